@@ -1,44 +1,139 @@
 import os
+import gc
 import logging
+import multiprocessing
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Importing this module only defines the extension objects; create_app() builds
+# and configures an application. Tables are created and upgraded by
+# `python setup_db.py` (see schema.init_database); the only query at startup
+# looks for unfinished image processing jobs. The prediction and ML code is
+# imported by the routes that use it, and by resume_jobs() if there are any.
 
 class Base(DeclarativeBase):
     pass
 
 db = SQLAlchemy(model_class=Base)
 
-# Create the app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "genosense_default_secret_key")
+logger = logging.getLogger(__name__)
 
-# Configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///genosense.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-app.config["UPLOAD_FOLDER"] = "uploads"
-app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB max upload size
 
-# Initialize the app with the extension
-db.init_app(app)
+def default_config():
+    """Configuration from the environment"""
+    return {
+        "SECRET_KEY": os.environ.get("SESSION_SECRET", "genosense_default_secret_key"),
+        "SQLALCHEMY_DATABASE_URI": os.environ.get("DATABASE_URL", "sqlite:///genosense.db"),
+        "SQLALCHEMY_ENGINE_OPTIONS": {
+            "pool_recycle": 300,
+            "pool_pre_ping": True,
+        },
+        "UPLOAD_FOLDER": "uploads",
+        "MAX_CONTENT_LENGTH": int(os.environ.get("MAX_CONTENT_LENGTH", 16 * 1024 * 1024)),  # 16MB max upload size by default
+        "TILE_CACHE_FOLDER": os.environ.get("TILE_CACHE_FOLDER", "tile_cache"),
+        "TILE_CACHE_MAX_BYTES": int(os.environ.get("TILE_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+        "PREVIEW_FOLDER": os.environ.get("PREVIEW_FOLDER", "previews"),  # Thumbnails and tile pyramids of uploaded images; empty disables them
+        "PREDICTION_CACHE_MAX_BYTES": int(os.environ.get("PREDICTION_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        "PREDICTION_CACHE_FOLDER": os.environ.get("PREDICTION_CACHE_FOLDER"),  # Unset keeps the cache in memory only
+        "ANALYSIS_CACHE_MAX_BYTES": int(os.environ.get("ANALYSIS_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+        "JOB_WORKERS": int(os.environ.get("JOB_WORKERS", 2)),  # 0 processes uploads inline
+        "JOB_TIMEOUT": int(os.environ.get("JOB_TIMEOUT", 6 * 3600)),  # Seconds after which a running job counts as abandoned and can be retried
+        "RESUME_JOBS": os.environ.get("RESUME_JOBS", "1") == "1",  # Resume unfinished processing jobs at startup
+        "BATCH_WORKERS": int(os.environ.get("BATCH_WORKERS", os.cpu_count() or 1)),  # Detection processes per batch upload; 0 runs them in the job thread
+        "BATCH_MAX_CONTENT_LENGTH": int(os.environ.get("BATCH_MAX_CONTENT_LENGTH", 2 * 1024 * 1024 * 1024)),  # 2GB per batch upload by default
+        "INFERENCE_TILE_SIZE": int(os.environ.get("INFERENCE_TILE_SIZE", 512)),  # Pixels per model window
+        "INFERENCE_TILE_OVERLAP": int(os.environ.get("INFERENCE_TILE_OVERLAP", 32)),
+        "INFERENCE_BATCH_SIZE": int(os.environ.get("INFERENCE_BATCH_SIZE", 8)),
+        "MODEL_PRELOAD": os.environ.get("MODEL_PRELOAD", "0") == "1",  # Load active models at startup, e.g. before gunicorn forks
+        "ENSEMBLE_WORKERS": int(os.environ.get("ENSEMBLE_WORKERS", os.cpu_count() or 1)),  # Processes per worker for ensemble predictions; 0 runs them inline
+        "ENSEMBLE_MAX_MEMBERS": int(os.environ.get("ENSEMBLE_MAX_MEMBERS", 1000)),
+        "INFECTION_SNAPSHOT": os.environ.get("INFECTION_SNAPSHOT", "1") == "1",  # Per-worker columnar copy of the hot infection data for reads
+        "HOT_DATA_MONTHS": int(os.environ.get("HOT_DATA_MONTHS", 12)),  # Months kept out of the archive by setup_db.py --compact
+        "METRICS_ENABLED": os.environ.get("METRICS_ENABLED", "1") == "1",  # Request instrumentation and /metrics
+        "METRICS_FOLDER": os.environ.get("METRICS_FOLDER"),  # Shared by gunicorn workers so /metrics covers all of them
+        "SLOW_REQUEST_MS": float(os.environ.get("SLOW_REQUEST_MS", 0)),  # Log requests slower than this; 0 disables
+        "PROFILE_SLOW_REQUESTS": os.environ.get("PROFILE_SLOW_REQUESTS", "0") == "1",  # Profile every request, log slow ones
+    }
 
-# Ensure upload directory exists
-os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
-with app.app_context():
-    # Import models to create tables
-    import models
-    db.create_all()
+def configure_logging():
+    # DEBUG logs every SQL statement and response, which costs noticeably per
+    # request; per-query timings are available from /metrics instead.
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+    logging.getLogger("sqlalchemy").setLevel(os.environ.get("SQL_LOG_LEVEL", "WARNING").upper())
 
-# Import routes
-from routes import *
 
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+def resume_jobs(app):
+    """Resume image processing left unfinished by a previous process"""
+    from sqlalchemy import select
+    from sqlalchemy.exc import SQLAlchemyError
+    from models import ProcessingJob
+
+    with app.app_context():
+        try:
+            unfinished = db.session.execute(
+                select(ProcessingJob.id).where(ProcessingJob.status.in_(('queued', 'running'))).limit(1)
+            ).first()
+        except SQLAlchemyError as e:
+            # E.g. setup_db.py has not created the tables yet
+            logger.info(f"Not resuming jobs: {str(getattr(e, 'orig', e))}")
+            return
+    if unfinished is None:
+        return
+
+    import jobs
+    jobs.resume_jobs(app)
+
+
+def create_app(config=None):
+    """
+    Create the application
+
+    Args:
+        config: Optional mapping overriding the configuration from the environment
+
+    Returns:
+        Configured Flask app
+    """
+    configure_logging()
+
+    app = Flask(__name__)
+    app.config.update(default_config())
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+
+    import metrics
+    metrics.init_app(app)
+
+    # Session listeners keeping derived data in sync with InfectionData writes
+    import rollups  # Trend rollups
+    import clusters  # Map cluster index
+    import tiles  # Invalidates cached heatmap tiles
+    import versioning  # Bumps the dataset version
+
+    from routes import bp
+    app.register_blueprint(bp)
+
+    # Pool processes of ensembles and batches import the app too; they run no jobs
+    if app.config["RESUME_JOBS"] and app.config["JOB_WORKERS"] > 0 and multiprocessing.parent_process() is None:
+        if app.config["MODEL_PRELOAD"]:
+            # gunicorn --preload: the master forks the workers and must stay single-threaded
+            os.register_at_fork(after_in_child=lambda: resume_jobs(app))
+        else:
+            resume_jobs(app)
+
+    if app.config["MODEL_PRELOAD"]:
+        from model_registry import get_registry
+        with app.app_context():
+            get_registry().refresh()
+            # Workers forked after this must not share the master's connections
+            db.engine.dispose()
+        # Keep the preloaded objects out of later collections, so forked workers
+        # don't write to (and copy) the pages they share with the master
+        gc.freeze()
+
+    return app
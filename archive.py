@@ -0,0 +1,144 @@
+import logging
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import select, insert, delete, func, text, union_all
+from sqlalchemy.orm import aliased
+
+from app import db
+from models import InfectionData, InfectionArchive
+from clusters import rebuild_clusters
+from versioning import mark_changed
+
+# Time-partitioned history of InfectionData. The infection_data table holds the
+# hot rows the map, tiles, clusters and predictions work on; compact() moves rows
+# recorded before a cutoff into infection_data_archive, keeping their ids. On
+# PostgreSQL the archive is range partitioned by month (compact() creates the
+# partitions it needs), elsewhere it is a single table indexed on date_recorded.
+#
+# Archived rows stay queryable: a request with a date range reaching back into
+# the archive reads infection_source(), which maps InfectionData onto the union
+# of both tables. Requests without a date range only see the hot table, so their
+# cost follows the retained months rather than the whole history. The trend
+# rollups keep covering the full history.
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = ('id', 'latitude', 'longitude', 'infection_level', 'date_recorded', 'source_image_id', 'grid_cell')
+
+
+def date_conditions(model, start=None, end=None):
+    """
+    SQL conditions selecting the rows of a model recorded in a date range
+
+    Args:
+        model: Mapped class with a date_recorded column
+        start, end: Inclusive dates, or None for an open end
+
+    Returns:
+        List of conditions for Select.where()
+    """
+    conditions = []
+    if start is not None:
+        conditions.append(model.date_recorded >= datetime.combine(start, time.min))
+    if end is not None:
+        conditions.append(model.date_recorded < datetime.combine(end + timedelta(days=1), time.min))
+    return conditions
+
+
+def archived_until():
+    """Recording time of the newest archived row, or None if the archive is empty"""
+    return db.session.execute(select(func.max(InfectionArchive.date_recorded))).scalar()
+
+
+def infection_history():
+    """InfectionData mapped onto the union of the hot and the archived rows"""
+    hot = select(*[InfectionData.__table__.c[name] for name in _COLUMNS])
+    archived = select(*[InfectionArchive.__table__.c[name] for name in _COLUMNS])
+    return aliased(InfectionData, union_all(hot, archived).subquery('infection_history'))
+
+
+def infection_source(start=None, end=None):
+    """
+    Entity to query for infections in a date range
+
+    Returns:
+        InfectionData, or infection_history() if the range reaches archived rows
+    """
+    if start is None and end is None:
+        return InfectionData
+
+    newest = archived_until()
+    if newest is None or (start is not None and newest < datetime.combine(start, time.min)):
+        return InfectionData
+    return infection_history()
+
+
+def _create_partitions(first, before):
+    """Create the monthly archive partitions covering [first, before) on PostgreSQL"""
+    table = InfectionArchive.__tablename__
+    month = datetime(first.year, first.month, 1)
+    while month < before:
+        following = (month + timedelta(days=32)).replace(day=1)
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {table}_{month:%Y_%m} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        ))
+        month = following
+
+
+def compact(before):
+    """
+    Move the infections recorded before a date from the hot table to the archive
+
+    The move, the dataset version bump and the rebuilt cluster index are
+    committed together.
+
+    Args:
+        before: Date; rows recorded earlier are archived
+
+    Returns:
+        Number of archived rows
+    """
+    before = datetime.combine(before, time.min)
+    hot = InfectionData.__table__
+    moved = hot.c.date_recorded < before
+
+    count, first, south, north, west, east = db.session.execute(
+        select(
+            func.count(), func.min(hot.c.date_recorded),
+            func.min(hot.c.latitude), func.max(hot.c.latitude),
+            func.min(hot.c.longitude), func.max(hot.c.longitude)
+        ).where(moved)
+    ).one()
+    if count == 0:
+        return 0
+
+    # Removing rows from the hot table invalidates delta cursors
+    mark_changed(db.session, rewrite=True)
+    if db.engine.dialect.name == 'postgresql':
+        _create_partitions(first, before)
+
+    # Executed on the session's connection to skip ORM statement handling
+    connection = db.session.connection()
+    connection.execute(
+        insert(InfectionArchive.__table__).from_select(
+            list(_COLUMNS), select(*[hot.c[name] for name in _COLUMNS]).where(moved)
+        )
+    )
+    connection.execute(delete(hot).where(moved))
+
+    # The bounding box corners are enough for tile invalidation after commit
+    db.session.info.setdefault('tile_points', []).extend([(south, west), (north, east)])
+
+    # The cluster index only covers the hot table; rebuilding it commits the move
+    rebuild_clusters()
+
+    logger.info(f"Archived {count} infection points recorded before {before:%Y-%m-%d}")
+    return count
+
+
+def months_ago(months, today=None):
+    """First day of the month `months` calendar months before today's month"""
+    today = today or datetime.utcnow().date()
+    index = today.year * 12 + today.month - 1 - months
+    return today.replace(year=index // 12, month=index % 12 + 1, day=1)
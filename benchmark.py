@@ -0,0 +1,459 @@
+"""
+Benchmark suite for the Genosense API and processing pipeline
+
+Synthetic plantation datasets are generated from a fixed seed into scratch SQLite
+databases (reused between runs), then each endpoint is timed through the Flask
+test client. Every dataset size runs in its own process, since the app reads its
+database from the environment. Startup is timed by importing the app in fresh
+processes; it must stay within an import budget and must not load the modules in
+LAZY_MODULES. Results are written as JSON and compared against a stored baseline;
+the exit status is 1 when a case got slower than the threshold or startup is over
+its budget.
+
+Usage:
+    python benchmark.py                                 # 1k, 100k and 1M points
+    python benchmark.py --sizes 1k,10m --repeat 3
+    python benchmark.py --update-baseline               # store the results as the baseline
+    python benchmark.py --baseline other.json --threshold 0.1
+    python benchmark.py --import-budget 500             # startup budget in ms
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+# Bump when the generator changes so cached datasets are rebuilt
+GENERATOR_VERSION = 1
+
+DEFAULT_SIZES = '1k,100k,1m'
+DEFAULT_SEED = 42
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.2
+
+# Slowdowns smaller than this are timer noise, whatever their relative size
+NOISE_FLOOR_MS = 2.0
+DEFAULT_DATA_DIR = '.benchmark_data'
+DEFAULT_OUTPUT = 'benchmark_results.json'
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+# Synthetic plantations: estates of palms on a 9m triangular grid in Riau, each
+# with a few infection foci spreading outwards over one season
+REGION = (100.5, -0.5, 103.5, 2.0)  # west, south, east, north
+ESTATE_SIZE = 0.04  # Degrees (~4.5km)
+PALM_SPACING = 0.00008  # Degrees (~9m)
+POINTS_PER_ESTATE = 20000
+FOCI_PER_ESTATE = 6
+FOCUS_RADIUS = 0.002  # Standard deviation of a focus, in degrees (~220m)
+SEASON_START = datetime(2024, 1, 1)
+SEASON_DAYS = 180
+GENERATE_CHUNK = 100000
+
+# Synthetic orthomosaic for process_image: 5 bands (blue, green, red, red edge, NIR)
+RASTER_SIZE = 4096
+
+# Time allowed for importing the app (main.py, which creates it) in a fresh process
+IMPORT_BUDGET_MS = 1500
+
+# Prediction, image processing and import code, loaded by the routes that use it
+LAZY_MODULES = ('ml_models', 'inference', 'raster', 'model_registry', 'jobs', 'uploads',
+                'cellular_automata', 'ensemble', 'ingest')
+
+STARTUP_SCRIPT = """
+import sys, time, json
+started = time.perf_counter()
+import main
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({'ms': elapsed, 'loaded': [name for name in %r if name in sys.modules]}))
+"""
+
+# (name, method, url, json body, largest dataset size the case runs at)
+ENDPOINT_CASES = [
+    ('infection_data_viewport', 'get', '/api/infection_data?bbox={estate}&zoom=15&limit=5000', None, None),
+    ('infection_data_region', 'get', '/api/infection_data?bbox={region}&zoom=8&limit=5000', None, None),
+    ('infection_data_all', 'get', '/api/infection_data', None, 1000000),
+    ('trend_data_daily', 'get', '/api/trend_data', None, None),
+    ('trend_data_weekly', 'get', '/api/trend_data?granularity=week', None, None),
+    ('predict_cold', 'post', '/api/predict', {'days': 30, 'seed': 1}, 1000000),
+    ('predict_cached', 'post', '/api/predict', {'days': 30, 'seed': 1}, 1000000),
+    ('predict_delta_cold', 'post', '/api/predict', {'days': 30, 'seed': 1, 'format': 'delta'}, 1000000),
+]
+
+
+def parse_size(value):
+    """Parse a dataset size such as 1k, 100k, 1m or 2500"""
+    value = value.strip().lower()
+    multiplier = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    return int(float(value.rstrip('km')) * multiplier)
+
+
+def format_size(size):
+    if size >= 1000000 and size % 1000000 == 0:
+        return f'{size // 1000000}m'
+    if size >= 1000 and size % 1000 == 0:
+        return f'{size // 1000}k'
+    return str(size)
+
+
+def _estates(size, seed):
+    """Estate origins and infection foci of a dataset (independent of chunking)"""
+    rng = np.random.default_rng([seed, size])
+    west, south, east, north = REGION
+    count = max(1, -(-size // POINTS_PER_ESTATE))
+    origins = np.column_stack([
+        rng.uniform(south, north - ESTATE_SIZE, count),
+        rng.uniform(west, east - ESTATE_SIZE, count),
+    ])
+    foci = origins[:, None, :] + rng.uniform(0.1, 0.9, (count, FOCI_PER_ESTATE, 2)) * ESTATE_SIZE
+    onset = rng.uniform(0, SEASON_DAYS / 2, (count, FOCI_PER_ESTATE))
+    return origins, foci.reshape(-1, 2), onset.ravel()
+
+
+def generate_chunk(size, seed, chunk):
+    """
+    Points of one chunk of a synthetic dataset
+
+    Returns:
+        Tuple of latitude, longitude, level and date arrays
+    """
+    origins, foci, onset = _estates(size, seed)
+    start = chunk * GENERATE_CHUNK
+    count = min(GENERATE_CHUNK, size - start)
+    rng = np.random.default_rng([seed, size, chunk])
+
+    focus = rng.integers(0, len(foci), count)
+    offsets = rng.normal(0, FOCUS_RADIUS, (count, 2))
+    distance = np.hypot(offsets[:, 0], offsets[:, 1]) / FOCUS_RADIUS
+
+    # Snap to the palm grid of the estate; odd rows are offset by half a palm
+    origin = origins[focus // FOCI_PER_ESTATE]
+    position = foci[focus] + offsets
+    row = np.round((position[:, 0] - origin[:, 0]) / (PALM_SPACING * 0.866))
+    col = np.round((position[:, 1] - origin[:, 1]) / PALM_SPACING - 0.5 * (row % 2)) + 0.5 * (row % 2)
+    lats = origin[:, 0] + row * PALM_SPACING * 0.866
+    lngs = origin[:, 1] + col * PALM_SPACING
+
+    # Trees near a focus were infected earlier and are further along
+    levels = np.clip(0.95 - 0.25 * distance + rng.normal(0, 0.08, count), 0.05, 1.0)
+    days = np.clip(onset[focus] + distance * 30 + rng.exponential(10, count), 0, SEASON_DAYS - 1)
+    dates = np.datetime64(SEASON_START, 's') + (days * 86400).astype('timedelta64[s]')
+    return lats, lngs, levels, dates
+
+
+def estate_bbox(size, seed):
+    """Bounding box of the first estate, as a bbox query parameter"""
+    origins, _, _ = _estates(size, seed)
+    south, west = origins[0]
+    return f'{west},{south},{west + ESTATE_SIZE},{south + ESTATE_SIZE}'
+
+
+def _scratch_environment(database_path, scratch_dir):
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': f'sqlite:///{database_path}',
+        'JOB_WORKERS': '0',
+        'MODEL_PRELOAD': '0',
+        'TILE_CACHE_FOLDER': os.path.join(scratch_dir, 'tile_cache'),
+    })
+    env.pop('PREDICTION_CACHE_FOLDER', None)
+    return env
+
+
+def _time_calls(call, repeat, reset=None):
+    """Warm up once, then time repeat calls"""
+    if reset:
+        reset()
+    response = call()
+    if response.status_code != 200:
+        raise RuntimeError(f"Status {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+    samples = []
+    for _ in range(repeat):
+        if reset:
+            reset()
+        started = time.perf_counter()
+        response = call()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    samples = np.array(samples)
+    return {
+        'median_ms': float(np.median(samples)),
+        'min_ms': float(samples.min()),
+        'mean_ms': float(samples.mean()),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'bytes': len(response.get_data()),
+        'repeat': repeat
+    }
+
+
+def run_dataset(size, seed, repeat):
+    """Generate (if needed) and benchmark one dataset; runs inside the worker process"""
+    from app import create_app, db
+    from schema import init_database
+    from ingest import insert_infections
+    from models import InfectionData
+    import result_cache
+
+    app = create_app()
+    results = {'size': size, 'cases': {}}
+    with app.app_context():
+        init_database()
+        if db.session.query(InfectionData.id).first() is None:
+            started = time.perf_counter()
+            for chunk in range(-(-size // GENERATE_CHUNK)):
+                lats, lngs, levels, dates = generate_chunk(size, seed, chunk)
+                insert_infections(lats, lngs, levels, dates=dates)
+                db.session.commit()
+            results['generate_seconds'] = time.perf_counter() - started
+
+        client = app.test_client()
+        west, south, east, north = REGION
+        params = {'estate': estate_bbox(size, seed), 'region': f'{west},{south},{east},{north}'}
+
+        def reset_prediction_cache():
+            result_cache._prediction_cache = None
+
+        for name, method, url, body, max_size in ENDPOINT_CASES:
+            if max_size is not None and size > max_size:
+                results['cases'][name] = {'skipped': f'only run up to {format_size(max_size)} points'}
+                continue
+            url = url.format(**params)
+            call = (lambda url=url: client.get(url)) if method == 'get' else (lambda url=url, body=body: client.post(url, json=body))
+            reset = reset_prediction_cache if name.endswith('_cold') else None
+            results['cases'][name] = _time_calls(call, repeat, reset)
+            print(f"  {format_size(size):>5} {name:<24} {results['cases'][name]['median_ms']:10.1f} ms", file=sys.stderr)
+    return results
+
+
+def run_process_image(seed, repeat, scratch_dir):
+    """Benchmark process_image on a synthetic GeoTIFF; runs inside the worker process"""
+    from app import create_app, db
+    from schema import init_database
+    from models import ImageData
+    from ml_models import process_image
+    from raster import create_raster, MODEL_PIXEL_SCALE, MODEL_TIEPOINT, GEO_KEY_DIRECTORY
+
+    path = os.path.join(scratch_dir, 'orthomosaic.tif')
+    west, south, _, north = REGION
+    geo_tags = {
+        MODEL_PIXEL_SCALE: (0.000002, 0.000002, 0.0),
+        MODEL_TIEPOINT: (0, 0, 0, west + 1, north - 1, 0),
+        GEO_KEY_DIRECTORY: (1, 1, 0, 1, 1024, 0, 1, 2),
+    }
+    pixels = create_raster(path, RASTER_SIZE, RASTER_SIZE, 5, np.uint16, geo_tags)
+    rng = np.random.default_rng([seed, RASTER_SIZE])
+    for row in range(0, RASTER_SIZE, 512):
+        block = pixels[row:row + 512]
+        block[..., 0:4] = rng.integers(1500, 3500, block.shape[:2] + (4,), dtype=np.uint16)
+        block[..., 4] = rng.integers(20000, 32000, block.shape[:2], dtype=np.uint16)
+    # Stressed patches with a low NIR response
+    for center_row, center_col in rng.integers(256, RASTER_SIZE - 256, (12, 2)):
+        pixels[center_row - 128:center_row + 128, center_col - 128:center_col + 128, 4] = 6000
+    pixels.flush()
+    del pixels
+
+    app = create_app()
+    with app.app_context():
+        init_database()
+        image = ImageData(filename=os.path.basename(path))
+        db.session.add(image)
+        db.session.commit()
+
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            if process_image(path, image.id) is None:
+                raise RuntimeError("process_image failed")
+            samples.append((time.perf_counter() - started) * 1000)
+
+    samples = np.array(samples)
+    megapixels = RASTER_SIZE * RASTER_SIZE / 1e6
+    result = {
+        'median_ms': float(np.median(samples)),
+        'min_ms': float(samples.min()),
+        'mean_ms': float(samples.mean()),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'megapixels_per_second': megapixels / (np.median(samples) / 1000),
+        'repeat': repeat
+    }
+    print(f"  {'raster':>5} {'process_image':<24} {result['median_ms']:10.1f} ms", file=sys.stderr)
+    return {'cases': {'process_image': result}}
+
+
+def _run_worker(args, extra, database_path, scratch_dir):
+    """Run one benchmark group in a fresh process and return its results"""
+    result_path = os.path.join(scratch_dir, 'result.json')
+    command = [sys.executable, os.path.abspath(__file__), '--worker', '--seed', str(args.seed),
+               '--repeat', str(args.repeat), '--result-file', result_path] + extra
+    subprocess.run(command, cwd=scratch_dir, env=_scratch_environment(database_path, scratch_dir), check=True)
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def run_startup(repeat, database_path, scratch_dir):
+    """Time importing the app in fresh processes"""
+    env = _scratch_environment(database_path, scratch_dir)
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    loaded = set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT % (LAZY_MODULES,)], cwd=scratch_dir,
+                                env=env, capture_output=True, text=True, check=True).stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        samples.append(sample['ms'])
+        loaded.update(sample['loaded'])
+
+    samples = np.array(samples)
+    result = {
+        'median_ms': float(np.median(samples)),
+        'min_ms': float(samples.min()),
+        'mean_ms': float(samples.mean()),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'eager_modules': sorted(loaded),
+        'repeat': repeat
+    }
+    print(f"  {'start':>5} {'import_app':<24} {result['median_ms']:10.1f} ms", file=sys.stderr)
+    return {'cases': {'import_app': result}}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Compare the median times of two result sets
+
+    Returns:
+        List of (group, case, baseline_ms, current_ms, change) for cases present
+        in both, where change is the relative slowdown (0.1 = 10% slower)
+    """
+    rows = []
+    for group, current in results['groups'].items():
+        previous = baseline.get('groups', {}).get(group)
+        if previous is None:
+            continue
+        for case, timing in current['cases'].items():
+            before = previous['cases'].get(case, {})
+            if 'median_ms' in timing and 'median_ms' in before:
+                change = timing['median_ms'] / before['median_ms'] - 1
+                rows.append((group, case, before['median_ms'], timing['median_ms'], change))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma-separated dataset sizes (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Timed calls per case')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help='Where generated datasets are kept')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative slowdown reported as a regression (default: %(default)s)')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--skip-process-image', action='store_true')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_MS,
+                        help='Milliseconds allowed for importing the app (default: %(default)s)')
+    # Internal: run one group inside a worker process
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        import logging
+        logging.disable(logging.INFO)
+        if args.size is None:
+            result = run_process_image(args.seed, args.repeat, os.getcwd())
+        else:
+            result = run_dataset(args.size, args.seed, args.repeat)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {
+        'meta': {
+            'date': datetime.utcnow().isoformat(timespec='seconds'),
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'generator_version': GENERATOR_VERSION
+        },
+        'groups': {}
+    }
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        results['groups']['startup'] = run_startup(
+            args.repeat, os.path.join(scratch_dir, 'startup.db'), scratch_dir
+        )
+
+    for size in [parse_size(value) for value in args.sizes.split(',')]:
+        name = f'synthetic-{format_size(size)}-seed{args.seed}-v{GENERATOR_VERSION}.db'
+        database_path = os.path.abspath(os.path.join(args.data_dir, name))
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            results['groups'][format_size(size)] = _run_worker(
+                args, ['--size', str(size)], database_path, scratch_dir
+            )
+
+    if not args.skip_process_image:
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            results['groups']['raster'] = _run_worker(
+                args, [], os.path.join(scratch_dir, 'raster.db'), scratch_dir
+            )
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    startup = results['groups']['startup']['cases']['import_app']
+    startup_failed = startup['median_ms'] > args.import_budget or startup['eager_modules']
+    if startup['median_ms'] > args.import_budget:
+        print(f"Importing the app took {startup['median_ms']:.0f}ms, over the {args.import_budget:.0f}ms budget")
+    if startup['eager_modules']:
+        print(f"Importing the app loaded {', '.join(startup['eager_modules'])}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline updated: {args.baseline}")
+        return 1 if startup_failed else 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to create one")
+        return 1 if startup_failed else 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = 0
+    print(f"\n{'group':>6} {'case':<24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for group, case, before, after, change in compare(results, baseline):
+        flag = ''
+        if change > args.threshold and after - before > NOISE_FLOOR_MS:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{group:>6} {case:<24} {before:8.1f}ms {after:8.1f}ms {change:+7.1%}{flag}")
+    if regressions:
+        print(f"\n{regressions} case(s) slower than the baseline by more than {args.threshold:.0%} "
+              f"(and {NOISE_FLOOR_MS:.0f}ms)")
+        return 1
+    return 1 if startup_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,100 +1,465 @@
-import numpy as np
+import copy
+import math
+import base64
 import logging
 
+import numpy as np
+
+from metrics import timed
+
 logger = logging.getLogger(__name__)
 
-def predict_spread(current_state, days):
+# Default grid resolution in degrees (~55m at the equator, a handful of palms per cell)
+DEFAULT_CELL_SIZE = 0.0005
+
+# Upper bound on the number of cells in the simulation grid. When the infected
+# area is too large for the requested resolution the cell size is coarsened.
+MAX_GRID_CELLS = 4_000_000
+
+# Longest prediction the API accepts. The grid is padded by one cell per day, so
+# the padding alone must stay well below MAX_GRID_CELLS.
+MAX_PREDICTION_DAYS = 730
+
+# Upper bound on the number of newly infected cells reported per timeframe
+MAX_NEW_POINTS = 5000
+
+# Moore neighbourhood kernel: orthogonal neighbours weigh more than diagonal ones
+SPREAD_KERNEL = np.array([
+    [0.7071, 1.0, 0.7071],
+    [1.0,    0.0, 1.0],
+    [0.7071, 1.0, 0.7071],
+], dtype=np.float32)
+
+# Transition parameters (per day)
+TRANSMISSION_RATE = 0.08   # Infection pressure -> infection probability scale
+GROWTH_RATE = 0.03         # Logistic growth rate of severity inside an infected cell
+INITIAL_LEVEL = 0.1        # Severity of a freshly infected cell
+
+
+def _logit(levels):
+    """Log-odds of infection levels, with 0 mapping to -inf and 1 to +inf"""
+    levels = np.clip(np.asarray(levels, dtype=np.float64), 0.0, 1.0)
+    with np.errstate(divide='ignore'):
+        return (np.log(levels) - np.log1p(-levels)).astype(np.float32)
+
+
+def _sigmoid(values):
+    """Inverse of _logit"""
+    with np.errstate(over='ignore'):
+        return 1.0 / (1.0 + np.exp(-values))
+
+
+class InfectionGrid:
+    """
+    Raster representation of infection severity used by the Cellular Automata model
+
+    Severity inside an infected cell follows logistic growth, so instead of the level
+    itself each cell stores the offset ``b`` of its log-odds curve and the level on
+    day ``t`` is ``sigmoid(growth_rate * t + b)``. Susceptible cells have ``b = -inf``.
+    This keeps a simulation step proportional to the infection frontier (susceptible
+    cells with at least one infected neighbour) rather than to the size of the grid.
+
+    Raises:
+        ValueError: If cell_size is not a positive number, or `days` of padding
+            alone need more than max_cells cells
+    """
+
+    def __init__(self, lats, lngs, levels, days, cell_size=DEFAULT_CELL_SIZE,
+                 max_cells=MAX_GRID_CELLS, growth_rate=GROWTH_RATE):
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+
+        # Infection travels at most one cell per day, so pad the extent by `days` cells
+        lat_span = float(lats.max() - lats.min())
+        lng_span = float(lngs.max() - lngs.min())
+        cell_size = float(cell_size)
+        if not math.isfinite(cell_size) or cell_size <= 0:
+            raise ValueError("cell_size must be a positive number")
+        # Coarsening shrinks the extent but not the padding
+        if (1 + 2 * days) ** 2 > max_cells:
+            raise ValueError(f"A {days} day prediction needs more than {max_cells} grid cells")
+        while True:
+            rows = int(lat_span / cell_size) + 1 + 2 * days
+            cols = int(lng_span / cell_size) + 1 + 2 * days
+            if rows * cols <= max_cells:
+                break
+            cell_size *= 1.5
+
+        logger.debug(f"Simulating on a {rows}x{cols} grid with cell size {cell_size:.6f}")
+
+        self.cell_size = cell_size
+        self.rows = rows
+        self.cols = cols
+        self.growth_rate = growth_rate
+        self.origin_lat = float(lats.min()) - days * cell_size
+        self.origin_lng = float(lngs.min()) - days * cell_size
+
+        # Cells are stored with a one-cell border so neighbour offsets never wrap
+        self.stride = cols + 2
+        self.offsets = np.array([
+            dr * self.stride + dc
+            for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc
+        ], dtype=np.int64)
+        self.weights = np.array([
+            SPREAD_KERNEL[dr + 1, dc + 1]
+            for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc
+        ], dtype=np.float32)
+
+        self.point_cells = self.cell_index(lats, lngs)
+        self.point_offsets = _logit(levels)
+
+        # A cell's severity is the highest severity observed inside it
+        self.offset = np.full((rows + 2) * self.stride, -np.inf, dtype=np.float32)
+        np.maximum.at(self.offset, self.point_cells, self.point_offsets)
+
+        # Border cells are never candidates for infection
+        self.blocked = np.zeros((rows + 2, self.stride), dtype=bool)
+        self.blocked[[0, -1], :] = True
+        self.blocked[:, [0, -1]] = True
+        self.blocked = self.blocked.ravel()
+        self.blocked |= self.offset > -np.inf
+
+        # Scratch array used to drop duplicate neighbours without sorting
+        self.stamp = np.zeros(self.offset.size, dtype=np.int32)
+
+        # Newly infected cells per simulated day, in order of infection
+        self.new_cells = []
+
+        seeded = np.flatnonzero(self.offset > -np.inf)
+        self.frontier = np.empty(0, dtype=np.int64)
+        self._extend_frontier(seeded)
+
+    def copy(self):
+        """Independent copy of the grid, for running several realizations from one state"""
+        grid = copy.copy(self)
+        grid.offset = self.offset.copy()
+        grid.blocked = self.blocked.copy()
+        grid.new_cells = list(self.new_cells)
+        return grid
+
+    def cell_index(self, lats, lngs):
+        """Flat (bordered) grid index of the cells containing the given coordinates"""
+        row = ((lats - self.origin_lat) / self.cell_size).astype(np.int64)
+        col = ((lngs - self.origin_lng) / self.cell_size).astype(np.int64)
+        np.clip(row, 0, self.rows - 1, out=row)
+        np.clip(col, 0, self.cols - 1, out=col)
+        return (row + 1) * self.stride + (col + 1)
+
+    def cell_centers(self, flat_index):
+        """Latitude/longitude of the centres of the given flat cell indices"""
+        row, col = np.divmod(flat_index, self.stride)
+        lat = self.origin_lat + (row - 0.5) * self.cell_size
+        lng = self.origin_lng + (col - 0.5) * self.cell_size
+        return lat, lng
+
+    def levels(self, flat_index, day):
+        """Infection level of the given cells on a given day"""
+        return _sigmoid(self.growth_rate * day + self.offset[flat_index])
+
+    def _extend_frontier(self, cells):
+        """Add the susceptible neighbours of newly infected cells to the frontier"""
+        if not cells.size:
+            return
+        neighbours = (cells[:, None] + self.offsets).ravel()
+        neighbours = neighbours[~self.blocked[neighbours]]
+        order = np.arange(neighbours.size, dtype=np.int32)
+        self.stamp[neighbours] = order
+        neighbours = neighbours[self.stamp[neighbours] == order]
+        self.blocked[neighbours] = True
+        self.frontier = np.concatenate([self.frontier, neighbours])
+
+    def step(self, day, rng, transmission_rate=TRANSMISSION_RATE):
+        """
+        Advance the grid by one day
+
+        Every frontier cell is infected with probability ``1 - exp(-beta * p)``, where
+        ``p`` is the kernel-weighted severity of its neighbourhood on the previous day.
+
+        Returns:
+            Array of flat indices of the cells infected on this day
+        """
+        if not self.frontier.size:
+            self.new_cells.append(self.frontier)
+            return self.frontier
+
+        if self.frontier.size * self.offsets.size > self.offset.size:
+            # Large frontier: convolving the whole grid with shifted views is cheaper
+            # than gathering every neighbour individually
+            grid_levels = self.levels(slice(None), day - 1)
+            grid_pressure = np.zeros_like(grid_levels)
+            lo, hi = self.stride + 1, grid_levels.size - self.stride - 1
+            scratch = np.empty(hi - lo, dtype=np.float32)
+            for offset, weight in zip(self.offsets, self.weights):
+                np.multiply(grid_levels[lo + offset:hi + offset], weight, out=scratch)
+                grid_pressure[lo:hi] += scratch
+            pressure = grid_pressure[self.frontier]
+        else:
+            neighbour_levels = self.levels(self.frontier[:, None] + self.offsets, day - 1)
+            pressure = neighbour_levels @ self.weights
+        probability = -np.expm1(-transmission_rate * pressure)
+        infected = rng.random(self.frontier.size, dtype=np.float32) < probability
+
+        newly = self.frontier[infected]
+        self.frontier = self.frontier[~infected]
+        self.offset[newly] = _logit(INITIAL_LEVEL) - self.growth_rate * day
+        self._extend_frontier(newly)
+
+        self.new_cells.append(newly)
+        return newly
+
+
+class InfectionPoints:
+    """
+    Infection points as parallel lat, lng and level arrays
+
+    Accepted wherever a list of point dictionaries is, without building one
+    dictionary per point (see snapshot.py).
+    """
+
+    __slots__ = ('lat', 'lng', 'level')
+
+    def __init__(self, lats, lngs, levels):
+        self.lat = np.asarray(lats, dtype=np.float64)
+        self.lng = np.asarray(lngs, dtype=np.float64)
+        self.level = np.asarray(levels, dtype=np.float64)
+
+    def __len__(self):
+        return self.lat.size
+
+    def to_list(self):
+        """The points as a list of dictionaries"""
+        return [{
+            'lat': lat,
+            'lng': lng,
+            'level': level
+        } for lat, lng, level in zip(self.lat.tolist(), self.lng.tolist(), self.level.tolist())]
+
+
+def point_list(current_state):
+    """List of point dictionaries of a list or InfectionPoints"""
+    if isinstance(current_state, InfectionPoints):
+        return current_state.to_list()
+    return current_state
+
+
+def _to_arrays(current_state):
+    """Split infection points (a list of dictionaries or InfectionPoints) into coordinate and level arrays"""
+    if isinstance(current_state, InfectionPoints):
+        return current_state.lat, current_state.lng, current_state.level
+    count = len(current_state)
+    lats = np.fromiter((p['lat'] for p in current_state), dtype=np.float64, count=count)
+    lngs = np.fromiter((p['lng'] for p in current_state), dtype=np.float64, count=count)
+    levels = np.fromiter((p['level'] for p in current_state), dtype=np.float64, count=count)
+    return lats, lngs, levels
+
+
+def frame_days_for(days):
+    """Days shown as timeframes of a prediction: day 0 and five steps up to `days`"""
+    return list(range(0, days + 1, max(1, days // 5)))
+
+
+def _frame_points(grid, lats, lngs, day, max_new_points):
+    """Build the list of points visible on a given day of the simulation"""
+    # Observed points keep their position and grow along their own logistic curve
+    levels = _sigmoid(grid.growth_rate * day + grid.point_offsets)
+    points = [{
+        'lat': lat,
+        'lng': lng,
+        'level': level
+    } for lat, lng, level in zip(lats.tolist(), lngs.tolist(), levels.tolist())]
+
+    # Newly infected cells, earliest infections first
+    new_cells = np.concatenate(grid.new_cells[:day])[:max_new_points]
+    cell_lats, cell_lngs = grid.cell_centers(new_cells)
+    cell_levels = grid.levels(new_cells, day)
+    points.extend({
+        'lat': lat,
+        'lng': lng,
+        'level': level
+    } for lat, lng, level in zip(cell_lats.tolist(), cell_lngs.tolist(), cell_levels.tolist()))
+
+    return points
+
+
+def _column(values, dtype):
+    """Little-endian typed-array column, base64 encoded for JSON"""
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+
+def _delta_prediction(grid, lats, lngs, frame_days, days, max_new_points):
+    """
+    Compact form of a prediction: each point is listed once and frames are deltas
+
+    Points are ordered by appearance (observed points first, then cells in order of
+    infection), so every frame shows a prefix of the point table. A point's level
+    on day t is sigmoid(growth_rate * t + offset), which lets clients derive the
+    level updates of every frame from one offset per point.
+    """
+    new_cells = np.concatenate(grid.new_cells)[:max_new_points] if grid.new_cells else np.empty(0, dtype=np.int64)
+    infection_days = np.repeat(np.arange(1, days + 1), [cells.size for cells in grid.new_cells])[:new_cells.size]
+    cell_lats, cell_lngs = grid.cell_centers(new_cells)
+
+    def frame(day):
+        return {'day': day, 'count': lats.size + int(np.searchsorted(infection_days, day, side='right'))}
+
+    return {
+        'format': 'delta',
+        'growth_rate': grid.growth_rate,
+        'observed': int(lats.size),
+        'columns': {
+            'lat': _column(np.concatenate([lats, cell_lats]), '<f8'),
+            'lng': _column(np.concatenate([lngs, cell_lngs]), '<f8'),
+            'offset': _column(np.concatenate([grid.point_offsets, grid.offset[new_cells]]), '<f4')
+        },
+        'timeframes': [frame(day) for day in frame_days],
+        'final': frame(days)
+    }
+
+
+def stream_prediction(current_state, days, cell_size=DEFAULT_CELL_SIZE, seed=None,
+                      max_new_points=MAX_NEW_POINTS, cancelled=None):
+    """
+    Predict the spread like predict_spread(delta=True), yielding every timeframe
+    as soon as the simulation reaches its day
+
+    Events are dictionaries with a 'type':
+        start: growth_rate, observed (number of observed points), days and frame_days
+        frame: day, count and the columns (lat, lng, offset, encoded as in the delta
+            format) of the points that appeared since the previous frame; the first
+            frame (day 0) carries the observed points
+        end: final {day, count} and the columns of the points that appeared after
+            the last frame
+        cancelled: sent instead of the remaining events once `cancelled` is set
+
+    Args:
+        cancelled: Optional threading.Event, checked before every simulated day
+    """
+    days = max(0, int(days))
+    frame_days = frame_days_for(days)
+    logger.info(f"Streaming a {days} day prediction based on {len(current_state)} infection points")
+
+    yield {
+        'type': 'start',
+        'growth_rate': GROWTH_RATE,
+        'observed': len(current_state),
+        'days': days,
+        'frame_days': frame_days
+    }
+
+    def columns(lats, lngs, offsets):
+        return {'lat': _column(lats, '<f8'), 'lng': _column(lngs, '<f8'), 'offset': _column(offsets, '<f4')}
+
+    if not current_state:
+        empty = columns([], [], [])
+        for day in frame_days:
+            yield {'type': 'frame', 'day': day, 'count': 0, 'columns': empty}
+        yield {'type': 'end', 'final': {'day': days, 'count': 0}, 'columns': empty}
+        return
+
+    lats, lngs, levels = _to_arrays(current_state)
+    grid = InfectionGrid(lats, lngs, levels, days, cell_size=cell_size)
+    rng = np.random.default_rng(seed)
+    yield {'type': 'frame', 'day': 0, 'count': int(lats.size), 'columns': columns(lats, lngs, grid.point_offsets)}
+
+    # Days whose new cells were not sent yet, and the number of cells sent
+    sent_days = 0
+    sent = 0
+
+    def appeared(day):
+        """Columns of the cells infected since the last event, within max_new_points"""
+        nonlocal sent_days, sent
+        chunks = grid.new_cells[sent_days:day]
+        cells = np.concatenate(chunks)[:max_new_points - sent] if chunks else np.empty(0, dtype=np.int64)
+        sent_days = day
+        sent += cells.size
+        cell_lats, cell_lngs = grid.cell_centers(cells)
+        return columns(cell_lats, cell_lngs, grid.offset[cells])
+
+    frames = set(frame_days)
+    for day in range(1, days + 1):
+        if cancelled is not None and cancelled.is_set():
+            logger.info(f"Prediction stream cancelled on day {day} of {days}")
+            yield {'type': 'cancelled', 'day': day}
+            return
+        grid.step(day, rng)
+        if day in frames:
+            new_columns = appeared(day)
+            yield {'type': 'frame', 'day': day, 'count': int(lats.size) + sent, 'columns': new_columns}
+
+    new_columns = appeared(days)
+    yield {'type': 'end', 'final': {'day': days, 'count': int(lats.size) + sent}, 'columns': new_columns}
+
+
+@timed('predict_spread')
+def predict_spread(current_state, days, cell_size=DEFAULT_CELL_SIZE, seed=None,
+                   max_new_points=MAX_NEW_POINTS, delta=False):
     """
     Predict the spread of Ganoderma infection using a Cellular Automata model
-    
+
+    The infection points are rasterized onto a grid and the grid is stepped one day
+    at a time: infected cells grow in severity and infect their susceptible
+    neighbours with a probability driven by the weighted neighbourhood severity.
+
     Args:
-        current_state: List of dictionaries with current infection data (lat, lng, level)
+        current_state: List of dictionaries with current infection data (lat, lng, level),
+            or InfectionPoints
         days: Number of days to predict into the future
-    
+        cell_size: Grid resolution in degrees
+        seed: Optional seed for reproducible predictions
+        max_new_points: Maximum number of newly infected cells reported per timeframe
+        delta: Return the compact delta-encoded form (see _delta_prediction)
+            instead of full point lists per timeframe
+
     Returns:
         Dictionary with prediction data for visualization
     """
     logger.info(f"Predicting spread for {days} days based on {len(current_state)} infection points")
-    
-    # In a real implementation, this would:
-    # 1. Convert the infection points into a grid
-    # 2. Define the cellular automata rules
-    # 3. Run the simulation for the specified number of days
-    # 4. Return the resulting infection spread
-    
-    # For this implementation, we'll simulate the spread by:
-    # - Keeping all original points
-    # - Adding new points around existing ones
-    # - Increasing infection levels over time
-    
-    # Copy the current state
-    prediction = current_state.copy()
-    
-    # Define the maximum number of new points to add in total
-    max_new_points = min(100, len(current_state) * days // 10)
-    
-    # Add new points based on the number of days
-    new_points_count = min(max_new_points, int(len(current_state) * days * 0.1))
-    
-    for _ in range(new_points_count):
-        # Select a random existing point as the source of spread
-        source_point = prediction[np.random.randint(0, len(prediction))]
-        
-        # Create a new point nearby
-        spread_distance = 0.005 * np.sqrt(days)  # Further spread over time
-        lat_offset = (np.random.random() - 0.5) * spread_distance
-        lng_offset = (np.random.random() - 0.5) * spread_distance
-        
-        # New infection level is based on source but decreases with distance
-        distance = np.sqrt(lat_offset**2 + lng_offset**2)
-        new_level = max(0.1, source_point['level'] * (1 - distance/spread_distance))
-        
-        # Add the new point
-        new_point = {
-            'lat': source_point['lat'] + lat_offset,
-            'lng': source_point['lng'] + lng_offset,
-            'level': new_level
+
+    days = max(0, int(days))
+    frame_days = frame_days_for(days)
+
+    if not current_state:
+        if delta:
+            empty = _column([], '<f8')
+            return {
+                'format': 'delta',
+                'growth_rate': GROWTH_RATE,
+                'observed': 0,
+                'columns': {'lat': empty, 'lng': empty, 'offset': empty},
+                'timeframes': [{'day': day, 'count': 0} for day in frame_days],
+                'final': {'day': days, 'count': 0}
+            }
+        return {
+            'initial_state': [],
+            'final_state': [],
+            'timeframes': [{'day': day, 'points': []} for day in frame_days]
         }
-        prediction.append(new_point)
-    
-    # Increase infection levels of existing points over time
-    for point in prediction:
-        # Increase by up to 20% based on days, but cap at 1.0
-        point['level'] = min(1.0, point['level'] * (1 + days * 0.005))
-    
-    # Create timeframes for visualization
-    timeframes = []
-    for day in range(0, days + 1, max(1, days // 5)):  # 5 timeframes
-        if day == 0:
-            # Initial state
-            timeframes.append({
-                'day': day,
-                'points': current_state.copy()
-            })
-        else:
-            # Calculate intermediate state
-            ratio = day / days
-            points_at_timeframe = []
-            
-            # Include original points with increased infection
-            for point in current_state:
-                p = point.copy()
-                p['level'] = min(1.0, p['level'] * (1 + day * 0.005))
-                points_at_timeframe.append(p)
-            
-            # Add new points proportional to timeframe
-            new_points_at_timeframe = int(new_points_count * ratio)
-            for i in range(new_points_at_timeframe):
-                if len(prediction) > len(current_state) + i:
-                    points_at_timeframe.append(prediction[len(current_state) + i])
-            
-            timeframes.append({
-                'day': day,
-                'points': points_at_timeframe
-            })
-    
+
+    lats, lngs, levels = _to_arrays(current_state)
+    grid = InfectionGrid(lats, lngs, levels, days, cell_size=cell_size)
+    rng = np.random.default_rng(seed)
+
+    for day in range(1, days + 1):
+        grid.step(day, rng)
+
+    if delta:
+        return _delta_prediction(grid, lats, lngs, frame_days, days, max_new_points)
+
+    current_state = point_list(current_state)
+    timeframes = [{'day': 0, 'points': [point.copy() for point in current_state]}]
+    for day in frame_days[1:]:
+        timeframes.append({
+            'day': day,
+            'points': _frame_points(grid, lats, lngs, day, max_new_points)
+        })
+
+    if frame_days[-1] == days:
+        final_state = timeframes[-1]['points']
+    else:
+        final_state = _frame_points(grid, lats, lngs, days, max_new_points)
+
     return {
         'initial_state': current_state,
-        'final_state': prediction,
+        'final_state': final_state,
         'timeframes': timeframes
     }
@@ -0,0 +1,296 @@
+import math
+import logging
+
+import numpy as np
+from sqlalchemy import event, inspect, select, insert, update, delete, case
+
+from app import db
+from models import InfectionData, InfectionCluster
+from spatial import DETAIL_ZOOM
+
+# Hierarchical clustering index of InfectionData for the map, in the spirit of
+# supercluster. At every zoom level below spatial.DETAIL_ZOOM the web mercator
+# plane is divided into cells of CLUSTER_PIXELS x CLUSTER_PIXELS screen pixels;
+# each cell of a zoom level splits into four at the next, so the levels form a
+# quadtree. InfectionCluster holds the count, coordinate sums and level sum/max
+# of every non-empty cell, so a viewport at any zoom is answered from a few
+# hundred index rows instead of the infection table.
+#
+# Like the rollups, the index is maintained incrementally: ORM inserts are folded
+# in when the session flushes, bulk loaders call add_to_clusters() once per batch
+# and rebuild_clusters() recomputes everything. A moved or removed point changes
+# a cell at every zoom, the world cell of zoom 0 included, so the level maximum
+# of those cells cannot be corrected without reading most of the table; ORM
+# updates and deletes therefore rebuild the index before their transaction
+# commits.
+
+logger = logging.getLogger(__name__)
+
+# Size of a cluster cell on screen
+CLUSTER_PIXELS = 64
+
+# Clusters are indexed for zoom levels 0 .. MAX_CLUSTER_ZOOM; closer zooms show points
+MAX_CLUSTER_ZOOM = DETAIL_ZOOM - 1
+
+# Rows folded into the index per statement
+UPSERT_CHUNK_SIZE = 1000
+
+# InfectionData columns the index is computed from
+CLUSTER_COLUMNS = ('latitude', 'longitude', 'infection_level')
+
+_MAX_LATITUDE = 85.0511
+
+
+def cells_per_side(zoom):
+    """Number of cluster cells along each axis of the world at a zoom level"""
+    return 256 * 2 ** zoom // CLUSTER_PIXELS
+
+
+def _mercator(lats, lngs):
+    """Web mercator coordinates normalized to 0-1 (y grows southward)"""
+    lat = np.radians(np.clip(np.asarray(lats, dtype=np.float64), -_MAX_LATITUDE, _MAX_LATITUDE))
+    x = (np.asarray(lngs, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2
+    return np.clip(x, 0, 1 - 1e-12), np.clip(y, 0, 1 - 1e-12)
+
+
+def cluster_totals(lats, lngs, levels, zooms=None):
+    """
+    Aggregate points into per-cell totals
+
+    Args:
+        lats, lngs, levels: Sequences of equal length
+        zooms: Zoom levels to aggregate for; None for every indexed level
+
+    Returns:
+        List of dictionaries with zoom, x, y, count, lat_sum, lng_sum, level_sum
+        and level_max
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    if lats.size == 0:
+        return []
+
+    mx, my = _mercator(lats, lngs)
+    rows = []
+    for zoom in range(MAX_CLUSTER_ZOOM + 1) if zooms is None else zooms:
+        n = cells_per_side(zoom)
+        keys = (my * n).astype(np.int64) * n + (mx * n).astype(np.int64)
+        cells, inverse = np.unique(keys, return_inverse=True)
+        level_max = np.zeros(cells.size)
+        np.maximum.at(level_max, inverse, levels)
+        columns = zip(
+            (cells % n).tolist(), (cells // n).tolist(),
+            np.bincount(inverse).tolist(),
+            np.bincount(inverse, weights=lats).tolist(),
+            np.bincount(inverse, weights=lngs).tolist(),
+            np.bincount(inverse, weights=levels).tolist(),
+            level_max.tolist()
+        )
+        rows.extend({
+            'zoom': zoom, 'x': x, 'y': y, 'count': count, 'lat_sum': lat_sum,
+            'lng_sum': lng_sum, 'level_sum': level_sum, 'level_max': level_max
+        } for x, y, count, lat_sum, lng_sum, level_sum, level_max in columns)
+    return rows
+
+
+def _upsert_statement(dialect):
+    """INSERT ... ON CONFLICT that adds to an existing cell, or None if unsupported"""
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+
+    table = InfectionCluster.__table__
+    statement = dialect_insert(table)
+    excluded = statement.excluded
+    return statement.on_conflict_do_update(
+        index_elements=['zoom', 'y', 'x'],
+        set_={
+            'count': table.c.count + excluded.count,
+            'lat_sum': table.c.lat_sum + excluded.lat_sum,
+            'lng_sum': table.c.lng_sum + excluded.lng_sum,
+            'level_sum': table.c.level_sum + excluded.level_sum,
+            'level_max': case((table.c.level_max < excluded.level_max, excluded.level_max),
+                              else_=table.c.level_max)
+        }
+    )
+
+
+def add_to_clusters(connection, lats, lngs, levels):
+    """
+    Fold new infection points into the cluster index
+
+    Args:
+        connection: Connection whose transaction the update joins
+        lats, lngs, levels: Sequences of equal length
+    """
+    rows = cluster_totals(lats, lngs, levels)
+    if not rows:
+        return
+
+    statement = _upsert_statement(connection.dialect.name)
+    if statement is not None:
+        for start in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            connection.execute(statement, rows[start:start + UPSERT_CHUNK_SIZE])
+        return
+
+    table = InfectionCluster.__table__
+    for row in rows:
+        result = connection.execute(
+            update(table)
+            .where(table.c.zoom == row['zoom'], table.c.y == row['y'], table.c.x == row['x'])
+            .values(
+                count=table.c.count + row['count'],
+                lat_sum=table.c.lat_sum + row['lat_sum'],
+                lng_sum=table.c.lng_sum + row['lng_sum'],
+                level_sum=table.c.level_sum + row['level_sum'],
+                level_max=case((table.c.level_max < row['level_max'], row['level_max']),
+                               else_=table.c.level_max)
+            )
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(**row))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _cluster_changed_infections(session, flush_context):
+    """Fold ORM inserts of InfectionData into the cluster index; flag a rebuild after updates and deletes"""
+    points = [
+        (obj.latitude, obj.longitude, obj.infection_level)
+        for obj in session.new if isinstance(obj, InfectionData)
+    ]
+    if points:
+        lats, lngs, levels = zip(*points)
+        add_to_clusters(session.connection(), lats, lngs, levels)
+
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, InfectionData) and (
+            obj in session.deleted
+            or any(inspect(obj).attrs[name].history.has_changes() for name in CLUSTER_COLUMNS)
+        ):
+            session.info['cluster_rebuild'] = True
+            break
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _flag_bulk_changes(orm_execute_state):
+    """Bulk updates and deletes of InfectionData may touch any cell"""
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ is InfectionData:
+            orm_execute_state.session.info['cluster_rebuild'] = True
+
+
+@event.listens_for(db.session, 'before_commit')
+def _rebuild_after_changes(session):
+    # Updates and deletes still pending flag the rebuild when they are flushed
+    session.flush()
+    if session.info.pop('cluster_rebuild', False):
+        recompute_clusters(session.connection())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('cluster_rebuild', None)
+
+
+def recompute_clusters(connection, batch_size=100000):
+    """
+    Recompute the cluster index from the infection table
+
+    Args:
+        connection: Connection whose transaction the update joins
+        batch_size: Infection rows read per partition
+    """
+    connection.execute(delete(InfectionCluster.__table__))
+    result = connection.execute(
+        select(InfectionData.latitude, InfectionData.longitude, InfectionData.infection_level)
+        .execution_options(stream_results=True, yield_per=batch_size)
+    )
+    for partition in result.partitions():
+        lats, lngs, levels = zip(*partition)
+        add_to_clusters(connection, lats, lngs, levels)
+
+
+def rebuild_clusters(batch_size=100000):
+    """Recompute the cluster index from scratch"""
+    recompute_clusters(db.session.connection(), batch_size)
+    db.session.commit()
+
+    logger.info(f"Rebuilt infection clusters ({InfectionCluster.query.count()} cells)")
+
+
+def ensure_clusters():
+    """Build the cluster index for databases that have infections but no clusters yet"""
+    if InfectionCluster.query.first() is None and InfectionData.query.first() is not None:
+        rebuild_clusters()
+
+
+def _cell_index(value, n):
+    return min(max(int(value * n), 0), n - 1)
+
+
+def get_clusters(bbox, zoom):
+    """
+    Clusters of a viewport
+
+    Args:
+        bbox: Tuple (west, south, east, north), or None for the whole world
+        zoom: Map zoom level, clamped to the indexed levels
+
+    Returns:
+        List of dictionaries with the centroid (lat, lng), count, mean_level,
+        max_level, and the zoom, x, y of the cell
+    """
+    zoom = min(max(int(zoom), 0), MAX_CLUSTER_ZOOM)
+    conditions = [InfectionCluster.zoom == zoom]
+    if bbox is not None:
+        west, south, east, north = bbox
+        n = cells_per_side(zoom)
+        (x_west, x_east), (y_south, y_north) = _mercator([south, north], [west, east])
+        conditions += [
+            InfectionCluster.x.between(_cell_index(x_west, n), _cell_index(x_east, n)),
+            InfectionCluster.y.between(_cell_index(y_north, n), _cell_index(y_south, n))
+        ]
+
+    rows = db.session.execute(
+        select(
+            InfectionCluster.x, InfectionCluster.y, InfectionCluster.count,
+            InfectionCluster.lat_sum, InfectionCluster.lng_sum,
+            InfectionCluster.level_sum, InfectionCluster.level_max
+        ).where(*conditions)
+    ).all()
+
+    return _cluster_dicts(rows, zoom)
+
+
+def cluster_points(lats, lngs, levels, zoom):
+    """
+    Cluster a set of points without the index, e.g. the points of a date range
+
+    Returns:
+        List of dictionaries shaped like get_clusters()
+    """
+    zoom = min(max(int(zoom), 0), MAX_CLUSTER_ZOOM)
+    rows = [
+        (row['x'], row['y'], row['count'], row['lat_sum'], row['lng_sum'], row['level_sum'], row['level_max'])
+        for row in cluster_totals(lats, lngs, levels, zooms=[zoom])
+    ]
+    return _cluster_dicts(rows, zoom)
+
+
+def _cluster_dicts(rows, zoom):
+    return [{
+        'lat': lat_sum / count,
+        'lng': lng_sum / count,
+        'count': count,
+        'mean_level': level_sum / count,
+        'max_level': level_max,
+        'zoom': zoom,
+        'x': x,
+        'y': y
+    } for x, y, count, lat_sum, lng_sum, level_sum, level_max in rows if count > 0]
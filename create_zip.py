@@ -16,6 +16,9 @@ def create_zip():
         # File Python inti
         "app.py", "main.py", "models.py", "routes.py", 
         "cellular_automata.py", "ml_models.py", "setup_db.py",
+        "jobs.py", "spatial.py", "schema.py", "rollups.py", "export.py", "tiles.py",
+        "versioning.py", "result_cache.py", "raster.py", "inference.py", "ingest.py",
+        "model_registry.py", "benchmark.py", "metrics.py", "uploads.py", "ensemble.py", "clusters.py", "archive.py", "snapshot.py", "patterns.py", "previews.py",
         
         # File konfigurasi
         "dependencies.txt", "README.md", ".gitignore",
@@ -27,6 +30,9 @@ def create_zip():
         # Template
         "templates",
         
+        # Pengujian
+        "tests", "pyproject.toml",
+        
         # Folder uploads (kosong)
         "uploads/.gitkeep"
     ]
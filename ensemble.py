@@ -0,0 +1,265 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from metrics import timed
+from cellular_automata import (
+    DEFAULT_CELL_SIZE, MAX_NEW_POINTS, InfectionGrid, _sigmoid, _to_arrays, frame_days_for, point_list
+)
+
+# Monte-Carlo ensembles of the Cellular Automata model. Each member is one
+# realization driven by its own child of a SeedSequence, so an ensemble is
+# reproducible for a given seed and member count no matter how members are split
+# across processes. Members run in chunks on a process pool; every chunk builds
+# the grid once, copies it per member and reduces its members to sparse per-cell
+# infection counts per timeframe, so only those counts travel back to the parent.
+#
+# This module does not import the app: pool processes only load the model code.
+
+logger = logging.getLogger(__name__)
+
+# Cells infected in fewer members than this are not reported
+MIN_PROBABILITY = 0.05
+
+# z-score of the two-sided 95% interval
+CONFIDENCE_Z = 1.96
+
+# Entries buffered by SparseCounts before they are merged
+COMPACT_SIZE = 4_000_000
+
+
+class SparseCounts:
+    """Per-cell count and level sum, accumulated from (cells, levels) batches"""
+
+    def __init__(self):
+        self.cells = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.level_sums = np.empty(0, dtype=np.float64)
+        self._pending = []
+        self._pending_size = 0
+
+    def add(self, cells, counts, level_sums):
+        self._pending.append((cells, counts, level_sums))
+        self._pending_size += cells.size
+        if self._pending_size >= COMPACT_SIZE:
+            self.compact()
+
+    def compact(self):
+        if not self._pending:
+            return self
+        cells = np.concatenate([self.cells] + [batch[0] for batch in self._pending])
+        counts = np.concatenate([self.counts] + [batch[1] for batch in self._pending])
+        level_sums = np.concatenate([self.level_sums] + [batch[2] for batch in self._pending])
+        self._pending = []
+        self._pending_size = 0
+
+        self.cells, inverse = np.unique(cells, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=self.cells.size).astype(np.int64)
+        self.level_sums = np.bincount(inverse, weights=level_sums, minlength=self.cells.size)
+        return self
+
+
+def _run_members(lats, lngs, levels, days, cell_size, frame_days, seeds):
+    """
+    Run a chunk of ensemble members
+
+    Returns:
+        Tuple (per-frame (cells, counts, level sums), per-member infected cell
+        counts of shape (members, frames))
+    """
+    base = InfectionGrid(lats, lngs, levels, days, cell_size=cell_size)
+    seeded = int(np.count_nonzero(base.offset > -np.inf))
+    frames = [SparseCounts() for _ in frame_days]
+    infected = np.zeros((len(seeds), len(frame_days)), dtype=np.int64)
+
+    for member, seed in enumerate(seeds):
+        grid = base.copy()
+        rng = np.random.default_rng(seed)
+        for day in range(1, days + 1):
+            grid.step(day, rng)
+
+        new_cells = np.concatenate(grid.new_cells) if grid.new_cells else np.empty(0, dtype=np.int64)
+        infection_days = np.repeat(np.arange(1, days + 1), [cells.size for cells in grid.new_cells])
+        for i, day in enumerate(frame_days):
+            # Cells are listed in order of infection, so a prefix is infected by `day`
+            count = int(np.searchsorted(infection_days, day, side='right'))
+            cells = new_cells[:count]
+            frames[i].add(cells, np.ones(count, dtype=np.int64), grid.levels(cells, day).astype(np.float64))
+            infected[member, i] = seeded + count
+
+    return [(frame.compact().cells, frame.counts, frame.level_sums) for frame in frames], infected
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    """Process pool of this worker, created on first use and after a fork"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # Forking a threaded server is unsafe; forkserver children start clean
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _drop_pool(pool):
+    """Forget a broken pool so the next _get_pool creates a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _run_chunks(workers, chunks, *args):
+    """
+    Run _run_members on every chunk of seeds in the process pool
+
+    A pool whose process died (killed by the OOM killer, for instance) is broken
+    for good, so it is replaced and the chunks are run once more.
+    """
+    for attempt in range(2):
+        pool = _get_pool(workers)
+        try:
+            futures = [pool.submit(_run_members, *args, chunk) for chunk in chunks]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            _drop_pool(pool)
+            if attempt:
+                raise
+            logger.warning("Ensemble process pool broke, retrying with a new pool")
+
+
+def _wilson(counts, members):
+    """Lower and upper bound of the 95% Wilson score interval of counts / members"""
+    p = counts / members
+    z2 = CONFIDENCE_Z ** 2
+    centre = (p + z2 / (2 * members)) / (1 + z2 / members)
+    half = CONFIDENCE_Z * np.sqrt(p * (1 - p) / members + z2 / (4 * members ** 2)) / (1 + z2 / members)
+    return np.clip(centre - half, 0, 1), np.clip(centre + half, 0, 1)
+
+
+def _band(values):
+    p05, p50, p95 = np.percentile(values, [5, 50, 95])
+    return {'mean': float(values.mean()), 'p05': float(p05), 'p50': float(p50), 'p95': float(p95)}
+
+
+@timed('predict_ensemble')
+def predict_ensemble(current_state, days, members, cell_size=DEFAULT_CELL_SIZE, seed=None,
+                     workers=None, max_new_points=MAX_NEW_POINTS, min_probability=MIN_PROBABILITY):
+    """
+    Predict the spread of Ganoderma infection as a Monte-Carlo ensemble
+
+    Args:
+        current_state: List of dictionaries with current infection data (lat, lng, level),
+            or InfectionPoints
+        days: Number of days to predict into the future
+        members: Number of realizations
+        cell_size: Grid resolution in degrees
+        seed: Seed of the ensemble; None draws a fresh one
+        workers: Processes to run members on; 0 runs them in this process and
+            None uses every core
+        max_new_points: Maximum number of predicted cells reported per timeframe
+        min_probability: Cells infected in a smaller fraction of members are not reported
+
+    Returns:
+        Dictionary shaped like predict_spread's result. Predicted points carry the
+        infection probability with its 95% confidence interval (lower, upper) and
+        the mean level of the members in which they are infected; every timeframe
+        carries the spread of the infected cell count across members.
+    """
+    days = max(0, int(days))
+    members = max(1, int(members))
+    frame_days = frame_days_for(days)
+    # The final state is simulated as an extra frame when it is not a timeframe
+    simulated_days = frame_days + ([days] if frame_days[-1] != days else [])
+
+    logger.info(f"Predicting spread for {days} days with {members} ensemble members "
+                f"based on {len(current_state)} infection points")
+
+    if not current_state:
+        return {
+            'initial_state': [],
+            'final_state': [],
+            'timeframes': [{'day': day, 'points': [], 'infected_cells': _band(np.zeros(1))} for day in frame_days],
+            'ensemble': {'members': members, 'seed': seed}
+        }
+
+    lats, lngs, levels = _to_arrays(current_state)
+    seeds = np.random.SeedSequence(seed).spawn(members)
+    workers = os.cpu_count() if workers is None else workers
+
+    if workers > 0 and members > 1:
+        # A few chunks per process keep every core busy when chunks finish unevenly
+        chunk_count = min(members, workers * 4)
+        bounds = np.linspace(0, members, chunk_count + 1).astype(int)
+        chunks = [seeds[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        results = _run_chunks(workers, chunks, lats, lngs, levels, days, cell_size, simulated_days)
+    else:
+        results = [_run_members(lats, lngs, levels, days, cell_size, simulated_days, seeds)]
+
+    # The grid is deterministic, so cell indices agree between chunks
+    grid = InfectionGrid(lats, lngs, levels, days, cell_size=cell_size)
+    infected = np.concatenate([chunk_infected for _, chunk_infected in results])
+
+    frames = []
+    for i, day in enumerate(simulated_days):
+        totals = SparseCounts()
+        for chunk_frames, _ in results:
+            totals.add(*chunk_frames[i])
+        totals.compact()
+
+        # Observed points are certain and grow along their own curves
+        observed_levels = _sigmoid(grid.growth_rate * day + grid.point_offsets)
+        points = [{
+            'lat': lat,
+            'lng': lng,
+            'level': level,
+            'probability': 1.0,
+            'lower': 1.0,
+            'upper': 1.0
+        } for lat, lng, level in zip(lats.tolist(), lngs.tolist(), observed_levels.tolist())]
+
+        probability = totals.counts / members
+        keep = np.flatnonzero(probability >= min_probability)
+        keep = keep[np.argsort(-probability[keep], kind='stable')][:max_new_points]
+        cells = totals.cells[keep]
+        cell_lats, cell_lngs = grid.cell_centers(cells)
+        mean_levels = totals.level_sums[keep] / totals.counts[keep]
+        lower, upper = _wilson(totals.counts[keep], members)
+        points.extend({
+            'lat': lat,
+            'lng': lng,
+            'level': level,
+            'probability': p,
+            'lower': lo,
+            'upper': hi
+        } for lat, lng, level, p, lo, hi in zip(
+            cell_lats.tolist(), cell_lngs.tolist(), mean_levels.tolist(),
+            probability[keep].tolist(), lower.tolist(), upper.tolist()
+        ))
+
+        frames.append({'day': day, 'points': points, 'infected_cells': _band(infected[:, i])})
+
+    return {
+        'initial_state': point_list(current_state),
+        'final_state': frames[-1]['points'],
+        'timeframes': frames[:len(frame_days)],
+        'ensemble': {
+            'members': members,
+            'seed': seed,
+            'cell_size': grid.cell_size,
+            'min_probability': min_probability
+        }
+    }
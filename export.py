@@ -0,0 +1,112 @@
+import struct
+from datetime import datetime
+
+import numpy as np
+
+from app import db
+
+# Streaming encoders for exporting infection points. Rows are read in batches with
+# yield_per (a server-side cursor on PostgreSQL) and each batch is encoded and sent
+# before the next one is fetched, so memory use does not grow with the row count.
+#
+# Columnar binary format (little-endian):
+#   header:  b'GNSD' magic, uint32 format version
+#   batches: uint32 row count n, uint32 padding, then the columns
+#            lat float64[n], lng float64[n], id int32[n], level float32[n],
+#            date int32[n] (days since 1970-01-01), zero-padded to a multiple
+#            of 8 bytes so every float64 column stays aligned for typed arrays.
+#   The stream ends with a batch of 0 rows.
+
+EXPORT_BATCH_SIZE = 5000
+
+COLUMNAR_MAGIC = b'GNSD'
+COLUMNAR_VERSION = 1
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'geojson': 'application/geo+json',
+    'columnar': 'application/octet-stream',
+}
+
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+
+def iter_batches(query, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Execute a query and yield its rows in batches
+
+    Args:
+        query: Select of (id, latitude, longitude, infection_level, date_recorded)
+        batch_size: Number of rows fetched per round trip
+
+    Yields:
+        Lists of row tuples
+    """
+    # Executed on the session's connection to skip ORM row processing
+    result = db.session.connection().execute(
+        query.execution_options(stream_results=True, yield_per=batch_size)
+    )
+    for partition in result.partitions():
+        yield partition
+
+
+def _date_json(date_recorded):
+    return f'"{date_recorded.isoformat()[:10]}"' if date_recorded else 'null'
+
+
+def ndjson_stream(batches):
+    """Encode row batches as newline-delimited JSON objects"""
+    for batch in batches:
+        yield ''.join(
+            f'{{"id":{row_id},"lat":{lat!r},"lng":{lng!r},"level":{level!r},'
+            f'"date":{_date_json(date_recorded)}}}\n'
+            for row_id, lat, lng, level, date_recorded in batch
+        )
+
+
+def geojson_stream(batches):
+    """Encode row batches as a single GeoJSON FeatureCollection"""
+    yield '{"type":"FeatureCollection","features":['
+    separator = ''
+    for batch in batches:
+        yield separator + ','.join(
+            f'{{"type":"Feature","id":{row_id},'
+            f'"geometry":{{"type":"Point","coordinates":[{lng!r},{lat!r}]}},'
+            f'"properties":{{"level":{level!r},"date":{_date_json(date_recorded)}}}}}'
+            for row_id, lat, lng, level, date_recorded in batch
+        )
+        separator = ','
+    yield ']}'
+
+
+def encode_columnar_batch(ids, lats, lngs, levels, days):
+    """Encode one batch of columns in the columnar binary format"""
+    count = len(ids)
+    body = b''.join([
+        np.asarray(lats, dtype='<f8').tobytes(),
+        np.asarray(lngs, dtype='<f8').tobytes(),
+        np.asarray(ids, dtype='<i4').tobytes(),
+        np.asarray(levels, dtype='<f4').tobytes(),
+        np.asarray(days, dtype='<i4').tobytes(),
+    ])
+    padding = b'\0' * (-len(body) % 8)
+    return struct.pack('<II', count, 0) + body + padding
+
+
+def columnar_stream(batches):
+    """Encode row batches in the columnar binary format"""
+    yield COLUMNAR_MAGIC + struct.pack('<I', COLUMNAR_VERSION)
+    for batch in batches:
+        if not batch:
+            continue
+        ids, lats, lngs, levels, dates = zip(*batch)
+        days = [date.toordinal() - _EPOCH_ORDINAL if date else -1 for date in dates]
+        yield encode_columnar_batch(ids, lats, lngs, levels, days)
+    yield struct.pack('<II', 0, 0)
+
+
+STREAM_ENCODERS = {
+    'ndjson': ndjson_stream,
+    'geojson': geojson_stream,
+    'columnar': columnar_stream,
+}
@@ -0,0 +1,291 @@
+import os
+import time
+import logging
+
+import numpy as np
+
+from raster import Raster, UnsupportedRaster, create_mask
+from previews import build_previews
+
+# Tiled inference over memory-mapped rasters. Overlapping windows are read from
+# the raster, stacked into fixed-size batches and run through the segmentation
+# model; the centre of each prediction (the overlap is discarded to avoid edge
+# artefacts) is written into a memory-mapped mask. Peak memory is therefore set
+# by the tile and batch size, not by the size of the image.
+
+logger = logging.getLogger(__name__)
+
+# Detections are reported per block of DETECTION_BLOCK x DETECTION_BLOCK pixels
+DETECTION_BLOCK = 32
+DETECTION_THRESHOLD = 0.5
+
+# Blocks with less valid (non-zero) data than this are ignored
+MIN_VALID_FRACTION = 0.5
+
+
+class StressIndexModel:
+    """
+    Placeholder segmentation model scoring vegetation stress from NDVI
+
+    Healthy palm canopy has a high NDVI; canopy stressed by basal stem rot has a
+    lower one, and bare soil lower still. The score rises from 0 at healthy_ndvi
+    to 1 at stressed_ndvi and is 0 for non-vegetation below soil_ndvi.
+    """
+
+    def __init__(self, healthy_ndvi=0.7, stressed_ndvi=0.3, soil_ndvi=0.15):
+        self.healthy_ndvi = healthy_ndvi
+        self.stressed_ndvi = stressed_ndvi
+        self.soil_ndvi = soil_ndvi
+
+    @classmethod
+    def load(cls, path):
+        """Load thresholds saved with np.savez (healthy_ndvi, stressed_ndvi, soil_ndvi)"""
+        with np.load(path) as weights:
+            return cls(**{name: float(weights[name]) for name in weights.files})
+
+    def predict(self, batch):
+        """
+        Args:
+            batch: float32 array of shape (n, bands, height, width), scaled to 0-1
+
+        Returns:
+            float32 array of shape (n, height, width) with infection probabilities
+        """
+        bands = batch.shape[1]
+        if bands >= 4:
+            # Multispectral order: blue, green, red, (red edge,) NIR
+            red, nir = batch[:, 2], batch[:, -1]
+        elif bands == 3:
+            # RGB only; green stands in for NIR
+            red, nir = batch[:, 0], batch[:, 1]
+        else:
+            return np.zeros((batch.shape[0],) + batch.shape[2:], dtype=np.float32)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ndvi = (nir - red) / (nir + red)
+        np.nan_to_num(ndvi, copy=False)
+        score = np.clip((self.healthy_ndvi - ndvi) / (self.healthy_ndvi - self.stressed_ndvi), 0, 1)
+        score[ndvi < self.soil_ndvi] = 0
+        return score.astype(np.float32, copy=False)
+
+
+def _scale(window, dtype):
+    """Convert raw samples to float32 in the 0-1 range"""
+    if dtype.kind in 'ui':
+        return window.astype(np.float32) / np.iinfo(dtype).max
+    return np.clip(window, 0, 1, dtype=np.float32)
+
+
+def iter_windows(height, width, step):
+    """Yield the (row, col) origin of every output tile in row-major order"""
+    for row in range(0, height, step):
+        for col in range(0, width, step):
+            yield row, col
+
+
+def _block_means(probabilities, valid):
+    """Mean probability and valid fraction of each detection block"""
+    height, width = probabilities.shape
+    blocks_down = -(-height // DETECTION_BLOCK)
+    blocks_across = -(-width // DETECTION_BLOCK)
+    shape = (blocks_down * DETECTION_BLOCK, blocks_across * DETECTION_BLOCK)
+
+    padded = np.zeros(shape, dtype=np.float32)
+    padded[:height, :width] = np.where(valid, probabilities, 0)
+    counts = np.zeros(shape, dtype=np.float32)
+    counts[:height, :width] = valid
+
+    blocks = (blocks_down, DETECTION_BLOCK, blocks_across, DETECTION_BLOCK)
+    sums = padded.reshape(blocks).sum(axis=(1, 3))
+    valid_counts = counts.reshape(blocks).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(valid_counts > 0, sums / valid_counts, 0)
+    return means, valid_counts / DETECTION_BLOCK ** 2
+
+
+def run_tiled_inference(raster, model, mask, tile_size=512, overlap=32, batch_size=8, progress=None):
+    """
+    Segment a raster tile by tile
+
+    Args:
+        raster: raster.Raster to read from
+        model: Object whose predict(batch) maps (n, bands, h, w) to (n, h, w)
+        mask: Writable (height, width) uint8 array receiving probabilities * 255
+        tile_size: Window size fed to the model, in pixels
+        overlap: Context pixels on each side of a window that are not stitched
+        batch_size: Windows per model call
+        progress: Optional callback receiving the completed fraction (0-1)
+
+    Returns:
+        Dictionary with the tile count, seconds, tiles_per_second and the
+        detections as pixel-space arrays rows, cols (block centres) and levels
+    """
+    # Output tiles are aligned to detection blocks so blocks never straddle tiles
+    step = (tile_size - 2 * overlap) // DETECTION_BLOCK * DETECTION_BLOCK
+    if step <= 0:
+        raise ValueError("tile_size must exceed 2 * overlap by at least one detection block")
+
+    total = len(range(0, raster.height, step)) * len(range(0, raster.width, step))
+    batch = np.zeros((batch_size, raster.bands, tile_size, tile_size), dtype=np.float32)
+    valid = np.zeros((batch_size, tile_size, tile_size), dtype=bool)
+    origins = []
+    rows, cols, levels = [], [], []
+    done = 0
+    started = time.perf_counter()
+
+    def flush():
+        nonlocal done
+        count = len(origins)
+        probabilities = model.predict(batch[:count])
+        for i, (row, col) in enumerate(origins):
+            height = min(step, raster.height - row)
+            width = min(step, raster.width - col)
+            centre = (slice(overlap, overlap + height), slice(overlap, overlap + width))
+            mask[row:row + height, col:col + width] = probabilities[i][centre] * 255
+
+            means, coverage = _block_means(probabilities[i][centre], valid[i][centre])
+            block_rows, block_cols = np.nonzero(
+                (means >= DETECTION_THRESHOLD) & (coverage >= MIN_VALID_FRACTION)
+            )
+            rows.append(row + np.minimum((block_rows + 0.5) * DETECTION_BLOCK, height))
+            cols.append(col + np.minimum((block_cols + 0.5) * DETECTION_BLOCK, width))
+            levels.append(means[block_rows, block_cols])
+
+        done += count
+        origins.clear()
+        if progress is not None:
+            progress(done / total)
+
+    for row, col in iter_windows(raster.height, raster.width, step):
+        window = raster.read(row - overlap, col - overlap, tile_size, tile_size)
+        slot = len(origins)
+        batch[slot] = _scale(window, raster.dtype)
+        valid[slot] = window.any(axis=0)
+        origins.append((row, col))
+        if len(origins) == batch_size:
+            flush()
+    if origins:
+        flush()
+
+    seconds = time.perf_counter() - started
+    return {
+        'tiles': total,
+        'seconds': seconds,
+        'tiles_per_second': total / seconds if seconds > 0 else 0.0,
+        'rows': np.concatenate(rows) if rows else np.empty(0),
+        'cols': np.concatenate(cols) if cols else np.empty(0),
+        'levels': np.concatenate(levels).astype(np.float64) if levels else np.empty(0)
+    }
+
+
+def detect_infections(image_path, model, tile_size=512, overlap=32, batch_size=8, progress=None,
+                      preview_folder=None):
+    """
+    Detect infections in an image without touching the database
+
+    Uncompressed GeoTIFFs are memory-mapped and segmented tile by tile, so their
+    size is not limited by available memory. Other formats fall back to
+    simulated detections until a decoder is available.
+
+    Args:
+        image_path: Path to the image
+        model: Segmentation model (see model_registry), only needed for GeoTIFFs
+        tile_size, overlap, batch_size: See run_tiled_inference
+        progress: Optional callback receiving the completed fraction (0-1)
+        preview_folder: Where to render the previews of the image and its mask
+            (see previews.py), or None to skip them
+
+    Returns:
+        Dictionary with the detections as arrays lats, lngs, levels and the
+        result_path of the processed image
+    """
+    def report(fraction):
+        if progress is not None:
+            progress(fraction)
+
+    try:
+        raster = Raster(image_path)
+    except UnsupportedRaster as e:
+        logger.info(f"{image_path} cannot be memory-mapped ({str(e)}), using simulated detections")
+        return _simulate_detections(image_path, report)
+
+    if model is None:
+        raise RuntimeError("No active segmentation model")
+
+    root, _ = os.path.splitext(image_path)
+    mask_path = f"{root}_mask.tif"
+    mask = create_mask(mask_path, raster.height, raster.width, raster.geo_tags)
+    stats = run_tiled_inference(raster, model, mask, tile_size=tile_size, overlap=overlap,
+                                batch_size=batch_size, progress=report)
+    mask.flush()
+    del mask
+    logger.info(f"Segmented {raster.width}x{raster.height} image {image_path}: "
+                f"{stats['tiles']} tiles in {stats['seconds']:.1f}s "
+                f"({stats['tiles_per_second']:.1f} tiles/sec)")
+
+    if preview_folder:
+        # Previews are a convenience; the detections stand without them
+        try:
+            build_previews(image_path, mask_path, preview_folder)
+        except Exception as e:
+            logger.warning(f"Could not render previews of {image_path}: {str(e)}")
+
+    if raster.transform is None:
+        logger.warning(f"{image_path} has no georeference, skipping {len(stats['levels'])} detections")
+        empty = np.empty(0)
+        return {'lats': empty, 'lngs': empty, 'levels': empty, 'result_path': mask_path}
+
+    lats, lngs = raster.transform.to_latlng(stats['rows'], stats['cols'])
+    return {'lats': lats, 'lngs': lngs, 'levels': stats['levels'], 'result_path': mask_path}
+
+
+def _simulate_detections(image_path, report):
+    """Random detections standing in for images that cannot be decoded yet"""
+    # In a real implementation, this would:
+    # 1. Load the image
+    # 2. Preprocess it for the model
+    # 3. Run it through the UNet model
+    # 4. Generate an annotated version
+
+    # Simulate model processing time
+    time.sleep(2)
+    report(0.7)
+
+    # A fresh generator per image, so forked pool processes don't repeat each other
+    rng = np.random.default_rng()
+
+    # Simulate finding 3-7 infection points
+    num_points = rng.integers(3, 8)
+
+    # Base coordinates (would be extracted from the image georeference data in production)
+    base_lat = rng.uniform(-3, 3)  # Random center in Indonesia region
+    base_lng = rng.uniform(100, 115)
+
+    # Points within ~2km of base point, with simulated infection levels (0-1)
+    return {
+        'lats': base_lat + (rng.random(num_points) - 0.5) * 0.04,
+        'lngs': base_lng + (rng.random(num_points) - 0.5) * 0.04,
+        'levels': rng.random(num_points),
+        # In a real implementation, this would be the path to the annotated image
+        'result_path': image_path
+    }
+
+
+# Progress queue of a detection pool process (see init_detection_worker)
+_progress_queue = None
+
+
+def init_detection_worker(progress_queue):
+    """Process pool initializer: report detection progress on a shared queue"""
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def detect_in_worker(key, image_path, model, tile_size, overlap, batch_size, preview_folder):
+    """detect_infections in a pool process, putting (key, fraction) progress on the pool's queue"""
+    def progress(fraction):
+        if _progress_queue is not None:
+            _progress_queue.put((key, fraction))
+
+    return detect_infections(image_path, model, tile_size=tile_size, overlap=overlap,
+                             batch_size=batch_size, progress=progress, preview_folder=preview_folder)
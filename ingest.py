@@ -0,0 +1,440 @@
+import io
+import csv
+import json
+import time
+import logging
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import insert, select
+
+from app import db
+from models import ImageData, InfectionData
+from rollups import add_to_rollups
+from clusters import add_to_clusters
+from spatial import grid_cells
+from versioning import mark_changed
+
+# Bulk insertion of infection points, bypassing the ORM unit of work. Rows are
+# written with Core executemany (COPY on PostgreSQL). The ORM listeners that keep
+# rollups, heatmap tiles and the dataset version in sync never see these rows, so
+# their bookkeeping is done here once per batch instead of once per row.
+#
+# Imports accept CSV (header row required), NDJSON and GeoJSON FeatureCollections,
+# including the NDJSON/GeoJSON produced by /api/infection_data/export. Records are
+# parsed and validated in batches of IMPORT_BATCH_SIZE and each batch is committed
+# in its own transaction, so a bad row never aborts the rest of the import.
+
+logger = logging.getLogger(__name__)
+
+IMPORT_FORMATS = ('csv', 'ndjson', 'geojson')
+
+# Rows per validated and committed batch
+IMPORT_BATCH_SIZE = 10000
+
+# Rows per executemany call within a batch
+INSERT_CHUNK_SIZE = 5000
+
+MAX_REPORTED_ERRORS = 20
+
+# Accepted field names, canonical name first
+FIELD_ALIASES = {
+    'latitude': ('latitude', 'lat'),
+    'longitude': ('longitude', 'lng', 'lon'),
+    'infection_level': ('infection_level', 'level'),
+    'date_recorded': ('date_recorded', 'date'),
+    'source_image_id': ('source_image_id', 'image_id'),
+}
+
+_COLUMNS = ('latitude', 'longitude', 'infection_level', 'date_recorded', 'source_image_id', 'grid_cell')
+
+
+def _rollup_totals(dates, image_ids, levels):
+    """Vectorized rollups.aggregate() over arrays of one batch"""
+    days = dates.astype('datetime64[D]').astype(np.int64)
+    keys = np.stack([days, image_ids])
+    unique, inverse = np.unique(keys, axis=1, return_inverse=True)
+    inverse = inverse.ravel()
+
+    counts = np.bincount(inverse)
+    sums = np.bincount(inverse, weights=levels)
+    maxima = np.full(len(counts), -np.inf)
+    np.maximum.at(maxima, inverse, levels)
+
+    epoch = datetime(1970, 1, 1).toordinal()
+    return {
+        (datetime.fromordinal(epoch + day).date(), image_id): [count, level_sum, level_max]
+        for day, image_id, count, level_sum, level_max in zip(
+            unique[0].tolist(), unique[1].tolist(), counts.tolist(), sums.tolist(), maxima.tolist()
+        )
+    }
+
+
+def _copy_rows(rows):
+    """Load rows with PostgreSQL COPY on the session's connection"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for lat, lng, level, date, image_id, cell in rows:
+        writer.writerow((repr(lat), repr(lng), repr(level), date.isoformat(),
+                         '' if image_id is None else image_id, cell))
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {InfectionData.__tablename__} ({', '.join(_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+    finally:
+        cursor.close()
+
+
+def insert_infections(lats, lngs, levels, source_image_id=None, dates=None):
+    """
+    Insert infection points in the session's transaction (the caller commits)
+
+    Args:
+        lats, lngs, levels: Sequences of equal length
+        source_image_id: Optional ImageData id shared by every point, or a
+            sequence of per-point ids (None for points without an image)
+        dates: Optional sequence of datetimes (defaults to now)
+
+    Returns:
+        Number of rows inserted
+    """
+    count = len(lats)
+    if count == 0:
+        return 0
+
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    cells = grid_cells(lats, lngs)
+    if dates is None:
+        dates = np.full(count, np.datetime64(datetime.utcnow(), 'us'))
+    else:
+        dates = np.asarray(dates, dtype='datetime64[us]')
+    if source_image_id is None or np.isscalar(source_image_id):
+        image_ids = [source_image_id] * count
+    else:
+        image_ids = list(source_image_id)
+
+    rows = list(zip(lats.tolist(), lngs.tolist(), levels.tolist(),
+                    dates.astype(object).tolist(), image_ids, cells.tolist()))
+
+    # Bumped first so concurrent loaders commit their ids in order
+    mark_changed(db.session)
+    if db.engine.dialect.name == 'postgresql':
+        _copy_rows(rows)
+    else:
+        # Executed on the session's connection to skip ORM statement handling
+        connection = db.session.connection()
+        table = InfectionData.__table__
+        for start in range(0, count, INSERT_CHUNK_SIZE):
+            connection.execute(insert(table), [
+                dict(zip(_COLUMNS, row)) for row in rows[start:start + INSERT_CHUNK_SIZE]
+            ])
+
+    rollup_ids = np.array([image_id or 0 for image_id in image_ids], dtype=np.int64)
+    add_to_rollups(db.session, _rollup_totals(dates, rollup_ids, levels))
+    add_to_clusters(db.session.connection(), lats, lngs, levels)
+
+    # The bounding box corners are enough for tile invalidation after commit
+    db.session.info.setdefault('tile_points', []).extend([
+        (float(lats.min()), float(lngs.min())),
+        (float(lats.max()), float(lngs.max()))
+    ])
+
+    logger.debug(f"Inserted {count} infection points")
+    return count
+
+
+def _canonical(fields):
+    """Map a dictionary with aliased keys to the canonical field names"""
+    record = {}
+    for name, aliases in FIELD_ALIASES.items():
+        for alias in aliases:
+            if fields.get(alias) is not None:
+                record[name] = fields[alias]
+                break
+    return record
+
+
+def iter_csv_records(text):
+    """Yield canonical records from CSV text with a header row"""
+    reader = csv.reader(text)
+    header = [name.strip().lower() for name in next(reader, [])]
+
+    # Resolve the aliases once from the header
+    columns = []
+    for name, aliases in FIELD_ALIASES.items():
+        index = next((header.index(alias) for alias in aliases if alias in header), None)
+        if index is not None:
+            columns.append((name, index))
+
+    for row in reader:
+        if row:
+            yield {name: row[index] for name, index in columns if index < len(row) and row[index] != ''}
+
+
+def iter_ndjson_records(text):
+    """Yield canonical records from newline-delimited JSON objects"""
+    for line in text:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            fields = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        yield _canonical(fields) if isinstance(fields, dict) else None
+
+
+def _geojson_record(feature):
+    if not isinstance(feature, dict):
+        return None
+    geometry = feature.get('geometry') or {}
+    coordinates = geometry.get('coordinates') if geometry.get('type') == 'Point' else None
+    record = _canonical(feature.get('properties') or {})
+    if isinstance(coordinates, list) and len(coordinates) >= 2:
+        record['longitude'], record['latitude'] = coordinates[:2]
+    return record
+
+
+def iter_geojson_records(text, read_size=1 << 16):
+    """
+    Yield canonical records from the Point features of a GeoJSON FeatureCollection
+
+    Features are decoded one at a time from a sliding buffer, so the collection is
+    never parsed (or held) as a whole.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = text.read(read_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    # Skip to the opening bracket of the features array
+    while True:
+        start = buffer.find('"features"')
+        bracket = buffer.find('[', start) if start >= 0 else -1
+        if bracket >= 0:
+            position = bracket + 1
+            break
+        if eof:
+            raise ValueError("GeoJSON has no features array")
+        # Keep a partially read key for the next search
+        position = start if start >= 0 else max(len(buffer) - len('"features"'), 0)
+        fill()
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError("GeoJSON ended inside the features array")
+            fill()
+            continue
+        if buffer[position] == ']':
+            return
+
+        try:
+            feature, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                raise ValueError("Malformed GeoJSON feature")
+            fill()
+            continue
+        position = end
+        yield _geojson_record(feature)
+
+
+RECORD_READERS = {
+    'csv': iter_csv_records,
+    'ndjson': iter_ndjson_records,
+    'geojson': iter_geojson_records,
+}
+
+
+def _floats(values):
+    """Convert raw values to float64, with NaN for missing or unparseable ones"""
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        result = np.full(len(values), np.nan)
+        for i, value in enumerate(values):
+            try:
+                result[i] = float(value)
+            except (TypeError, ValueError):
+                pass
+        return result
+
+
+def _dates(values):
+    """
+    Convert raw ISO 8601 values to datetime64
+
+    Returns:
+        Tuple (dates, bad) where missing dates are NaT and bad flags values that
+        are present but not ISO 8601 strings
+    """
+    raw = [None if value is None or value == '' else value for value in values]
+    bad = np.array([value is not None and not isinstance(value, str) for value in raw], dtype=bool)
+    strings = [value.strip().rstrip('Z') if isinstance(value, str) else 'NaT' for value in raw]
+    try:
+        return np.array(strings, dtype='datetime64[us]'), bad
+    except ValueError:
+        dates = np.full(len(strings), np.datetime64('NaT'), dtype='datetime64[us]')
+        for i, value in enumerate(strings):
+            try:
+                dates[i] = np.datetime64(value, 'us')
+            except ValueError:
+                bad[i] = True
+        return dates, bad
+
+
+def validate_batch(records):
+    """
+    Validate a batch of canonical records in bulk
+
+    Referenced source images are looked up with one query per batch.
+
+    Returns:
+        Tuple (columns, valid, reasons): columns is a dictionary of arrays,
+        valid a boolean mask and reasons a function giving the rejection reason
+        of a row
+    """
+    unreadable = np.array([record is None for record in records], dtype=bool)
+    records = [record or {} for record in records]
+
+    lats = _floats([record.get('latitude') for record in records])
+    lngs = _floats([record.get('longitude') for record in records])
+    levels = _floats([record.get('infection_level') for record in records])
+    dates, bad_dates = _dates([record.get('date_recorded') for record in records])
+    image_ids = _floats([record.get('source_image_id') for record in records])
+
+    with np.errstate(invalid='ignore'):
+        integral = ~np.isnan(image_ids) & (image_ids == np.round(image_ids))
+        # Ids outside the range of the integer key cannot exist
+        in_range = integral & (image_ids >= 1) & (image_ids <= 2 ** 31 - 1)
+    referenced = np.unique(image_ids[in_range]).astype(np.int64).tolist()
+    known = set(db.session.execute(
+        select(ImageData.id).where(ImageData.id.in_(referenced))
+    ).scalars()) if referenced else set()
+    unknown_images = integral & ~(in_range & np.isin(image_ids, list(known)))
+
+    with np.errstate(invalid='ignore'):
+        checks = [
+            (unreadable, "unreadable record"),
+            (~((lats >= -90) & (lats <= 90)), "latitude missing or outside -90..90"),
+            (~((lngs >= -180) & (lngs <= 180)), "longitude missing or outside -180..180"),
+            (~((levels >= 0) & (levels <= 1)), "infection_level missing or outside 0..1"),
+            (bad_dates, "date_recorded is not an ISO 8601 date"),
+            (~np.isnan(image_ids) & ~integral, "source_image_id is not an integer"),
+            (unknown_images, "source_image_id does not match an uploaded image"),
+        ]
+    invalid = np.zeros(len(records), dtype=bool)
+    for failed, _ in checks:
+        invalid |= failed
+
+    def reasons(i):
+        return next(reason for failed, reason in checks if failed[i])
+
+    columns = {'lats': lats, 'lngs': lngs, 'levels': levels, 'dates': dates, 'image_ids': image_ids}
+    return columns, ~invalid, reasons
+
+
+def _batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_infections(text, fmt, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Import infection points from a text stream, committing once per batch
+
+    Args:
+        text: Text file object
+        fmt: One of IMPORT_FORMATS
+        batch_size: Rows validated and committed together
+
+    Returns:
+        Dictionary with rows (inserted), rejected, batches, seconds,
+        rows_per_second, errors (row number and reason of the first
+        MAX_REPORTED_ERRORS rejected rows; row 1 is the first record) and
+        error (why the import stopped early, or None)
+    """
+    started = time.perf_counter()
+    inserted = rejected = batches = offset = 0
+    errors = []
+    now = np.datetime64(datetime.utcnow(), 'us')
+
+    error = None
+    try:
+        for batch in _batches(RECORD_READERS[fmt](text), batch_size):
+            columns, valid, reasons = validate_batch(batch)
+            for i in np.flatnonzero(~valid)[:MAX_REPORTED_ERRORS - len(errors)].tolist():
+                errors.append({'row': offset + i + 1, 'error': reasons(i)})
+
+            dates = columns['dates'][valid]
+            dates[np.isnat(dates)] = now
+            image_ids = [None if np.isnan(value) else int(value) for value in columns['image_ids'][valid].tolist()]
+
+            inserted += insert_infections(columns['lats'][valid], columns['lngs'][valid],
+                                          columns['levels'][valid], image_ids, dates)
+            db.session.commit()
+
+            rejected += int(len(batch) - valid.sum())
+            offset += len(batch)
+            batches += 1
+    except ValueError as e:
+        # Unreadable input (bad encoding, malformed GeoJSON); earlier batches stay committed
+        db.session.rollback()
+        error = str(e)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    seconds = time.perf_counter() - started
+    logger.info(f"Imported {inserted} infection points ({rejected} rejected) in {seconds:.2f}s")
+    return {
+        'rows': inserted,
+        'rejected': rejected,
+        'batches': batches,
+        'seconds': seconds,
+        'rows_per_second': inserted / seconds if seconds > 0 else 0.0,
+        'errors': errors,
+        'error': error
+    }
+
+
+def detect_format(filename=None, mimetype=None):
+    """Import format implied by a file name or MIME type, or None"""
+    if filename and '.' in filename:
+        extension = filename.rsplit('.', 1)[1].lower()
+        if extension in ('json', 'geojson'):
+            return 'geojson'
+        if extension in ('ndjson', 'jsonl'):
+            return 'ndjson'
+        if extension == 'csv':
+            return 'csv'
+    return {
+        'text/csv': 'csv',
+        'application/x-ndjson': 'ndjson',
+        'application/geo+json': 'geojson',
+        'application/json': 'geojson',
+    }.get(mimetype)
@@ -0,0 +1,422 @@
+import os
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import select, update, or_, and_
+
+from app import db
+from models import ImageData, ProcessingJob, UploadBatch
+from ml_models import process_image
+from inference import detect_infections, detect_in_worker, init_detection_worker
+from model_registry import get_registry
+from ingest import insert_infections
+
+# Image processing runs on a local pool of worker threads. The ProcessingJob table
+# is the queue: jobs are claimed with an atomic status update, so several gunicorn
+# workers (each with their own pool) can share it without an external broker.
+#
+# The jobs of a batch upload (UploadBatch) are run together by run_batch(): the
+# detections are spread over a process pool, so a survey is processed on every
+# core, and the infection points of all images are written in one transaction.
+# Batches with jobs left queued by a previous process are resumed as batches.
+#
+# A job whose process died while running it stays 'running'. Once its start is
+# longer than JOB_TIMEOUT ago it counts as abandoned: it is failed when jobs are
+# resumed, and retry_job() accepts it like a failed job. The app resumes jobs at
+# startup (see app.resume_jobs).
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Create the worker pool on first use so forked workers don't inherit threads"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        # A pool inherited through fork has no threads in this process
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config["JOB_WORKERS"],
+                thread_name_prefix="genosense-job"
+            )
+            _executor_pid = os.getpid()
+            _resume_pending_jobs()
+        return _executor
+
+
+def resume_jobs(app):
+    """Fail abandoned jobs and run the jobs and batches left queued by a previous process"""
+    with app.app_context():
+        if app.config["JOB_WORKERS"] > 0:
+            _get_executor()
+
+
+def _stale_conditions():
+    """Conditions matching running jobs started longer than JOB_TIMEOUT ago"""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config["JOB_TIMEOUT"])
+    return ProcessingJob.status == 'running', ProcessingJob.started_date < cutoff
+
+
+def fail_stale_jobs():
+    """
+    Fail running jobs abandoned by a process that stopped, and their batches
+
+    Returns:
+        Number of failed jobs
+    """
+    stale = _stale_conditions()
+    batch_ids = db.session.execute(
+        select(ProcessingJob.batch_id).distinct().where(*stale, ProcessingJob.batch_id.is_not(None))
+    ).scalars().all()
+    now = datetime.utcnow()
+    error = "Processing stopped without finishing (timed out)"
+    result = db.session.execute(
+        update(ProcessingJob).where(*stale).values(status='failed', error=error, finished_date=now)
+    )
+    if batch_ids:
+        db.session.execute(
+            update(UploadBatch)
+            .where(UploadBatch.id.in_(batch_ids), UploadBatch.status == 'running')
+            .values(status='failed', error=error, finished_date=now)
+        )
+    db.session.commit()
+    if result.rowcount:
+        logger.warning(f"Failed {result.rowcount} processing jobs that stopped without finishing")
+    return result.rowcount
+
+
+def _resume_pending_jobs():
+    """Submit jobs and batches left queued by a previous process"""
+    app = current_app._get_current_object()
+    fail_stale_jobs()
+    pending = db.session.query(ProcessingJob.id, ProcessingJob.batch_id).filter_by(status='queued').all()
+    for job_id, batch_id in pending:
+        if batch_id is None:
+            _executor.submit(run_job, job_id, app)
+    for batch_id in sorted({batch_id for _, batch_id in pending if batch_id is not None}):
+        _executor.submit(run_batch, batch_id, app)
+
+
+# Seconds between progress updates of a running batch
+BATCH_PROGRESS_INTERVAL = 0.5
+
+
+def _submit(job_id):
+    """Run a job on the worker pool, or inline when the pool is disabled"""
+    app = current_app._get_current_object()
+    if app.config["JOB_WORKERS"] > 0:
+        _get_executor().submit(run_job, job_id, app)
+    else:
+        run_job(job_id, app)
+
+
+def _claim(job_id):
+    """Atomically move a queued job to running; returns False if someone else got it"""
+    result = db.session.execute(
+        update(ProcessingJob)
+        .where(ProcessingJob.id == job_id, ProcessingJob.status == 'queued')
+        .values(status='running', progress=0.0, error=None,
+                attempts=ProcessingJob.attempts + 1, started_date=datetime.utcnow())
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def _set_progress(job_id, progress):
+    """Record job progress on its own connection, outside the job's transaction"""
+    with db.engine.begin() as connection:
+        connection.execute(
+            update(ProcessingJob)
+            .where(ProcessingJob.id == job_id)
+            .values(progress=progress)
+        )
+
+
+def enqueue_image(image):
+    """
+    Queue an uploaded image for processing
+
+    Args:
+        image: ImageData entry of the uploaded file
+
+    Returns:
+        The new ProcessingJob
+    """
+    job = ProcessingJob(image_id=image.id)
+    db.session.add(job)
+    db.session.commit()
+
+    logger.info(f"Queued processing job {job.id} for image {image.id}")
+    _submit(job.id)
+    return job
+
+
+def retry_job(job):
+    """
+    Re-queue a failed job, or a running one that timed out (see JOB_TIMEOUT)
+
+    Returns:
+        True if the job was re-queued, False if it is not failed or timed out
+    """
+    result = db.session.execute(
+        update(ProcessingJob)
+        .where(ProcessingJob.id == job.id, or_(ProcessingJob.status == 'failed', and_(*_stale_conditions())))
+        .values(status='queued', progress=0.0, finished_date=None)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        return False
+
+    logger.info(f"Retrying processing job {job.id} (attempt {job.attempts + 1})")
+    _submit(job.id)
+    return True
+
+
+def run_job(job_id, app):
+    """
+    Process the image of a queued job and record the outcome
+
+    Args:
+        job_id: Database ID of the ProcessingJob
+        app: Application to run the job in (pool threads have no app context)
+    """
+    with app.app_context():
+        if not _claim(job_id):
+            return
+
+        job = db.session.get(ProcessingJob, job_id)
+        image = db.session.get(ImageData, job.image_id)
+        image_path = os.path.join(app.config["UPLOAD_FOLDER"], image.filename)
+
+        try:
+            result_path = process_image(
+                image_path, image.id,
+                progress=lambda fraction: _set_progress(job_id, fraction)
+            )
+            if result_path is None:
+                raise RuntimeError("Image processing failed")
+        except Exception as e:
+            db.session.rollback()
+            job.status = 'failed'
+            job.error = str(e)
+            job.finished_date = datetime.utcnow()
+            db.session.commit()
+            logger.error(f"Processing job {job_id} failed: {str(e)}")
+            return
+
+        image.processed = True
+        image.result_path = result_path
+        job.status = 'done'
+        job.progress = 1.0
+        job.finished_date = datetime.utcnow()
+        db.session.commit()
+        logger.info(f"Processing job {job_id} finished for image {image.id}")
+
+
+def enqueue_batch(batch):
+    """Run the queued jobs of a committed UploadBatch on the worker pool, or inline when it is disabled"""
+    app = current_app._get_current_object()
+    logger.info(f"Queued upload batch {batch.id}")
+    if app.config["JOB_WORKERS"] > 0:
+        _get_executor().submit(run_batch, batch.id, app)
+    else:
+        run_batch(batch.id, app)
+
+
+def _detection_settings():
+    return {
+        'tile_size': current_app.config["INFERENCE_TILE_SIZE"],
+        'overlap': current_app.config["INFERENCE_TILE_OVERLAP"],
+        'batch_size': current_app.config["INFERENCE_BATCH_SIZE"],
+        'preview_folder': current_app.config["PREVIEW_FOLDER"]
+    }
+
+
+def _detect_all(paths, progress):
+    """
+    Detect infections in several images, on a process pool if configured
+
+    Args:
+        paths: Dictionary of image paths by job id
+        progress: Callback receiving (job id, detected fraction)
+
+    Returns:
+        Tuple (detections by job id, error messages by job id)
+    """
+    model = get_registry().get('segmentation')
+    settings = _detection_settings()
+    workers = min(current_app.config["BATCH_WORKERS"], len(paths))
+    results, errors = {}, {}
+
+    if workers == 0:
+        for job_id, path in paths.items():
+            try:
+                results[job_id] = detect_infections(path, model, progress=lambda f, job_id=job_id: progress(job_id, f),
+                                                    **settings)
+            except Exception as e:
+                errors[job_id] = str(e)
+        return results, errors
+
+    # Forking a threaded server is unsafe; forkserver children start clean
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    progress_queue = context.Queue()
+
+    def report_progress():
+        latest = {}
+        while True:
+            try:
+                job_id, fraction = progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            latest[job_id] = fraction
+        for job_id, fraction in latest.items():
+            progress(job_id, fraction)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_detection_worker, initargs=(progress_queue,)) as pool:
+        futures = {
+            pool.submit(detect_in_worker, job_id, path, model, settings['tile_size'],
+                        settings['overlap'], settings['batch_size'], settings['preview_folder']): job_id
+            for job_id, path in paths.items()
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=BATCH_PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+            report_progress()
+            for future in done:
+                job_id = futures[future]
+                try:
+                    results[job_id] = future.result()
+                except Exception as e:
+                    errors[job_id] = str(e)
+                    continue
+                progress(job_id, 1.0)
+    return results, errors
+
+
+def run_batch(batch_id, app):
+    """
+    Process the queued jobs of an upload batch and record the outcome
+
+    Detection covers the first 90% of each job's progress. The infection points
+    of every image, the processed images and the job outcomes are then committed
+    together.
+
+    Args:
+        batch_id: Database ID of the UploadBatch
+        app: Application to run the batch in (pool threads have no app context)
+    """
+    with app.app_context():
+        batch = db.session.get(UploadBatch, batch_id)
+        job_ids = db.session.execute(
+            select(ProcessingJob.id).where(ProcessingJob.batch_id == batch_id, ProcessingJob.status == 'queued')
+        ).scalars().all()
+        # Jobs another thread or process already took are left to it
+        job_ids = [job_id for job_id in job_ids if _claim(job_id)]
+        if not job_ids:
+            return
+
+        batch.status = 'running'
+        batch.started_date = datetime.utcnow()
+        db.session.commit()
+
+        jobs = {job_id: db.session.get(ProcessingJob, job_id) for job_id in job_ids}
+        images = {job_id: db.session.get(ImageData, job.image_id) for job_id, job in jobs.items()}
+        paths = {job_id: os.path.join(app.config["UPLOAD_FOLDER"], image.filename) for job_id, image in images.items()}
+
+        try:
+            results, errors = _detect_all(paths, lambda job_id, fraction: _set_progress(job_id, 0.9 * fraction))
+            finished = datetime.utcnow()
+
+            # Every image's points in one insert, each tagged with its image id
+            ordered = list(results)
+            counts = [len(results[job_id]['lats']) for job_id in ordered]
+            if ordered:
+                insert_infections(
+                    np.concatenate([results[job_id]['lats'] for job_id in ordered]),
+                    np.concatenate([results[job_id]['lngs'] for job_id in ordered]),
+                    np.concatenate([results[job_id]['levels'] for job_id in ordered]),
+                    source_image_id=np.repeat([images[job_id].id for job_id in ordered], counts).tolist()
+                )
+            for job_id in ordered:
+                images[job_id].processed = True
+                images[job_id].result_path = results[job_id]['result_path']
+                jobs[job_id].status = 'done'
+                jobs[job_id].progress = 1.0
+                jobs[job_id].finished_date = finished
+            for job_id, error in errors.items():
+                jobs[job_id].status = 'failed'
+                jobs[job_id].error = error
+                jobs[job_id].finished_date = finished
+            batch.status = 'failed' if errors and not results else 'done'
+            batch.finished_date = finished
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            finished = datetime.utcnow()
+            for job in jobs.values():
+                job.status = 'failed'
+                job.error = str(e)
+                job.finished_date = finished
+            batch.status = 'failed'
+            batch.error = str(e)
+            batch.finished_date = finished
+            db.session.commit()
+            logger.error(f"Upload batch {batch_id} failed: {str(e)}")
+            return
+
+        logger.info(f"Upload batch {batch_id} finished: {len(results)} images processed "
+                    f"({sum(counts)} infection points), {len(errors)} failed")
+
+
+def batch_to_dict(batch):
+    """Serialize an UploadBatch with the progress of each file for the API"""
+    rows = db.session.execute(
+        select(ProcessingJob, ImageData.original_filename)
+        .join(ImageData, ImageData.id == ProcessingJob.image_id)
+        .where(ProcessingJob.batch_id == batch.id)
+        .order_by(ProcessingJob.id)
+    ).all()
+    files = [dict(job_to_dict(job), filename=filename) for job, filename in rows]
+    statuses = [job.status for job, _ in rows]
+    return {
+        'id': batch.id,
+        'status': batch.status,
+        'error': batch.error,
+        'total': len(rows),
+        'queued': statuses.count('queued'),
+        'running': statuses.count('running'),
+        'done': statuses.count('done'),
+        'failed': statuses.count('failed'),
+        'progress': sum(job.progress for job, _ in rows) / len(rows) if rows else 1.0,
+        'created': batch.created_date.isoformat() if batch.created_date else None,
+        'started': batch.started_date.isoformat() if batch.started_date else None,
+        'finished': batch.finished_date.isoformat() if batch.finished_date else None,
+        'files': files
+    }
+
+
+def job_to_dict(job):
+    """Serialize a ProcessingJob for the API"""
+    return {
+        'id': job.id,
+        'image_id': job.image_id,
+        'batch_id': job.batch_id,
+        'status': job.status,
+        'progress': job.progress,
+        'attempts': job.attempts,
+        'error': job.error,
+        'created': job.created_date.isoformat() if job.created_date else None,
+        'started': job.started_date.isoformat() if job.started_date else None,
+        'finished': job.finished_date.isoformat() if job.finished_date else None
+    }
@@ -1,4 +1,11 @@
-from app import app
+from app import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
+    # The development server sets up the database itself; deployments run
+    # `python setup_db.py` before starting gunicorn
+    from schema import init_database
+    with app.app_context():
+        init_database()
     app.run(host="0.0.0.0", port=5000, debug=True)
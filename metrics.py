@@ -0,0 +1,322 @@
+import io
+import os
+import json
+import time
+import pstats
+import bisect
+import logging
+import cProfile
+import threading
+from functools import wraps
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-request instrumentation exposed in the Prometheus text format. Request hooks
+# time every route, SQLAlchemy cursor events count queries and database time, and
+# @timed records the time spent in expensive functions. When METRICS_ENABLED is
+# off no hook is installed and @timed costs one flag check per call.
+#
+# Each gunicorn worker keeps its own metrics. With METRICS_FOLDER set, workers
+# write snapshots there and /metrics merges them, so a scrape sees every worker.
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+# Minimum seconds between two snapshot writes of a worker
+SNAPSHOT_INTERVAL = 5
+
+# Statements and functions listed per slow request
+SLOW_LOG_STATEMENTS = 5
+SLOW_LOG_FUNCTIONS = 15
+
+_enabled = False
+_local = threading.local()
+
+
+class Histogram:
+    """Cumulative histogram with one series per label combination"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(key): [list(counts), total] for key, (counts, total) in self._series.items()}
+
+    @staticmethod
+    def merge(into, series):
+        counts, total = into.setdefault(series[0], [[0] * len(series[1][0]), 0.0])
+        for i, count in enumerate(series[1][0]):
+            counts[i] += count
+        into[series[0]][1] = total + series[1][1]
+
+    def render(self, merged):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for key, (counts, total) in sorted(merged.items()):
+            labels = _labels(self.labels, json.loads(key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class Counter:
+    """Monotonic counter with one series per label combination"""
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *label_values):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(key): value for key, value in self._series.items()}
+
+    @staticmethod
+    def merge(into, series):
+        into[series[0]] = into.get(series[0], 0) + series[1]
+
+    def render(self, merged):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        for key, value in sorted(merged.items()):
+            lines.append(f'{self.name}{{{_labels(self.labels, json.loads(key))}}} {value}')
+        return lines
+
+
+def _labels(names, values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+REQUEST_DURATION = Histogram(
+    'genosense_http_request_duration_seconds', 'Time to handle a request',
+    ('method', 'endpoint', 'status'), LATENCY_BUCKETS
+)
+RESPONSE_SIZE = Histogram(
+    'genosense_http_response_size_bytes', 'Size of response bodies (streamed responses excluded)',
+    ('endpoint',), SIZE_BUCKETS
+)
+REQUEST_QUERIES = Histogram(
+    'genosense_http_request_db_queries', 'SQL statements executed per request',
+    ('endpoint',), QUERY_BUCKETS
+)
+DB_QUERIES = Counter(
+    'genosense_db_queries_total', 'SQL statements executed', ('endpoint',)
+)
+DB_SECONDS = Counter(
+    'genosense_db_query_seconds_total', 'Time spent executing SQL statements', ('endpoint',)
+)
+FUNCTION_DURATION = Histogram(
+    'genosense_function_duration_seconds', 'Time spent in instrumented functions',
+    ('function',), LATENCY_BUCKETS
+)
+
+METRICS = (REQUEST_DURATION, RESPONSE_SIZE, REQUEST_QUERIES, DB_QUERIES, DB_SECONDS, FUNCTION_DURATION)
+
+
+class RequestStats:
+    """Timings collected while one request is handled"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.statements = {}
+        self.functions = {}
+        self.profiler = None
+
+
+def timed(name):
+    """Decorator recording the duration of a function in FUNCTION_DURATION"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                FUNCTION_DURATION.observe(elapsed, name)
+                stats = getattr(_local, 'request', None)
+                if stats is not None:
+                    stats.functions[name] = stats.functions.get(name, 0.0) + elapsed
+        return wrapper
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    stats = getattr(_local, 'request', None)
+    if stats is None:
+        DB_QUERIES.inc(1, '')
+        DB_SECONDS.inc(elapsed, '')
+        return
+    stats.queries += 1
+    stats.db_seconds += elapsed
+    count, total = stats.statements.get(statement, (0, 0.0))
+    stats.statements[statement] = (count + 1, total + elapsed)
+
+
+def _before_request():
+    stats = _local.request = RequestStats()
+    if _profile_slow:
+        stats.profiler = cProfile.Profile()
+        try:
+            stats.profiler.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            stats.profiler = None
+
+
+def _after_request(response):
+    stats = getattr(_local, 'request', None)
+    if stats is None:
+        return response
+    _local.request = None
+    if stats.profiler is not None:
+        stats.profiler.disable()
+
+    elapsed = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_DURATION.observe(elapsed, request.method, endpoint, str(response.status_code))
+    REQUEST_QUERIES.observe(stats.queries, endpoint)
+    DB_QUERIES.inc(stats.queries, endpoint)
+    DB_SECONDS.inc(stats.db_seconds, endpoint)
+    if not response.is_streamed:
+        RESPONSE_SIZE.observe(response.content_length or 0, endpoint)
+
+    if _slow_seconds and elapsed >= _slow_seconds:
+        _log_slow_request(stats, elapsed, response)
+    if _folder and time.monotonic() - _last_snapshot[0] > SNAPSHOT_INTERVAL:
+        write_snapshot()
+    return response
+
+
+def _log_slow_request(stats, elapsed, response):
+    lines = [
+        f"Slow request {request.method} {request.full_path.rstrip('?')} -> {response.status_code}: "
+        f"{elapsed * 1000:.0f}ms, {stats.queries} queries in {stats.db_seconds * 1000:.0f}ms"
+    ]
+    for name, seconds in sorted(stats.functions.items(), key=lambda item: -item[1]):
+        lines.append(f"  {name}: {seconds * 1000:.0f}ms")
+    statements = sorted(stats.statements.items(), key=lambda item: -item[1][1])[:SLOW_LOG_STATEMENTS]
+    for statement, (count, seconds) in statements:
+        lines.append(f"  {count}x {seconds * 1000:.1f}ms: {' '.join(statement.split())[:200]}")
+    if stats.profiler is not None:
+        output = io.StringIO()
+        pstats.Stats(stats.profiler, stream=output).sort_stats('cumulative').print_stats(SLOW_LOG_FUNCTIONS)
+        lines.append(output.getvalue())
+    logger.warning('\n'.join(lines))
+
+
+_slow_seconds = 0
+_profile_slow = False
+_folder = None
+_last_snapshot = [0.0]
+
+
+def init_app(app):
+    """Install the instrumentation hooks if METRICS_ENABLED is set"""
+    global _enabled, _slow_seconds, _profile_slow, _folder
+    _enabled = app.config["METRICS_ENABLED"]
+    if not _enabled:
+        return
+
+    _slow_seconds = app.config["SLOW_REQUEST_MS"] / 1000
+    _profile_slow = bool(_slow_seconds) and app.config["PROFILE_SLOW_REQUESTS"]
+    _folder = app.config["METRICS_FOLDER"]
+    if _folder:
+        os.makedirs(_folder, exist_ok=True)
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    # Engine listeners are global; a second app must not count queries twice
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def enabled():
+    return _enabled
+
+
+def _snapshot():
+    return {metric.name: metric.snapshot() for metric in METRICS}
+
+
+def write_snapshot():
+    """Write this worker's metrics to METRICS_FOLDER for the other workers to merge"""
+    _last_snapshot[0] = time.monotonic()
+    path = os.path.join(_folder, f'{os.getpid()}.json')
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(temp_path, path)
+
+
+def render_metrics():
+    """
+    All metrics in the Prometheus text exposition format
+
+    With METRICS_FOLDER set, the snapshots of every worker (including exited
+    ones, so counters never go backwards) are merged.
+    """
+    if _folder:
+        write_snapshot()
+        snapshots = []
+        for name in os.listdir(_folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(_folder, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    else:
+        snapshots = [_snapshot()]
+
+    lines = []
+    for metric in METRICS:
+        merged = {}
+        for snapshot in snapshots:
+            for series in snapshot.get(metric.name, {}).items():
+                metric.merge(merged, series)
+        lines.extend(metric.render(merged))
+    return '\n'.join(lines) + '\n'
@@ -1,74 +1,55 @@
-import os
-import numpy as np
 import logging
-from app import app, db
-from models import InfectionData, PredictionModel
+from flask import current_app
+from app import db
+from inference import detect_infections
+from model_registry import get_registry
+from ingest import insert_infections
+from metrics import timed
 
 # This file would contain the actual ML model implementations
 # For now, we'll include placeholder functions that simulate ML processing
 
 logger = logging.getLogger(__name__)
 
-def process_image(image_path, image_id):
+@timed('process_image')
+def process_image(image_path, image_id, progress=None):
     """
     Process an uploaded image using the UNet model to detect Ganoderma infections
     
+    Detection (see inference.detect_infections) covers the first 90% of progress,
+    storing the detected infection points the rest.
+    
     Args:
         image_path: Path to the uploaded image
         image_id: Database ID of the image entry
+        progress: Optional callback receiving the completed fraction (0-1)
     
     Returns:
         Path to the processed/annotated image
     """
     logger.info(f"Processing image: {image_path}")
     
+    def report(fraction):
+        if progress is not None:
+            progress(fraction)
+    
     try:
-        # In a real implementation, this would:
-        # 1. Load the image
-        # 2. Preprocess it for the model
-        # 3. Run it through the UNet model
-        # 4. Generate an annotated version
-        # 5. Save infection data to the database
-        
-        # For this implementation, we'll simulate finding infections
-        # and add some random data points
-        
-        # Simulate model processing time
-        import time
-        time.sleep(2)
-        
-        # Simulate finding 3-7 infection points
-        num_points = np.random.randint(3, 8)
-        
-        # Base coordinates (would be extracted from the image georeference data in production)
-        base_lat = np.random.uniform(-3, 3)  # Random center in Indonesia region
-        base_lng = np.random.uniform(100, 115)
-        
-        for i in range(num_points):
-            # Create points within ~2km of base point
-            lat_offset = (np.random.random() - 0.5) * 0.04
-            lng_offset = (np.random.random() - 0.5) * 0.04
-            
-            # Simulate infection level (0-1)
-            infection_level = np.random.random()
-            
-            # Add to database
-            new_infection = InfectionData(
-                latitude=base_lat + lat_offset,
-                longitude=base_lng + lng_offset,
-                infection_level=infection_level,
-                source_image_id=image_id
-            )
-            db.session.add(new_infection)
-        
+        detections = detect_infections(
+            image_path, get_registry().get('segmentation'),
+            tile_size=current_app.config["INFERENCE_TILE_SIZE"],
+            overlap=current_app.config["INFERENCE_TILE_OVERLAP"],
+            batch_size=current_app.config["INFERENCE_BATCH_SIZE"],
+            preview_folder=current_app.config["PREVIEW_FOLDER"],
+            progress=lambda fraction: report(0.9 * fraction)
+        )
+        insert_infections(detections['lats'], detections['lngs'], detections['levels'],
+                          source_image_id=image_id)
         db.session.commit()
-        logger.info(f"Added {num_points} simulated infection points from image {image_id}")
-        
-        # In a real implementation, this would be the path to the annotated image
-        result_path = image_path
-        return result_path
-        
+        report(0.95)
+        logger.info(f"Added {len(detections['lats'])} infection points from image {image_id}")
+        return detections['result_path']
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error processing image: {str(e)}")
         return None
 
@@ -77,28 +58,7 @@ def get_model_info():
     Return information about the available ML models
     
     Returns:
-        Dictionary with model information
+        List of dictionaries describing each model, with load time and memory
+        for the active models this worker has loaded
     """
-    # In production, this would query the database for model info
-    # For now, return static information about our simulated models
-    
-    models = [
-        {
-            "name": "UNet Multispectral",
-            "type": "UNet",
-            "description": "UNet architecture for segmentation of multispectral imagery",
-            "accuracy": 0.89,
-            "last_updated": "2023-05-15",
-            "active": True
-        },
-        {
-            "name": "ANN Classifier",
-            "type": "ANN",
-            "description": "Artificial Neural Network for classification of palm oil infections",
-            "accuracy": 0.92,
-            "last_updated": "2023-06-10",
-            "active": True
-        }
-    ]
-    
-    return models
+    return get_registry().info()
@@ -0,0 +1,247 @@
+import time
+import logging
+import threading
+import tracemalloc
+
+from flask import current_app
+from sqlalchemy import select
+
+from app import db
+from models import PredictionModel
+from inference import StressIndexModel
+from versioning import PREDICTION_MODELS, get_dataset_version
+
+# Process-wide registry of the models marked active in PredictionModel. Each model
+# is deserialized once per worker, on first use or up front when MODEL_PRELOAD is
+# set (with gunicorn --preload the master loads them and workers share the pages
+# after fork). Any write to PredictionModel bumps the 'prediction_models' dataset
+# version; the registry compares it on every lookup and swaps in the new set of
+# models without interrupting calls still running on the old ones.
+
+logger = logging.getLogger(__name__)
+
+# What each model type is used for
+MODEL_TASKS = {
+    'UNet': 'segmentation',
+    'ANN': 'segmentation',
+    'CA': 'spread',
+}
+
+# Models seeded into an empty PredictionModel table
+DEFAULT_MODELS = [
+    {
+        'name': "UNet Multispectral",
+        'model_type': "UNet",
+        'description': "UNet architecture for segmentation of multispectral imagery",
+        'accuracy': 0.89,
+        'active': True
+    },
+    {
+        'name': "ANN Classifier",
+        'model_type': "ANN",
+        'description': "Artificial Neural Network for classification of palm oil infections",
+        'accuracy': 0.92,
+        'active': True
+    },
+]
+
+
+def _load_segmentation_model(record):
+    return StressIndexModel.load(record.weights_path) if record.weights_path else StressIndexModel()
+
+
+# Loader per model type; types without one (the cellular automaton) have no weights
+MODEL_LOADERS = {
+    'UNet': _load_segmentation_model,
+    'ANN': _load_segmentation_model,
+}
+
+
+def _date_string(value):
+    return value.strftime('%Y-%m-%d') if value else None
+
+
+# Loads are serialized so the tracemalloc measurements don't overlap
+_load_lock = threading.Lock()
+
+
+class LoadedModel:
+    """An active PredictionModel row together with its deserialized model"""
+
+    def __init__(self, record):
+        self.id = record.id
+        self.name = record.name
+        self.model_type = record.model_type
+        self.description = record.description
+        self.accuracy = record.accuracy
+        self.weights_path = record.weights_path
+        self.updated_date = record.updated_date or record.created_date
+        self.model = None
+        self.load_seconds = None
+        self.memory_bytes = None
+        self.error = None
+
+    @property
+    def key(self):
+        """Changes whenever the row changes in a way that requires a reload"""
+        return (self.id, self.model_type, self.weights_path, self.updated_date)
+
+    @property
+    def task(self):
+        return MODEL_TASKS.get(self.model_type)
+
+    @property
+    def loadable(self):
+        return self.model_type in MODEL_LOADERS
+
+    def load(self):
+        """Deserialize the model if that has not happened yet; returns it or None"""
+        if self.model is not None or not self.loadable:
+            return self.model
+
+        with _load_lock:
+            if self.model is None and self.error is None:
+                # Memory is measured only while loading, so lookups stay free
+                tracing = tracemalloc.is_tracing()
+                if not tracing:
+                    tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+                started = time.perf_counter()
+                try:
+                    self.model = MODEL_LOADERS[self.model_type](self)
+                except Exception as e:
+                    self.error = str(e)
+                    logger.error(f"Failed to load model {self.name}: {str(e)}")
+                finally:
+                    self.load_seconds = time.perf_counter() - started
+                    self.memory_bytes = max(tracemalloc.get_traced_memory()[0] - before, 0)
+                    if not tracing:
+                        tracemalloc.stop()
+
+                if self.model is not None:
+                    logger.info(f"Loaded model {self.name} in {self.load_seconds:.2f}s "
+                                f"({self.memory_bytes / 1024 ** 2:.1f}MB)")
+        return self.model
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'type': self.model_type,
+            'description': self.description or '',
+            'accuracy': self.accuracy,
+            'last_updated': _date_string(self.updated_date),
+            'active': True,
+            'loaded': self.model is not None,
+            'load_seconds': self.load_seconds,
+            'memory_bytes': self.memory_bytes,
+            'error': self.error
+        }
+
+
+class ModelRegistry:
+    """
+    Active models of this worker, reloaded when PredictionModel changes
+
+    Args:
+        preload: Load every active model as soon as it is activated instead of
+            on first use
+    """
+
+    def __init__(self, preload=False):
+        self.preload = preload
+        self._models = []
+        self._version = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Re-read the active models if PredictionModel changed since the last check"""
+        version = get_dataset_version(PREDICTION_MODELS)
+        if version == self._version:
+            return
+
+        with self._lock:
+            if version == self._version:
+                return
+
+            records = db.session.execute(
+                select(PredictionModel)
+                .where(PredictionModel.active.is_(True))
+                .order_by(PredictionModel.accuracy.desc(), PredictionModel.id)
+            ).scalars().all()
+
+            # Keep already loaded models whose rows did not change
+            current = {model.key: model for model in self._models}
+            models = []
+            for record in records:
+                candidate = LoadedModel(record)
+                models.append(current.get(candidate.key, candidate))
+
+            dropped = [model.name for model in self._models if model not in models]
+            self._models = models
+            self._version = version
+            if dropped:
+                logger.info(f"Unloaded models: {', '.join(dropped)}")
+
+        if self.preload:
+            for model in models:
+                model.load()
+
+    def models(self):
+        """Every active model, loaded or not"""
+        self.refresh()
+        return list(self._models)
+
+    def info(self):
+        """Description of every model, active ones with their load statistics"""
+        inactive = db.session.execute(
+            select(PredictionModel)
+            .where(PredictionModel.active.isnot(True))
+            .order_by(PredictionModel.id)
+        ).scalars().all()
+        return [model.to_dict() for model in self.models()] + [{
+            'id': record.id,
+            'name': record.name,
+            'type': record.model_type,
+            'description': record.description or '',
+            'accuracy': record.accuracy,
+            'last_updated': _date_string(record.updated_date or record.created_date),
+            'active': False,
+            'loaded': False
+        } for record in inactive]
+
+    def get(self, task):
+        """
+        The most accurate active model for a task, loading it on first use
+
+        Args:
+            task: 'segmentation' or 'spread'
+
+        Returns:
+            The deserialized model, or None if no active model can serve the task
+        """
+        for model in self.models():
+            if model.task == task and model.load() is not None:
+                return model.model
+        return None
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """The process-wide model registry"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry(preload=current_app.config["MODEL_PRELOAD"])
+        return _registry
+
+
+def ensure_default_models():
+    """Seed PredictionModel with the default models if it is empty"""
+    if PredictionModel.query.first() is None:
+        db.session.add_all([PredictionModel(**fields) for fields in DEFAULT_MODELS])
+        db.session.commit()
+        logger.info(f"Added {len(DEFAULT_MODELS)} default prediction models")
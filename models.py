@@ -1,27 +1,84 @@
 from datetime import datetime
+from sqlalchemy.orm import validates
 from app import db
+from spatial import grid_cell
+
+def _default_grid_cell(context):
+    """Column default deriving the spatial grid cell from the inserted coordinates"""
+    params = context.get_current_parameters()
+    return grid_cell(params['latitude'], params['longitude'])
 
 class ImageData(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)  # Stored name, <content_hash>.<ext> (see uploads.py)
+    original_filename = db.Column(db.String(255), nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)  # SHA-256 of the file
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     processed = db.Column(db.Boolean, default=False)
     result_path = db.Column(db.String(255), nullable=True)
     
+    __table_args__ = (
+        db.Index('ix_image_data_content_hash', 'content_hash', unique=True),
+    )
+    
     def __repr__(self):
-        return f'<ImageData {self.filename}>'
+        return f'<ImageData {self.original_filename or self.filename}>'
 
 class InfectionData(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    latitude = db.Column(db.Float, nullable=False)
-    longitude = db.Column(db.Float, nullable=False)
+    # Old coordinates are loaded before a change so tiles.py can invalidate where a point was
+    latitude = db.column_property(db.Column(db.Float, nullable=False), active_history=True)
+    longitude = db.column_property(db.Column(db.Float, nullable=False), active_history=True)
     infection_level = db.Column(db.Float, nullable=False)  # 0-1 value indicating severity
-    date_recorded = db.Column(db.DateTime, default=datetime.utcnow)
-    source_image_id = db.Column(db.Integer, db.ForeignKey('image_data.id'), nullable=True)
+    # Old values are loaded before a change so rollups.py can recompute the day a row left
+    date_recorded = db.column_property(db.Column(db.DateTime, default=datetime.utcnow), active_history=True)
+    source_image_id = db.column_property(db.Column(db.Integer, db.ForeignKey('image_data.id'), nullable=True),
+                                         active_history=True)
+    grid_cell = db.Column(db.Integer, nullable=True, default=_default_grid_cell)  # See spatial.py
+    
+    __table_args__ = (
+        db.Index('ix_infection_data_grid_cell', 'grid_cell'),
+        # Covers the map query so viewport reads never touch the table itself
+        db.Index('ix_infection_data_lat_lng', 'latitude', 'longitude', 'grid_cell',
+                 'infection_level', 'date_recorded'),
+        db.Index('ix_infection_data_date_recorded', 'date_recorded'),
+    )
+    
+    @validates('latitude', 'longitude')
+    def _update_grid_cell(self, key, value):
+        """Keep grid_cell in step with points moved through the ORM"""
+        lat = value if key == 'latitude' else self.latitude
+        lng = value if key == 'longitude' else self.longitude
+        if lat is not None and lng is not None:
+            self.grid_cell = grid_cell(lat, lng)
+        return value
     
     def __repr__(self):
         return f'<InfectionData lat:{self.latitude}, lng:{self.longitude}, level:{self.infection_level}>'
 
+class InfectionArchive(db.Model):
+    # InfectionData rows moved out of the hot table by archive.compact(), with their ids.
+    # Range partitioned by month on PostgreSQL, so the partition key is part of the key.
+    __tablename__ = 'infection_data_archive'
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    date_recorded = db.Column(db.DateTime, primary_key=True)
+    # Old coordinates are loaded before a change so tiles.py can invalidate where a point was
+    latitude = db.column_property(db.Column(db.Float, nullable=False), active_history=True)
+    longitude = db.column_property(db.Column(db.Float, nullable=False), active_history=True)
+    infection_level = db.Column(db.Float, nullable=False)
+    source_image_id = db.Column(db.Integer, nullable=True)
+    grid_cell = db.Column(db.Integer, nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_infection_data_archive_date_recorded', 'date_recorded'),
+        db.Index('ix_infection_data_archive_grid_cell', 'grid_cell'),
+        {'postgresql_partition_by': 'RANGE (date_recorded)'},
+    )
+    
+    def __repr__(self):
+        return f'<InfectionArchive {self.id} {self.date_recorded:%Y-%m-%d}>'
+
 class PredictionModel(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -29,6 +86,81 @@ class PredictionModel(db.Model):
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
     accuracy = db.Column(db.Float, nullable=True)
     active = db.Column(db.Boolean, default=False)
+    description = db.Column(db.Text, nullable=True)
+    weights_path = db.Column(db.String(255), nullable=True)  # Serialized weights, if the model type uses any
+    updated_date = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
         return f'<PredictionModel {self.name} ({self.model_type})>'
+
+class UploadBatch(db.Model):
+    # Files uploaded together and processed on a process pool (see uploads.register_batch and jobs.run_batch)
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    error = db.Column(db.Text, nullable=True)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    started_date = db.Column(db.DateTime, nullable=True)
+    finished_date = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<UploadBatch {self.id} ({self.status})>'
+
+class ProcessingJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.Integer, db.ForeignKey('image_data.id'), nullable=False)
+    batch_id = db.Column(db.Integer, db.ForeignKey('upload_batch.id'), nullable=True, index=True)  # Set for batch uploads
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, done, failed
+    progress = db.Column(db.Float, nullable=False, default=0.0)  # 0-1 value
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    started_date = db.Column(db.DateTime, nullable=True)
+    finished_date = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<ProcessingJob {self.id} image:{self.image_id} ({self.status})>'
+
+class InfectionRollup(db.Model):
+    # Daily aggregates of InfectionData, maintained incrementally by rollups.py
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    image_id = db.Column(db.Integer, nullable=False, default=0)  # source_image_id, 0 when not from an image
+    count = db.Column(db.Integer, nullable=False, default=0)
+    level_sum = db.Column(db.Float, nullable=False, default=0.0)
+    level_max = db.Column(db.Float, nullable=False, default=0.0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('day', 'image_id', name='uq_infection_rollup_day_image'),
+    )
+    
+    def __repr__(self):
+        return f'<InfectionRollup {self.day} image:{self.image_id} count:{self.count}>'
+
+class InfectionCluster(db.Model):
+    # Per-zoom web mercator cells of InfectionData, maintained incrementally by clusters.py
+    id = db.Column(db.Integer, primary_key=True)
+    zoom = db.Column(db.SmallInteger, nullable=False)
+    x = db.Column(db.Integer, nullable=False)
+    y = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    lat_sum = db.Column(db.Float, nullable=False, default=0.0)
+    lng_sum = db.Column(db.Float, nullable=False, default=0.0)
+    level_sum = db.Column(db.Float, nullable=False, default=0.0)
+    level_max = db.Column(db.Float, nullable=False, default=0.0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('zoom', 'y', 'x', name='uq_infection_cluster_cell'),
+    )
+    
+    def __repr__(self):
+        return f'<InfectionCluster z{self.zoom} {self.x},{self.y} count:{self.count}>'
+
+class DatasetVersion(db.Model):
+    # Counter bumped by every write to a dataset, used to key caches (see versioning.py)
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    rewritten_version = db.Column(db.Integer, nullable=True, default=0)  # Last version that updated or deleted rows
+    updated_date = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DatasetVersion {self.name} v{self.version}>'
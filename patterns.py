@@ -0,0 +1,290 @@
+import math
+import logging
+
+import numpy as np
+
+from metrics import timed
+
+# Spatial pattern statistics of a set of infection points, for /api/pattern_analysis.
+# Everything is computed on a regular grid over the analysis extent so the cost
+# grows with the number of points only through the binning:
+#
+# - Kernel density: point counts per cell convolved with a Gaussian kernel.
+# - Getis-Ord Gi*: per-cell z-scores of the infection level sums within a fixed
+#   distance band, flagging cells that sit in significantly high (hot) or low
+#   (cold) neighbourhoods.
+# - Clark-Evans nearest-neighbour ratio: mean nearest-neighbour distance of a
+#   random sample of points (found through a bucket grid) against the distance
+#   expected for a random pattern of the same density.
+#
+# Convolutions are done with FFTs, and distances use a local equirectangular
+# projection around the extent's centre, which is accurate to well under a
+# percent at plantation scale.
+
+logger = logging.getLogger(__name__)
+
+# Cells along the longer side of the analysis grid
+GRID_SIZE = 128
+
+# Points sampled for the nearest-neighbour statistics, and searched at a time
+NN_SAMPLE_SIZE = 2000
+NN_CHUNK_SIZE = 250
+
+# Upper bound on the significant Gi* cells listed in a result
+MAX_HOTSPOTS = 500
+
+# Number of density peaks listed in a result
+DENSITY_PEAKS = 10
+
+# Two-sided z thresholds of the reported confidence levels, strictest first
+CONFIDENCE_LEVELS = ((2.576, 99), (1.960, 95), (1.645, 90))
+
+# Clark-Evans standard error constant for a random pattern
+_NN_SE_CONSTANT = 0.26136
+
+_KM_PER_DEGREE_LAT = 110.574
+_KM_PER_DEGREE_LNG = 111.320
+
+
+def _convolve(image, kernel):
+    """Convolution of an image with a symmetric odd-sized kernel, same-size output"""
+    ky, kx = kernel.shape
+    shape = (image.shape[0] + ky - 1, image.shape[1] + kx - 1)
+    full = np.fft.irfft2(np.fft.rfft2(image, shape) * np.fft.rfft2(kernel, shape), shape)
+    return full[ky // 2:ky // 2 + image.shape[0], kx // 2:kx // 2 + image.shape[1]]
+
+
+def _kernel_offsets(radius_cells, cell_km):
+    """Distances in km of a (2r+1) x (2r+1) window of cells from its centre"""
+    r = np.arange(-radius_cells, radius_cells + 1) * cell_km
+    return np.hypot(*np.meshgrid(r, r))
+
+
+def _local_maxima(grid):
+    """Mask of cells not smaller than any of their 8 neighbours"""
+    padded = np.pad(grid, 1, constant_values=-np.inf)
+    rows, cols = grid.shape
+    neighbours = [
+        padded[1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols]
+        for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx
+    ]
+    return grid >= np.max(neighbours, axis=0)
+
+
+def nearest_neighbour_distances(x, y, sample, cell):
+    """
+    Distance from sampled points to their nearest other point
+
+    Points are bucketed into square cells; a sample point's neighbours are searched
+    in growing rings of cells until the nearest one found lies within the ring,
+    which guarantees no closer point is outside it.
+
+    Args:
+        x, y: Projected coordinates of all points (km)
+        sample: Indices of the points to measure from
+        cell: Bucket size (km), a fraction of the expected nearest-neighbour distance
+
+    Returns:
+        Array of distances, one per sample point
+    """
+    cx = ((x - x.min()) / cell).astype(np.int64)
+    cy = ((y - y.min()) / cell).astype(np.int64)
+    cols = int(cx.max()) + 1
+    rows = int(cy.max()) + 1
+    keys = cy * cols + cx
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    def nearest_in_ring(points, ring):
+        """Nearest other point of each point among the (2r+1)² cells around it"""
+        px, py = cx[points], cy[points]
+        first_col = np.maximum(px - ring, 0)
+        last_col = np.minimum(px + ring, cols - 1)
+
+        # One contiguous key range per row of the ring
+        starts, ends, owners = [], [], []
+        for dy in range(-ring, ring + 1):
+            row = py + dy
+            valid = (row >= 0) & (row < rows)
+            starts.append(np.where(valid, np.searchsorted(sorted_keys, row * cols + first_col, 'left'), 0))
+            ends.append(np.where(valid, np.searchsorted(sorted_keys, row * cols + last_col, 'right'), 0))
+            owners.append(np.arange(points.size))
+        starts, ends, owners = np.concatenate(starts), np.concatenate(ends), np.concatenate(owners)
+
+        nearest = np.full(points.size, np.inf)
+        lengths = ends - starts
+        total = int(lengths.sum())
+        if total:
+            # Flat positions of every candidate, with the point each belongs to
+            owner = np.repeat(owners, lengths)
+            offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            candidates = order[np.repeat(starts, lengths) + offsets]
+            distances = np.hypot(x[candidates] - x[points[owner]], y[candidates] - y[points[owner]])
+            distances[candidates == points[owner]] = np.inf
+            np.minimum.at(nearest, owner, distances)
+        return nearest
+
+    best = np.full(sample.size, np.inf)
+    pending = np.arange(sample.size)
+    ring = 1
+    while pending.size:
+        # Chunks bound the candidate arrays where points are dense
+        for chunk in np.array_split(pending, math.ceil(pending.size / NN_CHUNK_SIZE)):
+            best[chunk] = nearest_in_ring(sample[chunk], ring)
+
+        # Found within the ring (or the ring already covers every point)
+        resolved = (best[pending] <= ring * cell) | (ring >= max(rows, cols))
+        pending = pending[~resolved]
+        ring *= 2
+
+    return best
+
+
+@timed('pattern_analysis')
+def analyze_patterns(lats, lngs, levels, bbox=None, bandwidth_km=None, seed=0):
+    """
+    Kernel density, Getis-Ord Gi* hotspots and nearest-neighbour statistics
+
+    Args:
+        lats, lngs, levels: Arrays of equal length
+        bbox: Analysis extent (west, south, east, north); None for the extent of the points
+        bandwidth_km: Kernel bandwidth, also the Gi* distance band; None picks one
+            with Scott's rule
+        seed: Seed of the nearest-neighbour sample, so results are repeatable
+
+    Returns:
+        Dictionary with count, center, extent, density, hotspots and nearest_neighbour
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    levels = np.asarray(levels, dtype=np.float64)
+    n = lats.size
+    if n == 0:
+        return {'count': 0, 'center': None, 'extent': None, 'density': None,
+                'hotspots': [], 'hotspot_counts': None, 'nearest_neighbour': None}
+
+    if bbox is None:
+        west, south, east, north = lngs.min(), lats.min(), lngs.max(), lats.max()
+    else:
+        west, south, east, north = bbox
+
+    # Local projection to km around the extent's centre
+    lat0 = (south + north) / 2
+    km_lng = _KM_PER_DEGREE_LNG * math.cos(math.radians(lat0))
+    x = (lngs - west) * km_lng
+    y = (lats - south) * _KM_PER_DEGREE_LAT
+    width = max((east - west) * km_lng, 1e-3)
+    height = max((north - south) * _KM_PER_DEGREE_LAT, 1e-3)
+    area = width * height
+
+    cell_km = max(width, height) / GRID_SIZE
+    cols = max(1, math.ceil(width / cell_km))
+    rows = max(1, math.ceil(height / cell_km))
+
+    # Grid binning; points on the far edges fall in the last cell
+    col = np.clip((x / cell_km).astype(np.int64), 0, cols - 1)
+    row = np.clip((y / cell_km).astype(np.int64), 0, rows - 1)
+    cell = row * cols + col
+    counts = np.bincount(cell, minlength=rows * cols).reshape(rows, cols).astype(np.float64)
+    level_sums = np.bincount(cell, weights=levels, minlength=rows * cols).reshape(rows, cols)
+
+    if bandwidth_km is None:
+        # Scott's rule for two dimensions
+        spread = math.sqrt((np.var(x) + np.var(y)) / 2) or cell_km
+        bandwidth_km = spread * n ** (-1 / 6)
+    bandwidth_km = max(float(bandwidth_km), cell_km)
+
+    # Kernel density in points per km²
+    radius = min(max(1, math.ceil(3 * bandwidth_km / cell_km)), max(rows, cols))
+    offsets = _kernel_offsets(radius, cell_km)
+    gaussian = np.exp(-0.5 * (offsets / bandwidth_km) ** 2) / (2 * math.pi * bandwidth_km ** 2)
+    density = np.maximum(_convolve(counts, gaussian), 0)
+
+    cell_lngs = west + (np.arange(cols) + 0.5) * cell_km / km_lng
+    cell_lats = south + (np.arange(rows) + 0.5) * cell_km / _KM_PER_DEGREE_LAT
+
+    peak_cells = np.flatnonzero(_local_maxima(density) & (counts > 0))
+    peak_cells = peak_cells[np.argsort(density.ravel()[peak_cells])[::-1][:DENSITY_PEAKS]]
+    peaks = [{
+        'lat': float(cell_lats[c // cols]),
+        'lng': float(cell_lngs[c % cols]),
+        'density': float(density.ravel()[c])
+    } for c in peak_cells.tolist()]
+
+    # Getis-Ord Gi* over the level sums with a binary distance band; the band
+    # includes the cell itself, and edge cells have fewer neighbours
+    band = (_kernel_offsets(radius, cell_km) <= bandwidth_km).astype(np.float64)
+    cell_count = rows * cols
+    mean = level_sums.mean()
+    std = math.sqrt(max((level_sums ** 2).mean() - mean ** 2, 0))
+    neighbour_sums = _convolve(level_sums, band)
+    weights = np.rint(_convolve(np.ones((rows, cols)), band))
+    denominator = std * np.sqrt(np.maximum(cell_count * weights - weights ** 2, 0) / max(cell_count - 1, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gi = np.where(denominator > 0, (neighbour_sums - mean * weights) / denominator, 0.0)
+
+    significant = np.flatnonzero(np.abs(gi.ravel()) >= CONFIDENCE_LEVELS[-1][0])
+    significant = significant[np.argsort(np.abs(gi.ravel()[significant]))[::-1]]
+    hotspot_counts = {'hot': {}, 'cold': {}}
+    for threshold, confidence in CONFIDENCE_LEVELS:
+        hotspot_counts['hot'][confidence] = int(np.count_nonzero(gi >= threshold))
+        hotspot_counts['cold'][confidence] = int(np.count_nonzero(gi <= -threshold))
+
+    def confidence_of(z):
+        return next(confidence for threshold, confidence in CONFIDENCE_LEVELS if abs(z) >= threshold)
+
+    hotspots = [{
+        'lat': float(cell_lats[c // cols]),
+        'lng': float(cell_lngs[c % cols]),
+        'z': float(z),
+        'type': 'hot' if z > 0 else 'cold',
+        'confidence': confidence_of(z),
+        'count': int(counts.ravel()[c])
+    } for c, z in zip(significant[:MAX_HOTSPOTS].tolist(), gi.ravel()[significant[:MAX_HOTSPOTS]].tolist())]
+
+    # Clark-Evans nearest-neighbour ratio from a sample of the points
+    nearest_neighbour = None
+    if n > 1:
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(n, NN_SAMPLE_SIZE, replace=False) if n > NN_SAMPLE_SIZE else np.arange(n)
+        expected = 0.5 / math.sqrt(n / area)
+        # Buckets finer than the expected distance keep dense clusters cheap to search
+        distances = nearest_neighbour_distances(x, y, sample, max(expected / 4, 1e-6))
+        observed = float(distances.mean())
+        standard_error = _NN_SE_CONSTANT / math.sqrt(sample.size * n / area)
+        z = (observed - expected) / standard_error
+        nearest_neighbour = {
+            'mean_km': observed,
+            'expected_km': expected,
+            'ratio': observed / expected,
+            'z': z,
+            'pattern': 'clustered' if z <= -1.96 else 'dispersed' if z >= 1.96 else 'random',
+            'sample': int(sample.size)
+        }
+
+    weight = levels.sum()
+    center = {
+        'lat': float((lats * levels).sum() / weight) if weight > 0 else float(lats.mean()),
+        'lng': float((lngs * levels).sum() / weight) if weight > 0 else float(lngs.mean())
+    }
+
+    return {
+        'count': int(n),
+        'center': center,
+        'extent': {
+            'bbox': [float(west), float(south), float(east), float(north)],
+            'area_km2': area,
+            'rows': rows,
+            'cols': cols,
+            'cell_km': cell_km
+        },
+        'density': {
+            'bandwidth_km': bandwidth_km,
+            'max': float(density.max()),
+            'mean': float(n / area),
+            'peaks': peaks
+        },
+        'hotspots': hotspots,
+        'hotspot_counts': hotspot_counts,
+        'nearest_neighbour': nearest_neighbour
+    }
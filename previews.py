@@ -0,0 +1,250 @@
+import os
+import json
+import math
+import time
+import shutil
+import logging
+
+import numpy as np
+
+from raster import Raster, UnsupportedRaster
+from tiles import encode_png, PALETTE_LEVELS, PALETTE_COLORS, MAX_ALPHA
+
+# Browser-friendly previews of uploaded rasters. Multispectral TIFFs and result
+# masks cannot be shown by a browser and are often hundreds of MB, so the
+# processing pipeline renders each of them once into a thumbnail and a pyramid of
+# PREVIEW_TILE_SIZE PNG tiles (zoom 0 holds the whole image in one tile, each
+# further level doubles the resolution up to full resolution).
+#
+# The pyramid is built depth first: full resolution tiles are read from the
+# memory-mapped raster and every lower level is downsampled from the four tiles
+# below it, so memory stays at a few tiles per level whatever the image size.
+#
+# Every build goes to a new <folder>/<name>/<kind>-<version>/ directory and the
+# manifest <folder>/<name>/<kind>.json is switched to it afterwards. Tile URLs
+# therefore never change content and can be cached as immutable; a rebuilt mask
+# simply gets new URLs.
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_TILE_SIZE = 256
+
+# Preview kinds: the uploaded image and its result mask
+PREVIEW_KINDS = ('image', 'result')
+
+# Percentiles mapped to black and white when stretching image bands
+STRETCH_PERCENTILES = (2, 98)
+
+# The stretch is estimated from STRETCH_SAMPLES x STRETCH_SAMPLES windows
+STRETCH_SAMPLES = 8
+STRETCH_WINDOW = 64
+
+
+def pyramid_max_zoom(height, width):
+    """Zoom level at which a tile pixel is an image pixel"""
+    return max(0, math.ceil(math.log2(max(height, width) / PREVIEW_TILE_SIZE)))
+
+
+def _display_bands(bands):
+    """Bands shown as red, green and blue"""
+    if bands >= 4:
+        # Multispectral order: blue, green, red, (red edge,) NIR
+        return [2, 1, 0]
+    if bands == 3:
+        return [0, 1, 2]
+    return [0, 0, 0]
+
+
+def _band_stretch(raster, bands):
+    """Per-band (low, high) sample values from a sparse sample of the raster"""
+    rows = np.linspace(0, max(raster.height - STRETCH_WINDOW, 0), STRETCH_SAMPLES).astype(int)
+    cols = np.linspace(0, max(raster.width - STRETCH_WINDOW, 0), STRETCH_SAMPLES).astype(int)
+    samples = np.concatenate([
+        raster.read(row, col, STRETCH_WINDOW, STRETCH_WINDOW)[bands].reshape(len(bands), -1)
+        for row in np.unique(rows) for col in np.unique(cols)
+    ], axis=1).astype(np.float64)
+
+    # Zero is no data (see inference.MIN_VALID_FRACTION)
+    valid = samples.any(axis=0)
+    if not valid.any():
+        return np.zeros(len(bands)), np.ones(len(bands))
+    low, high = np.percentile(samples[:, valid], STRETCH_PERCENTILES, axis=1)
+    return low, np.maximum(high, low + 1e-9)
+
+
+def image_renderer(raster):
+    """Function rendering a raster window as RGBA, stretched to the image's histogram"""
+    bands = _display_bands(raster.bands)
+    low, high = _band_stretch(raster, bands)
+    low, high = low[:, None, None], high[:, None, None]
+
+    def render(window):
+        rgb = np.clip((window[bands] - low) / (high - low) * 255, 0, 255)
+        rgba = np.empty(window.shape[1:] + (4,), dtype=np.uint8)
+        rgba[..., :3] = np.moveaxis(rgb, 0, -1)
+        rgba[..., 3] = np.where(window.any(axis=0), 255, 0)
+        return rgba
+
+    return render
+
+
+def mask_renderer(raster):
+    """Function rendering a probability mask in the severity colours of the map"""
+    def render(window):
+        probability = window[0] / 255
+        rgba = np.empty(probability.shape + (4,), dtype=np.uint8)
+        for channel in range(3):
+            rgba[..., channel] = np.interp(probability, PALETTE_LEVELS, PALETTE_COLORS[:, channel])
+        rgba[..., 3] = MAX_ALPHA * probability
+        return rgba
+
+    return render
+
+
+def _downsample(rgba):
+    """Halve an RGBA image, averaging colours weighted by their opacity"""
+    height, width, _ = rgba.shape
+    blocks = rgba.reshape(height // 2, 2, width // 2, 2, 4).astype(np.float64)
+    alpha = blocks[..., 3:]
+    alpha_sum = alpha.sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rgb = np.where(alpha_sum > 0, (blocks[..., :3] * alpha).sum(axis=(1, 3)) / alpha_sum, 0)
+    result = np.empty((height // 2, width // 2, 4), dtype=np.uint8)
+    result[..., :3] = np.rint(rgb)
+    result[..., 3] = np.rint(alpha_sum[..., 0] / 4)
+    return result
+
+
+class _PyramidBuilder:
+    """Renders and writes the tiles of one pyramid, depth first"""
+
+    def __init__(self, raster, render, target):
+        self.raster = raster
+        self.render = render
+        self.target = target
+        self.max_zoom = pyramid_max_zoom(raster.height, raster.width)
+        self.tiles = 0
+
+    def tiles_across(self, z):
+        scale = PREVIEW_TILE_SIZE * 2 ** (self.max_zoom - z)
+        return -(-self.raster.width // scale), -(-self.raster.height // scale)
+
+    def build(self, z=0, x=0, y=0):
+        """Render tile z/x/y and everything below it; returns its RGBA array"""
+        size = PREVIEW_TILE_SIZE
+        if z == self.max_zoom:
+            rgba = self.render(self.raster.read(y * size, x * size, size, size))
+        else:
+            across, down = self.tiles_across(z + 1)
+            children = np.zeros((2 * size, 2 * size, 4), dtype=np.uint8)
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    if 2 * x + dx < across and 2 * y + dy < down:
+                        children[dy * size:(dy + 1) * size, dx * size:(dx + 1) * size] = \
+                            self.build(z + 1, 2 * x + dx, 2 * y + dy)
+            rgba = _downsample(children)
+
+        path = os.path.join(self.target, str(z), str(x), f'{y}.png')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(encode_png(rgba))
+        self.tiles += 1
+        return rgba
+
+
+def manifest_path(folder, name, kind):
+    return os.path.join(folder, name, f'{kind}.json')
+
+
+def get_manifest(folder, name, kind):
+    """Manifest of the current pyramid of an image, or None if it has none"""
+    try:
+        with open(manifest_path(folder, name, kind)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def build_pyramid(path, folder, name, kind):
+    """
+    Render the thumbnail and tile pyramid of a raster
+
+    Args:
+        path: Uncompressed TIFF to render
+        folder: Preview folder (PREVIEW_FOLDER)
+        name: Name of the uploaded image the raster belongs to
+        kind: One of PREVIEW_KINDS; 'result' renders a probability mask
+
+    Returns:
+        The manifest: width, height, tile_size, max_zoom, the version and its
+        directory relative to folder
+
+    Raises:
+        UnsupportedRaster: If the file cannot be memory-mapped
+    """
+    start = time.time()
+    raster = Raster(path)
+    render = mask_renderer(raster) if kind == 'result' else image_renderer(raster)
+
+    version = f'{time.time_ns():x}'
+    directory = f'{name}/{kind}-{version}'
+    target = os.path.join(folder, directory)
+    temp_target = f'{target}.{os.getpid()}.tmp'
+    builder = _PyramidBuilder(raster, render, temp_target)
+    try:
+        top = builder.build()
+        # The thumbnail is the zoom 0 tile without its transparent padding
+        scale = 2 ** builder.max_zoom
+        height, width = -(-raster.height // scale), -(-raster.width // scale)
+        with open(os.path.join(temp_target, 'thumbnail.png'), 'wb') as f:
+            f.write(encode_png(np.ascontiguousarray(top[:height, :width])))
+        os.replace(temp_target, target)
+    except BaseException:
+        shutil.rmtree(temp_target, ignore_errors=True)
+        raise
+
+    manifest = {
+        'width': raster.width,
+        'height': raster.height,
+        'tile_size': PREVIEW_TILE_SIZE,
+        'max_zoom': builder.max_zoom,
+        'version': version,
+        'directory': directory
+    }
+    path = manifest_path(folder, name, kind)
+    with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    # Older versions are only reachable through URLs handed out before this build
+    for entry in os.scandir(os.path.join(folder, name)):
+        if entry.is_dir() and entry.name.startswith(f'{kind}-') and entry.path != target:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    logger.info(f"Rendered {builder.tiles} {kind} preview tiles of {name} "
+                f"({raster.width}x{raster.height}) in {time.time() - start:.1f}s")
+    return manifest
+
+
+def build_previews(image_path, result_path, folder):
+    """
+    Render the previews of an uploaded image and its result
+
+    Rasters that cannot be memory-mapped (PNG, JPEG, compressed TIFFs) get no
+    pyramid; browsers display the former directly from /uploads.
+
+    Returns:
+        Dictionary mapping the kinds that were rendered to their manifests
+    """
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    sources = {'image': image_path}
+    if result_path and result_path != image_path:
+        sources['result'] = result_path
+
+    manifests = {}
+    for kind, path in sources.items():
+        try:
+            manifests[kind] = build_pyramid(path, folder, name, kind)
+        except UnsupportedRaster as e:
+            logger.debug(f"No {kind} preview for {path}: {str(e)}")
+    return manifests
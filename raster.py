@@ -0,0 +1,432 @@
+import math
+import struct
+
+import numpy as np
+
+# Memory-mapped access to uncompressed (Geo)TIFF rasters. The file is mapped once
+# and windows are assembled from the strips or tiles that overlap them, so only
+# the requested window is ever copied into RAM. Classic TIFF and BigTIFF (needed
+# for orthomosaics over 4GB) are supported, chunky or planar, integer or float.
+# Compressed rasters need a codec this module does not have and are rejected.
+
+# TIFF tags
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+SAMPLE_FORMAT = 339
+
+# GeoTIFF tags
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+MODEL_TRANSFORMATION = 34264
+GEO_KEY_DIRECTORY = 34735
+
+# GeoTIFF keys
+GT_MODEL_TYPE = 1024
+PROJECTED_CS_TYPE = 3072
+
+MODEL_TYPE_PROJECTED = 1
+MODEL_TYPE_GEOGRAPHIC = 2
+
+# TIFF field types: (struct code, size)
+FIELD_TYPES = {
+    1: ('B', 1),   # BYTE
+    2: ('s', 1),   # ASCII
+    3: ('H', 2),   # SHORT
+    4: ('I', 4),   # LONG
+    5: ('II', 8),  # RATIONAL
+    6: ('b', 1),   # SBYTE
+    7: ('B', 1),   # UNDEFINED
+    8: ('h', 2),   # SSHORT
+    9: ('i', 4),   # SLONG
+    11: ('f', 4),  # FLOAT
+    12: ('d', 8),  # DOUBLE
+    16: ('Q', 8),  # LONG8
+}
+
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class UnsupportedRaster(ValueError):
+    """The file is not a raster this module can memory-map"""
+
+
+class GeoTransform:
+    """
+    Mapping from pixel (row, col) to longitude/latitude
+
+    Args:
+        origin_x, origin_y: Model coordinates of the top-left corner of pixel (0, 0)
+        pixel_width, pixel_height: Pixel size in model units (pixel_height is
+            positive when rows run southwards)
+        utm_zone: UTM zone for WGS84 UTM rasters, or None for geographic ones
+        northern: Hemisphere of the UTM zone
+    """
+
+    def __init__(self, origin_x, origin_y, pixel_width, pixel_height, utm_zone=None, northern=True):
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.pixel_width = pixel_width
+        self.pixel_height = pixel_height
+        self.utm_zone = utm_zone
+        self.northern = northern
+
+    def to_latlng(self, rows, cols):
+        """
+        Coordinates of pixel positions (fractional positions are allowed, so
+        rows + 0.5 gives pixel centres)
+
+        Returns:
+            Tuple of latitude and longitude arrays
+        """
+        x = self.origin_x + np.asarray(cols, dtype=np.float64) * self.pixel_width
+        y = self.origin_y - np.asarray(rows, dtype=np.float64) * self.pixel_height
+        if self.utm_zone is None:
+            return y, x
+        return utm_to_latlng(x, y, self.utm_zone, self.northern)
+
+
+def utm_to_latlng(easting, northing, zone, northern=True):
+    """
+    Convert WGS84 UTM coordinates to latitude/longitude
+
+    Uses the series expansion of the inverse transverse Mercator projection,
+    accurate to well under a metre within a zone.
+
+    Returns:
+        Tuple of latitude and longitude arrays in degrees
+    """
+    a = 6378137.0
+    f = 1 / 298.257223563
+    k0 = 0.9996
+    e2 = f * (2 - f)
+    ep2 = e2 / (1 - e2)
+    e1 = (1 - math.sqrt(1 - e2)) / (1 + math.sqrt(1 - e2))
+
+    x = np.asarray(easting, dtype=np.float64) - 500000.0
+    y = np.asarray(northing, dtype=np.float64)
+    if not northern:
+        y = y - 10000000.0
+
+    mu = y / k0 / (a * (1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256))
+    phi1 = (mu
+            + (3 * e1 / 2 - 27 * e1 ** 3 / 32) * np.sin(2 * mu)
+            + (21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32) * np.sin(4 * mu)
+            + (151 * e1 ** 3 / 96) * np.sin(6 * mu)
+            + (1097 * e1 ** 4 / 512) * np.sin(8 * mu))
+
+    sin_phi = np.sin(phi1)
+    cos_phi = np.cos(phi1)
+    tan_phi = np.tan(phi1)
+    n1 = a / np.sqrt(1 - e2 * sin_phi ** 2)
+    t1 = tan_phi ** 2
+    c1 = ep2 * cos_phi ** 2
+    r1 = a * (1 - e2) / (1 - e2 * sin_phi ** 2) ** 1.5
+    d = x / (n1 * k0)
+
+    lat = phi1 - (n1 * tan_phi / r1) * (
+        d ** 2 / 2
+        - (5 + 3 * t1 + 10 * c1 - 4 * c1 ** 2 - 9 * ep2) * d ** 4 / 24
+        + (61 + 90 * t1 + 298 * c1 + 45 * t1 ** 2 - 252 * ep2 - 3 * c1 ** 2) * d ** 6 / 720
+    )
+    lng = (d
+           - (1 + 2 * t1 + c1) * d ** 3 / 6
+           + (5 - 2 * c1 + 28 * t1 - 3 * c1 ** 2 + 8 * ep2 + 24 * t1 ** 2) * d ** 5 / 120) / cos_phi
+
+    central_meridian = (zone - 1) * 6 - 180 + 3
+    return np.degrees(lat), central_meridian + np.degrees(lng)
+
+
+def _read_ifd(mm, offset, byte_order, big):
+    """Parse the tags of an image file directory into a dictionary"""
+    count_format, entry_size, value_size = ('Q', 20, 8) if big else ('H', 12, 4)
+    (count,) = struct.unpack_from(byte_order + count_format, mm, offset)
+    offset += struct.calcsize(count_format)
+
+    tags = {}
+    for i in range(count):
+        entry = offset + i * entry_size
+        tag, field_type = struct.unpack_from(byte_order + 'HH', mm, entry)
+        (value_count,) = struct.unpack_from(byte_order + ('Q' if big else 'I'), mm, entry + 4)
+        if field_type not in FIELD_TYPES:
+            continue
+
+        code, size = FIELD_TYPES[field_type]
+        total = size * value_count
+        value_offset = entry + (12 if big else 8)
+        if total > value_size:
+            (value_offset,) = struct.unpack_from(byte_order + ('Q' if big else 'I'), mm, value_offset)
+
+        if field_type == 2:
+            tags[tag] = bytes(mm[value_offset:value_offset + total]).rstrip(b'\0').decode('latin-1')
+        else:
+            tags[tag] = struct.unpack_from(f'{byte_order}{value_count * len(code)}{code[0]}', mm, value_offset)
+    return tags
+
+
+def _geo_transform(tags):
+    """GeoTransform from GeoTIFF tags, or None if the raster is not georeferenced"""
+    keys = {}
+    directory = tags.get(GEO_KEY_DIRECTORY)
+    if directory:
+        for i in range(4, min(4 + 4 * directory[3], len(directory) - 3), 4):
+            key, location, _, value = directory[i:i + 4]
+            if location == 0:
+                keys[key] = value
+
+    if MODEL_TRANSFORMATION in tags:
+        matrix = tags[MODEL_TRANSFORMATION]
+        if matrix[1] != 0 or matrix[4] != 0:
+            raise UnsupportedRaster("Rotated rasters are not supported")
+        origin_x, origin_y = matrix[3], matrix[7]
+        pixel_width, pixel_height = matrix[0], -matrix[5]
+    elif MODEL_TIEPOINT in tags and MODEL_PIXEL_SCALE in tags:
+        i, j, _, x, y, _ = tags[MODEL_TIEPOINT][:6]
+        pixel_width, pixel_height = tags[MODEL_PIXEL_SCALE][:2]
+        origin_x = x - i * pixel_width
+        origin_y = y + j * pixel_height
+    else:
+        return None
+
+    model_type = keys.get(GT_MODEL_TYPE, MODEL_TYPE_GEOGRAPHIC)
+    if model_type == MODEL_TYPE_GEOGRAPHIC:
+        return GeoTransform(origin_x, origin_y, pixel_width, pixel_height)
+
+    # WGS84 / UTM zone N is EPSG:326NN, zone S is EPSG:327NN
+    epsg = keys.get(PROJECTED_CS_TYPE)
+    if epsg is not None and 32601 <= epsg <= 32660:
+        return GeoTransform(origin_x, origin_y, pixel_width, pixel_height, epsg - 32600, True)
+    if epsg is not None and 32701 <= epsg <= 32760:
+        return GeoTransform(origin_x, origin_y, pixel_width, pixel_height, epsg - 32700, False)
+    raise UnsupportedRaster(f"Unsupported projection (EPSG:{epsg}); reproject to WGS84 or WGS84/UTM")
+
+
+class Raster:
+    """
+    Read-only memory-mapped view of an uncompressed TIFF
+
+    Attributes:
+        height, width, bands: Raster dimensions
+        dtype: NumPy dtype of the samples
+        transform: GeoTransform, or None if the raster has no georeference
+
+    Raises:
+        UnsupportedRaster: If the file is not an uncompressed TIFF
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self._mm = np.memmap(path, dtype=np.uint8, mode='r')
+            self._parse()
+        except UnsupportedRaster:
+            raise
+        except (ValueError, struct.error, KeyError, IndexError) as e:
+            raise UnsupportedRaster(f"Unreadable TIFF: {e}") from e
+
+    def _parse(self):
+
+        header = bytes(self._mm[:16])
+        if header[:2] == b'II':
+            byte_order = '<'
+        elif header[:2] == b'MM':
+            byte_order = '>'
+        else:
+            raise UnsupportedRaster("Not a TIFF file")
+
+        (magic,) = struct.unpack_from(byte_order + 'H', header, 2)
+        if magic == 42:
+            big = False
+            (ifd_offset,) = struct.unpack_from(byte_order + 'I', header, 4)
+        elif magic == 43:
+            big = True
+            (ifd_offset,) = struct.unpack_from(byte_order + 'Q', header, 8)
+        else:
+            raise UnsupportedRaster("Not a TIFF file")
+
+        tags = _read_ifd(self._mm, ifd_offset, byte_order, big)
+
+        compression = tags.get(COMPRESSION, (1,))[0]
+        if compression != 1:
+            raise UnsupportedRaster(f"Compressed TIFFs (compression {compression}) cannot be memory-mapped")
+
+        self.width = tags[IMAGE_WIDTH][0]
+        self.height = tags[IMAGE_LENGTH][0]
+        self.bands = tags.get(SAMPLES_PER_PIXEL, (1,))[0]
+        bits = tags.get(BITS_PER_SAMPLE, (1,))
+        kinds = tags.get(SAMPLE_FORMAT, (1,))
+        if len(set(bits)) != 1 or bits[0] % 8 or len(set(kinds)) != 1 or kinds[0] not in SAMPLE_KINDS:
+            raise UnsupportedRaster("Bands must share one byte-aligned sample format")
+        self.dtype = np.dtype(f'{byte_order}{SAMPLE_KINDS[kinds[0]]}{bits[0] // 8}')
+        self.planar = tags.get(PLANAR_CONFIGURATION, (1,))[0] == 2
+
+        # Strips are handled as tiles spanning the full width
+        if TILE_OFFSETS in tags:
+            self.block_width = tags[TILE_WIDTH][0]
+            self.block_height = tags[TILE_LENGTH][0]
+            self.block_offsets = tags[TILE_OFFSETS]
+        else:
+            self.block_width = self.width
+            self.block_height = min(tags.get(ROWS_PER_STRIP, (self.height,))[0], self.height)
+            self.block_offsets = tags[STRIP_OFFSETS]
+        self.blocks_across = -(-self.width // self.block_width)
+        self.blocks_down = -(-self.height // self.block_height)
+
+        expected = self.blocks_across * self.blocks_down * (self.bands if self.planar else 1)
+        if len(self.block_offsets) != expected:
+            raise UnsupportedRaster("Unexpected number of strips or tiles")
+
+        self.transform = _geo_transform(tags)
+        self._tags = tags
+
+    @property
+    def geo_tags(self):
+        """GeoTIFF tags of the raster, for copying to derived rasters"""
+        return {tag: self._tags[tag] for tag in
+                (MODEL_PIXEL_SCALE, MODEL_TIEPOINT, MODEL_TRANSFORMATION, GEO_KEY_DIRECTORY)
+                if tag in self._tags}
+
+    def _block(self, block_row, block_col, band=None):
+        """Array view of one strip or tile, without copying"""
+        index = block_row * self.blocks_across + block_col
+        if band is not None:
+            index += band * self.blocks_across * self.blocks_down
+
+        # The last strip may be short; tiles are always full size
+        rows = self.block_height
+        if self.block_width == self.width:
+            rows = min(rows, self.height - block_row * self.block_height)
+        shape = (rows, self.block_width) if band is not None else (rows, self.block_width, self.bands)
+
+        count = int(np.prod(shape))
+        return np.frombuffer(self._mm, dtype=self.dtype, count=count,
+                             offset=self.block_offsets[index]).reshape(shape)
+
+    def read(self, row, col, height, width):
+        """
+        Copy a window into memory
+
+        Args:
+            row, col: Top-left pixel of the window (may lie outside the raster)
+            height, width: Window size
+
+        Returns:
+            Array of shape (bands, height, width); pixels outside the raster are 0
+        """
+        window = np.zeros((self.bands, height, width), dtype=self.dtype.newbyteorder('='))
+        row0, row1 = max(row, 0), min(row + height, self.height)
+        col0, col1 = max(col, 0), min(col + width, self.width)
+        if row0 >= row1 or col0 >= col1:
+            return window
+
+        for block_row in range(row0 // self.block_height, (row1 - 1) // self.block_height + 1):
+            top = block_row * self.block_height
+            r0, r1 = max(row0, top), min(row1, top + self.block_height)
+            for block_col in range(col0 // self.block_width, (col1 - 1) // self.block_width + 1):
+                left = block_col * self.block_width
+                c0, c1 = max(col0, left), min(col1, left + self.block_width)
+                target = (slice(None), slice(r0 - row, r1 - row), slice(c0 - col, c1 - col))
+                if self.planar:
+                    for band in range(self.bands):
+                        block = self._block(block_row, block_col, band)
+                        window[band][target[1:]] = block[r0 - top:r1 - top, c0 - left:c1 - left]
+                else:
+                    block = self._block(block_row, block_col)
+                    window[target] = np.moveaxis(block[r0 - top:r1 - top, c0 - left:c1 - left], -1, 0)
+        return window
+
+
+def create_raster(path, height, width, bands=1, dtype=np.uint8, geo_tags=None):
+    """
+    Create an uncompressed TIFF and memory-map its pixels for writing
+
+    The pixels are one contiguous chunky strip, so the file is filled in place
+    without ever being held in memory. BigTIFF is used when the image exceeds 4GB.
+
+    Args:
+        path: Output path
+        height, width: Image size
+        bands: Samples per pixel
+        dtype: Integer or float sample type
+        geo_tags: Optional GeoTIFF tags to copy (see Raster.geo_tags)
+
+    Returns:
+        Writable np.memmap of shape (height, width), or (height, width, bands)
+        for multi-band rasters
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    sample_format = {kind: code for code, kind in SAMPLE_KINDS.items()}[dtype.kind]
+    data_size = height * width * bands * dtype.itemsize
+    big = data_size >= 2 ** 32 - 2 ** 20
+    byte_order = '<'
+    offset_code, count_code, entry_size, value_size = ('Q', 'Q', 20, 8) if big else ('I', 'H', 12, 4)
+    offset_type = 16 if big else 4
+
+    entries = [
+        (IMAGE_WIDTH, 4, (width,)),
+        (IMAGE_LENGTH, 4, (height,)),
+        (BITS_PER_SAMPLE, 3, (dtype.itemsize * 8,) * bands),
+        (COMPRESSION, 3, (1,)),
+        (PHOTOMETRIC, 3, (1,)),
+        (STRIP_OFFSETS, offset_type, (0,)),  # Patched below
+        (SAMPLES_PER_PIXEL, 3, (bands,)),
+        (ROWS_PER_STRIP, 4, (height,)),
+        (STRIP_BYTE_COUNTS, offset_type, (data_size,)),
+        (PLANAR_CONFIGURATION, 3, (1,)),
+        (SAMPLE_FORMAT, 3, (sample_format,) * bands),
+    ]
+    geo_types = {MODEL_PIXEL_SCALE: 12, MODEL_TIEPOINT: 12, MODEL_TRANSFORMATION: 12, GEO_KEY_DIRECTORY: 3}
+    for tag, values in sorted((geo_tags or {}).items()):
+        entries.append((tag, geo_types[tag], tuple(values)))
+
+    header_size = 16 if big else 8
+    ifd_size = struct.calcsize(count_code) + len(entries) * entry_size + value_size
+    extra = []
+    extra_offset = header_size + ifd_size
+    packed_entries = []
+    for tag, field_type, values in entries:
+        code = FIELD_TYPES[field_type][0]
+        payload = struct.pack(f'{byte_order}{len(values)}{code}', *values)
+        if len(payload) <= value_size:
+            packed_entries.append((tag, field_type, len(values), payload.ljust(value_size, b'\0')))
+        else:
+            packed_entries.append((tag, field_type, len(values),
+                                   struct.pack(byte_order + offset_code, extra_offset)))
+            extra.append(payload)
+            extra_offset += len(payload) + len(payload) % 2
+
+    data_offset = extra_offset + (-extra_offset % 16)
+    strip_offsets = [tag for tag, _, _, _ in packed_entries].index(STRIP_OFFSETS)
+    packed_entries[strip_offsets] = (STRIP_OFFSETS, offset_type, 1,
+                                     struct.pack(byte_order + offset_code, data_offset).ljust(value_size, b'\0'))
+
+    with open(path, 'wb') as f:
+        if big:
+            f.write(struct.pack(byte_order + '2sHHHQ', b'II', 43, 8, 0, header_size))
+        else:
+            f.write(struct.pack(byte_order + '2sHI', b'II', 42, header_size))
+        f.write(struct.pack(byte_order + count_code, len(packed_entries)))
+        for tag, field_type, count, value in packed_entries:
+            f.write(struct.pack(byte_order + 'HH' + ('Q' if big else 'I'), tag, field_type, count) + value)
+        f.write(b'\0' * value_size)  # No next IFD
+        for payload in extra:
+            f.write(payload + b'\0' * (len(payload) % 2))
+        f.truncate(data_offset + data_size)
+
+    shape = (height, width) if bands == 1 else (height, width, bands)
+    return np.memmap(path, dtype=dtype, mode='r+', offset=data_offset, shape=shape)
+
+
+def create_mask(path, height, width, geo_tags=None):
+    """Create a single-band uint8 TIFF for a segmentation mask (see create_raster)"""
+    return create_raster(path, height, width, geo_tags=geo_tags)
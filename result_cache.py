@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+# Cache of serialized API results keyed on (dataset version, request parameters).
+# Entries are held in a size-bounded in-memory LRU and, when a folder is
+# configured, persisted to disk so they survive worker restarts and are shared
+# between workers. Entries for older dataset versions are dropped as soon as a
+# newer version is stored.
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    LRU cache of result bytes keyed on a dataset version and request parameters
+
+    Args:
+        max_bytes: Upper bound on the total size of the in-memory entries
+        folder: Optional directory for on-disk persistence
+    """
+
+    def __init__(self, max_bytes, folder=None):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(params):
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, version, digest):
+        return os.path.join(self.folder, f'{version}-{digest}.json')
+
+    def get(self, version, params):
+        """
+        Cached result for a dataset version and parameters
+
+        Returns:
+            Result bytes, or None on a miss
+        """
+        digest = self._digest(params)
+        with self._lock:
+            data = self._entries.get((version, digest))
+            if data is not None:
+                self._entries.move_to_end((version, digest))
+                self.hits += 1
+                return data
+
+        if self.folder:
+            try:
+                with open(self._path(version, digest), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+            if data is not None:
+                self._store(version, digest, data)
+                with self._lock:
+                    self.hits += 1
+                return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, version, params, data):
+        """Store a result computed from the given dataset version"""
+        digest = self._digest(params)
+        self._store(version, digest, data)
+
+        if self.folder:
+            os.makedirs(self.folder, exist_ok=True)
+            path = self._path(version, digest)
+            temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            self._remove_stale_files(version)
+
+    def _store(self, version, digest, data):
+        with self._lock:
+            if self._version is None or version > self._version:
+                # A newer dataset version makes every older entry unreachable
+                self._entries.clear()
+                self._size = 0
+                self._version = version
+            elif version < self._version:
+                return
+
+            if len(data) > self.max_bytes:
+                return
+
+            previous = self._entries.pop((version, digest), None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[(version, digest)] = data
+            self._size += len(data)
+
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _remove_stale_files(self, version):
+        for name in os.listdir(self.folder):
+            prefix = name.split('-', 1)[0]
+            if prefix.isdigit() and int(prefix) < version:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        """Hit/miss counters and memory use"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'version': self._version
+            }
+
+
+_prediction_cache = None
+
+
+def get_prediction_cache():
+    """The process-wide cache of /api/predict results"""
+    global _prediction_cache
+    if _prediction_cache is None:
+        _prediction_cache = ResultCache(
+            current_app.config["PREDICTION_CACHE_MAX_BYTES"],
+            current_app.config["PREDICTION_CACHE_FOLDER"]
+        )
+    return _prediction_cache
+
+
+_analysis_cache = None
+
+
+def get_analysis_cache():
+    """The process-wide in-memory cache of /api/pattern_analysis results"""
+    global _analysis_cache
+    if _analysis_cache is None:
+        _analysis_cache = ResultCache(current_app.config["ANALYSIS_CACHE_MAX_BYTES"])
+    return _analysis_cache
@@ -0,0 +1,234 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import event, inspect, select, insert, update, delete, case, func, and_, or_
+
+from app import db
+from models import InfectionData, InfectionRollup
+from archive import infection_history
+
+# InfectionRollup holds per-day, per-image count/sum/max of infection_level so the
+# trend chart never has to scan InfectionData. Rows added through the ORM are folded
+# in automatically when the session flushes; bulk loaders that bypass the ORM call
+# add_to_rollups() once per batch. Rows updated or deleted through the ORM have the
+# days and images they left and entered recomputed in the same flush, and ORM bulk
+# updates and deletes rebuild the rollups before their transaction commits.
+# rebuild_rollups() recomputes everything. Rollups cover archived rows too (see
+# archive.py), so compaction leaves them alone.
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ('day', 'week', 'month')
+
+# InfectionData columns the rollups are computed from
+ROLLUP_COLUMNS = ('date_recorded', 'source_image_id', 'infection_level')
+
+
+def _rollup_key(date_recorded, image_id):
+    return (date_recorded or datetime.utcnow()).date(), image_id or 0
+
+
+def aggregate(rows):
+    """
+    Aggregate infection rows into rollup totals
+
+    Args:
+        rows: Iterable of (date_recorded, source_image_id, infection_level) tuples
+
+    Returns:
+        Dictionary mapping (day, image_id) to [count, level_sum, level_max]
+    """
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for date_recorded, image_id, level in rows:
+        entry = totals[_rollup_key(date_recorded, image_id)]
+        entry[0] += 1
+        entry[1] += level
+        entry[2] = max(entry[2], level)
+    return totals
+
+
+def add_to_rollups(connection, totals):
+    """
+    Fold aggregated totals into the rollup table
+
+    Args:
+        connection: Connection (or Session) whose transaction the update joins
+        totals: Output of aggregate()
+    """
+    table = InfectionRollup.__table__
+    for (day, image_id), (count, level_sum, level_max) in totals.items():
+        result = connection.execute(
+            update(table)
+            .where(table.c.day == day, table.c.image_id == image_id)
+            .values(
+                count=table.c.count + count,
+                level_sum=table.c.level_sum + level_sum,
+                level_max=case((table.c.level_max < level_max, level_max), else_=table.c.level_max)
+            )
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(
+                day=day, image_id=image_id, count=count,
+                level_sum=level_sum, level_max=level_max
+            ))
+
+
+def recompute_rollups(connection, keys=None):
+    """
+    Recompute rollup rows from the infection history, archived rows included
+
+    Args:
+        connection: Connection (or Session) whose transaction the update joins
+        keys: (day, image_id) pairs to recompute; None recomputes every row
+    """
+    table = InfectionRollup.__table__
+    history = infection_history()
+    day = func.date(history.date_recorded)
+    image_id = func.coalesce(history.source_image_id, 0)
+    query = (
+        select(
+            day, image_id, func.count(),
+            func.sum(history.infection_level),
+            func.max(history.infection_level)
+        )
+        .where(history.date_recorded.isnot(None))
+        .group_by(day, image_id)
+    )
+
+    if keys is None:
+        connection.execute(delete(table))
+    else:
+        keys = sorted(keys)
+        connection.execute(delete(table).where(or_(*[
+            and_(table.c.day == key_day, table.c.image_id == key_image_id)
+            for key_day, key_image_id in keys
+        ])))
+        query = query.where(or_(*[
+            and_(
+                history.date_recorded >= datetime.combine(key_day, time.min),
+                history.date_recorded < datetime.combine(key_day + timedelta(days=1), time.min),
+                image_id == key_image_id
+            ) for key_day, key_image_id in keys
+        ]))
+
+    connection.execute(insert(table).from_select(
+        ['day', 'image_id', 'count', 'level_sum', 'level_max'], query
+    ))
+
+
+def _previous_value(obj, name):
+    """Value of an attribute before the changes being flushed"""
+    history = inspect(obj).attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(obj, name)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _rollup_changed_infections(session, flush_context):
+    """Fold InfectionData rows inserted, updated or deleted through the ORM into the rollups"""
+    changed = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, InfectionData):
+            continue
+        if obj in session.deleted or any(inspect(obj).attrs[name].history.has_changes() for name in ROLLUP_COLUMNS):
+            # An edited row leaves one rollup row and enters another
+            changed.add(_rollup_key(_previous_value(obj, 'date_recorded'), _previous_value(obj, 'source_image_id')))
+            if obj not in session.deleted:
+                changed.add(_rollup_key(obj.date_recorded, obj.source_image_id))
+    if changed:
+        recompute_rollups(session.connection(), changed)
+
+    # New rows of recomputed days are already counted
+    rows = [
+        (obj.date_recorded, obj.source_image_id, obj.infection_level)
+        for obj in session.new
+        if isinstance(obj, InfectionData) and _rollup_key(obj.date_recorded, obj.source_image_id) not in changed
+    ]
+    if rows:
+        add_to_rollups(session.connection(), aggregate(rows))
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _flag_bulk_changes(orm_execute_state):
+    """Bulk updates and deletes of InfectionData may touch any rollup row"""
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ is InfectionData:
+            orm_execute_state.session.info['rollup_rebuild'] = True
+
+
+@event.listens_for(db.session, 'before_commit')
+def _rebuild_after_bulk_changes(session):
+    if session.info.get('rollup_rebuild'):
+        session.flush()
+        session.info.pop('rollup_rebuild', None)
+        recompute_rollups(session.connection())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_bulk_changes(session):
+    session.info.pop('rollup_rebuild', None)
+
+
+def rebuild_rollups():
+    """Recompute the rollup table from scratch, archived rows included"""
+    recompute_rollups(db.session)
+    db.session.commit()
+
+    logger.info(f"Rebuilt infection rollups ({InfectionRollup.query.count()} rows)")
+
+
+def ensure_rollups():
+    """Build the rollups for databases that have infections but no rollup rows yet"""
+    if InfectionRollup.query.first() is None and InfectionData.query.first() is not None:
+        rebuild_rollups()
+
+
+def _bucket(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def trend(start=None, end=None, granularity='day', image_id=None):
+    """
+    Infection trend from the rollup table
+
+    Args:
+        start: Optional first day (inclusive)
+        end: Optional last day (inclusive)
+        granularity: 'day', 'week' (buckets start on Monday) or 'month'
+        image_id: Optional source image filter (0 for points not from an image)
+
+    Returns:
+        List of dictionaries with date, count, avg_level and max_level, sorted by date
+    """
+    query = select(
+        InfectionRollup.day,
+        func.sum(InfectionRollup.count),
+        func.sum(InfectionRollup.level_sum),
+        func.max(InfectionRollup.level_max)
+    ).group_by(InfectionRollup.day).order_by(InfectionRollup.day)
+
+    if start is not None:
+        query = query.where(InfectionRollup.day >= start)
+    if end is not None:
+        query = query.where(InfectionRollup.day <= end)
+    if image_id is not None:
+        query = query.where(InfectionRollup.image_id == image_id)
+
+    buckets = {}
+    for day, count, level_sum, level_max in db.session.execute(query):
+        entry = buckets.setdefault(_bucket(day, granularity), [0, 0.0, 0.0])
+        entry[0] += count
+        entry[1] += level_sum
+        entry[2] = max(entry[2], level_max)
+
+    return [{
+        'date': bucket.strftime('%Y-%m-%d'),
+        'count': count,
+        'avg_level': level_sum / count if count > 0 else 0,
+        'max_level': level_max
+    } for bucket, (count, level_sum, level_max) in buckets.items()]
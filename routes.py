@@ -1,33 +1,158 @@
 import os
+import io
 import json
-from datetime import datetime
-from flask import render_template, request, jsonify, redirect, url_for, flash, send_from_directory
-from werkzeug.utils import secure_filename
+import math
+import uuid
+import threading
+from datetime import datetime, timezone
 import numpy as np
+from flask import Blueprint, current_app, render_template, request, jsonify, redirect, url_for, flash, send_from_directory, Response, stream_with_context, send_file
+from sqlalchemy import select, func, literal
+from sqlalchemy.orm import aliased
 
-from app import app, db
-from models import ImageData, InfectionData, PredictionModel
-from ml_models import process_image, get_model_info
-from cellular_automata import predict_spread
+from app import db
+from models import ImageData, ProcessingJob, UploadBatch
+from spatial import GRID_COLS, parse_bbox, bbox_conditions, thinning_factor
+from rollups import GRANULARITIES, trend
+from export import EXPORT_FORMATS, STREAM_ENCODERS, iter_batches
+from tiles import MAX_TILE_ZOOM, get_tile
+from clusters import get_clusters, cluster_points
+from archive import date_conditions, infection_source
+from snapshot import snapshot_for
+from versioning import PREDICTION_MODELS, get_dataset_state, get_dataset_version
+from result_cache import get_prediction_cache, get_analysis_cache
+from patterns import analyze_patterns
+import metrics
+
+# The prediction, image processing and import code is imported by the views that
+# use it, so workers start without loading it.
+
+bp = Blueprint('main', __name__)
+
+# Cancellation events of the prediction streams running in this process, by stream id
+_prediction_streams = {}
+_prediction_streams_lock = threading.Lock()
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tif', 'tiff'}
 
+# Lifetime of responses whose URL never changes content
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/')
+def parse_date(value):
+    """Parse a YYYY-MM-DD query parameter"""
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def parse_date_range(args):
+    """
+    Parse the optional start and end (inclusive, YYYY-MM-DD) of a request
+    
+    Raises:
+        ValueError: If a date is malformed or start is after end
+    """
+    try:
+        start = parse_date(args['start']) if args.get('start') else None
+        end = parse_date(args['end']) if args.get('end') else None
+    except (TypeError, ValueError):
+        raise ValueError("start and end must be dates formatted as YYYY-MM-DD")
+    if start is not None and end is not None and start > end:
+        raise ValueError("start must not be after end")
+    return start, end
+
+def parse_prediction_params(data):
+    """
+    Parse the days, cell_size and seed of a prediction request
+    
+    Raises:
+        ValueError: If days is not an integer between 0 and MAX_PREDICTION_DAYS,
+            cell_size is not a positive number or seed is not a non-negative
+            integer or null
+    """
+    from cellular_automata import DEFAULT_CELL_SIZE, MAX_PREDICTION_DAYS
+    
+    days = data.get('days', 30)
+    cell_size = data.get('cell_size', DEFAULT_CELL_SIZE)
+    if isinstance(days, bool) or not isinstance(days, int) or not 0 <= days <= MAX_PREDICTION_DAYS:
+        raise ValueError(f"days must be an integer between 0 and {MAX_PREDICTION_DAYS}")
+    if (isinstance(cell_size, bool) or not isinstance(cell_size, (int, float))
+            or not math.isfinite(cell_size) or cell_size <= 0):
+        raise ValueError("cell_size must be a positive number")
+    seed = data.get('seed')
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or seed < 0):
+        raise ValueError("seed must be a non-negative integer or null")
+    return days, cell_size, seed
+
+def load_current_state(start=None, end=None):
+    """Infection points a prediction starts from, optionally those recorded in a date range"""
+    from cellular_automata import InfectionPoints
+    
+    snapshot = snapshot_for(start, end)
+    if snapshot is not None:
+        index = snapshot.select(start=start, end=end)
+        return InfectionPoints(snapshot.lat[index], snapshot.lng[index], snapshot.level[index])
+    
+    infection = infection_source(start, end)
+    rows = db.session.execute(
+        select(infection.latitude, infection.longitude, infection.infection_level)
+        .where(*date_conditions(infection, start, end)).order_by(infection.id)
+    ).all()
+    return [{'lat': lat, 'lng': lng, 'level': level} for lat, lng, level in rows]
+
+def wants_json():
+    """Whether the client prefers a JSON response over an HTML page"""
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json' and request.accept_mimetypes[best] > request.accept_mimetypes['text/html']
+
+def set_validators(response, etag, last_modified):
+    """Add an ETag and Last-Modified and make clients revalidate before reusing the response"""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+    response.cache_control.no_cache = True
+    return response
+
+def set_immutable(response):
+    """Let browsers and proxies reuse a response whose URL never changes content"""
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+def not_modified(etag, last_modified):
+    """304 response if the client's copy is current, None if the request must be served"""
+    if request.if_none_match:
+        current = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified is not None:
+        current = last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= request.if_modified_since
+    else:
+        current = False
+    return set_validators(Response(status=304), etag, last_modified) if current else None
+
+def parse_cursor(value):
+    """Parse a "<version>.<last id>" sync cursor"""
+    version, _, last_id = value.partition('.')
+    if not version.isdigit() or not last_id.isdigit():
+        raise ValueError("since must be a cursor returned in X-Sync-Cursor")
+    return int(version), int(last_id)
+
+@bp.route('/')
 def index():
     """Main page with the interactive map and sidebar"""
     return render_template('index.html')
 
-@app.route('/about')
+@bp.route('/about')
 def about():
     """About page with information on Ganoderma and classification methods"""
     return render_template('about.html')
 
-@app.route('/upload', methods=['GET', 'POST'])
+@bp.route('/upload', methods=['GET', 'POST'])
 def upload():
     """Image upload page and processing"""
+    from uploads import register_upload
+    
     if request.method == 'POST':
         # Check if the post request has the file part
         if 'file' not in request.files:
@@ -40,123 +165,701 @@ def upload():
             return redirect(request.url)
         
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            # Store by content hash; identical imagery is processed only once
+            image, job, duplicate = register_upload(file)
             
-            # Create database entry
-            new_image = ImageData(filename=filename)
-            db.session.add(new_image)
-            db.session.commit()
+            if job is None:
+                if wants_json():
+                    return jsonify({
+                        'image_id': image.id,
+                        'duplicate': duplicate,
+                        'processed': image.processed,
+                        'result_path': image.result_path
+                    })
+                
+                flash(f'This image was already uploaded and processed (image #{image.id}), reusing its results')
+                return redirect(url_for('.index'))
             
-            # Process image (this would trigger the ML model)
-            result_path = process_image(filepath, new_image.id)
+            if wants_json():
+                return jsonify({
+                    'job_id': job.id,
+                    'image_id': image.id,
+                    'duplicate': duplicate,
+                    'status_url': url_for('.job_status', job_id=job.id)
+                }), 202
             
-            # Update database entry with result
-            new_image.processed = True
-            new_image.result_path = result_path
-            db.session.commit()
-            
-            flash('File successfully uploaded and processed')
-            return redirect(url_for('index'))
+            if duplicate:
+                flash(f'This image was already uploaded, following its processing job #{job.id}')
+            else:
+                flash(f'File successfully uploaded, processing job #{job.id} queued')
+            return redirect(url_for('.index'))
     
     return render_template('upload.html')
 
-@app.route('/api/infection_data')
+@bp.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    API endpoint to upload many images at once
+    
+    Accepts images and zip or tar archives of images in the multipart field
+    'files' (or 'file'). New images are processed together as an upload batch
+    whose per-file and overall progress is reported by /api/batches/<batch_id>;
+    images uploaded before reuse their results.
+    """
+    from uploads import register_batch
+    
+    # Surveys are larger than single uploads; must be set before the form is parsed
+    request.max_content_length = current_app.config["BATCH_MAX_CONTENT_LENGTH"]
+    files = [file for file in request.files.getlist('files') + request.files.getlist('file') if file.filename]
+    if not files:
+        return jsonify({"error": "No files uploaded"}), 400
+    
+    batch, stored, skipped = register_batch(files, allowed_file)
+    if not stored:
+        return jsonify({"error": "No supported images in the upload", "skipped": skipped}), 400
+    
+    body = {'batch_id': None, 'files': stored, 'skipped': skipped}
+    if batch is None:
+        return jsonify(body)
+    
+    body['batch_id'] = batch.id
+    body['status_url'] = url_for('.batch_status', batch_id=batch.id)
+    return jsonify(body), 202
+
+@bp.route('/api/infection_data')
 def get_infection_data():
-    """API endpoint to get infection data for the map"""
-    infections = InfectionData.query.all()
-    data = [{
-        'id': infection.id,
-        'lat': infection.latitude,
-        'lng': infection.longitude,
-        'level': infection.infection_level,
-        'date': infection.date_recorded.strftime('%Y-%m-%d')
-    } for infection in infections]
+    """
+    API endpoint to get infection data for the map
     
-    return jsonify(data)
+    Optional query parameters:
+        bbox: Viewport as "west,south,east,north"; only points inside are returned
+        zoom: Map zoom level; below spatial.DETAIL_ZOOM nearby points are merged
+            into one point carrying the highest level and a count
+        limit: Maximum number of points to return
+        start, end: Inclusive date range as YYYY-MM-DD; ranges reaching back
+            before the retained months include archived points
+        since: Cursor from the X-Sync-Cursor header of an earlier response with
+            the same bbox, zoom and limit. Only points added since are returned
+            (merged points whose block gained points are returned whole, under
+            the same id); X-Sync-Reset: true means the full data was returned
+            instead and replaces the earlier response.
+    
+    Points are read from the worker's InfectionSnapshot (see snapshot.py)
+    unless the date range reaches archived points.
+    """
+    try:
+        bbox = parse_bbox(request.args['bbox']) if 'bbox' in request.args else None
+        zoom = request.args.get('zoom', type=int)
+        limit = request.args.get('limit', type=int)
+        start, end = parse_date_range(request.args)
+        since = parse_cursor(request.args['since']) if 'since' in request.args else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    state = get_dataset_state()
+    etag = f'infection_data-{state.version}'
+    cached = not_modified(etag, state.updated_date)
+    if cached is not None:
+        return cached
+    
+    # A delta is only possible if rows were appended, not changed, since the cursor
+    reset = since is not None and not state.rewritten_version <= since[0] <= state.version
+    delta_after = since[1] if since is not None and not reset else None
+    factor = thinning_factor(zoom)
+    
+    snapshot = snapshot_for(start, end, state)
+    if snapshot is not None:
+        last_id = snapshot.last_id
+        rows = snapshot_rows(snapshot, bbox, start, end, factor, delta_after, limit)
+    else:
+        last_id, rows = _query_infection_rows(bbox, start, end, factor, delta_after, limit)
+    cursor = f'{state.version}.{last_id}'
+    
+    truncated = limit is not None and len(rows) > limit
+    if truncated:
+        rows = rows[:limit]
+    
+    data = []
+    for row_id, lat, lng, level, date_recorded, count in rows:
+        point = {
+            'id': row_id,
+            'lat': lat,
+            'lng': lng,
+            'level': level,
+            'date': date_recorded.strftime('%Y-%m-%d')
+        }
+        if factor is not None:
+            point['count'] = count
+        data.append(point)
+    
+    response = jsonify(data)
+    response.headers['X-Sync-Cursor'] = cursor
+    if reset:
+        response.headers['X-Sync-Reset'] = 'true'
+    if truncated:
+        response.headers['X-Truncated'] = 'true'
+    return set_validators(response, etag, state.updated_date)
 
-@app.route('/api/trend_data')
-def get_trend_data():
-    """API endpoint to get trend data for visualization"""
-    # Group infections by date and calculate average severity
-    infections = InfectionData.query.all()
-    
-    # Process data for trend visualization
-    dates = {}
-    for infection in infections:
-        date_str = infection.date_recorded.strftime('%Y-%m-%d')
-        if date_str not in dates:
-            dates[date_str] = {'count': 0, 'total_level': 0}
+def snapshot_rows(snapshot, bbox, start, end, factor, delta_after, limit):
+    """
+    Rows of /api/infection_data from the worker's InfectionSnapshot
+    
+    Returns:
+        Up to limit + 1 tuples (id, lat, lng, level, date_recorded, count), like
+        _query_infection_rows
+    """
+    if delta_after == snapshot.last_id:
+        return []
+    
+    index = snapshot.select(bbox, start, end)
+    if factor is None:
+        if delta_after is not None:
+            index = index[snapshot.id[index] > delta_after]
+        if limit is not None:
+            index = index[:limit + 1]
+        columns = (snapshot.id[index], snapshot.lat[index], snapshot.lng[index],
+                   snapshot.level[index], snapshot.date[index], np.ones(index.size, dtype=np.int64))
+    else:
+        # Blocks that gained points; their smallest id is unchanged by appends
+        gained = None
+        if delta_after is not None:
+            gained = snapshot.blocks(index[snapshot.id[index] > delta_after], factor)
+        columns = snapshot.merge_blocks(index, factor, gained)
+        if limit is not None:
+            columns = tuple(column[:limit + 1] for column in columns)
+    
+    # datetime64[us] converts to datetime objects
+    return list(zip(*(column.tolist() for column in columns)))
+
+def _query_infection_rows(bbox, start, end, factor, delta_after, limit):
+    """
+    Rows of /api/infection_data from the database
+    
+    Returns:
+        Tuple (last_id, rows): the largest id the rows cover and up to limit + 1
+        tuples (id, lat, lng, level, date_recorded, count)
+    """
+    # Read after the version, so the cursor never claims rows it does not cover
+    infection = infection_source(start, end)
+    last_id = db.session.execute(select(func.max(infection.id))).scalar() or 0
+    
+    conditions = bbox_conditions(infection, bbox) + date_conditions(infection, start, end) + [infection.id <= last_id]
+    
+    if factor is None:
+        if delta_after is not None:
+            conditions.append(infection.id > delta_after)
+        query = select(
+            infection.id,
+            infection.latitude,
+            infection.longitude,
+            infection.infection_level,
+            infection.date_recorded,
+            literal(1)
+        ).where(*conditions)
+    else:
+        # Merge points falling in the same block of factor x factor grid cells
+        def block_of(model):
+            return (
+                (model.grid_cell // GRID_COLS // factor) * GRID_COLS +
+                (model.grid_cell % GRID_COLS) // factor
+            )
+        
+        block = block_of(infection)
+        if delta_after is not None:
+            # Blocks that gained points; their smallest id is unchanged by appends
+            added = aliased(infection)
+            conditions.append(block.in_(
+                select(block_of(added)).where(
+                    added.id > delta_after, added.id <= last_id, *date_conditions(added, start, end)
+                )
+            ))
+        query = select(
+            func.min(infection.id),
+            func.avg(infection.latitude),
+            func.avg(infection.longitude),
+            func.max(infection.infection_level),
+            func.max(infection.date_recorded),
+            func.count()
+        ).where(*conditions).group_by(block)
+    
+    if limit is not None:
+        query = query.limit(limit + 1)
+    
+    rows = db.session.execute(query).all() if delta_after != last_id else []
+    return last_id, rows
+
+@bp.route('/api/clusters')
+def get_infection_clusters():
+    """
+    API endpoint to get clustered infection data for the map
+    
+    Answered from the cluster index (see clusters.py), so the cost depends on the
+    viewport rather than on the number of infection points.
+    
+    Query parameters:
+        zoom: Map zoom level (required)
+        bbox: Optional viewport as "west,south,east,north"
+        start, end: Optional inclusive date range as YYYY-MM-DD. The index has
+            no dates, so the points of a date range are clustered on the fly
+            (from the worker's snapshot, see snapshot.py, unless the range
+            reaches archived points).
+    """
+    try:
+        bbox = parse_bbox(request.args['bbox']) if 'bbox' in request.args else None
+        zoom = request.args.get('zoom', type=int)
+        if zoom is None:
+            raise ValueError("zoom is required")
+        start, end = parse_date_range(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    state = get_dataset_state()
+    etag = f'clusters-{state.version}'
+    cached = not_modified(etag, state.updated_date)
+    if cached is not None:
+        return cached
+    
+    snapshot = None if start is None and end is None else snapshot_for(start, end, state)
+    if start is None and end is None:
+        clusters = get_clusters(bbox, zoom)
+    elif snapshot is not None:
+        index = snapshot.select(bbox, start, end)
+        clusters = cluster_points(snapshot.lat[index], snapshot.lng[index], snapshot.level[index], zoom)
+    else:
+        infection = infection_source(start, end)
+        rows = db.session.execute(
+            select(infection.latitude, infection.longitude, infection.infection_level)
+            .where(*bbox_conditions(infection, bbox), *date_conditions(infection, start, end))
+        ).all()
+        clusters = cluster_points(*zip(*rows), zoom) if rows else []
+    
+    response = jsonify(clusters)
+    return set_validators(response, etag, state.updated_date)
+
+@bp.route('/api/pattern_analysis')
+def pattern_analysis():
+    """
+    API endpoint with spatial pattern statistics of the infections
+    
+    Returns kernel density peaks, Getis-Ord Gi* hot and cold spots and the
+    Clark-Evans nearest-neighbour ratio (see patterns.py). Results are cached
+    per dataset version and parameters.
+    
+    Optional query parameters:
+        bbox: Viewport as "west,south,east,north"; the analysis extent, and only
+            points inside are analyzed. Defaults to the extent of the points.
+        start, end: Inclusive date range as YYYY-MM-DD
+        bandwidth: Kernel bandwidth and Gi* distance band in km (default: Scott's rule)
+    """
+    try:
+        bbox = parse_bbox(request.args['bbox']) if 'bbox' in request.args else None
+        start, end = parse_date_range(request.args)
+        bandwidth = float(request.args['bandwidth']) if 'bandwidth' in request.args else None
+        if bandwidth is not None and not (math.isfinite(bandwidth) and bandwidth > 0):
+            raise ValueError("bandwidth must be a positive number")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    state = get_dataset_state()
+    etag = f'pattern_analysis-{state.version}'
+    cached = not_modified(etag, state.updated_date)
+    if cached is not None:
+        return cached
+    
+    # Viewports differing by less than a few meters share an entry
+    cache = get_analysis_cache()
+    params = {'bbox': bbox and [round(value, 5) for value in bbox], 'bandwidth': bandwidth,
+              'start': start and start.isoformat(), 'end': end and end.isoformat()}
+    body = cache.get(state.version, params)
+    if body is None:
+        snapshot = snapshot_for(start, end, state)
+        if snapshot is not None:
+            index = snapshot.select(bbox, start, end)
+            lats, lngs, levels = snapshot.lat[index], snapshot.lng[index], snapshot.level[index]
+        else:
+            infection = infection_source(start, end)
+            rows = db.session.execute(
+                select(infection.latitude, infection.longitude, infection.infection_level)
+                .where(*bbox_conditions(infection, bbox), *date_conditions(infection, start, end))
+            ).all()
+            lats, lngs, levels = zip(*rows) if rows else ([], [], [])
         
-        dates[date_str]['count'] += 1
-        dates[date_str]['total_level'] += infection.infection_level
+        result = analyze_patterns(lats, lngs, levels, bbox=bbox, bandwidth_km=bandwidth)
+        body = current_app.json.dumps(result).encode()
+        cache.put(state.version, params, body)
+        cache_status = 'MISS'
+    else:
+        cache_status = 'HIT'
     
-    trend_data = [{
-        'date': date,
-        'count': data['count'],
-        'avg_level': data['total_level'] / data['count'] if data['count'] > 0 else 0
-    } for date, data in dates.items()]
+    response = Response(body, mimetype='application/json', headers={'X-Cache': cache_status})
+    return set_validators(response, etag, state.updated_date)
+
+@bp.route('/api/infection_data/export')
+def export_infection_data():
+    """
+    API endpoint to stream infection data in bulk
     
-    # Sort by date
-    trend_data.sort(key=lambda x: x['date'])
+    Query parameters:
+        format: ndjson (default), geojson or columnar (binary typed-array batches,
+            see export.py)
+        bbox: Optional "west,south,east,north" filter
+        start, end: Optional inclusive date range as YYYY-MM-DD; ranges reaching
+            back before the retained months include archived points
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
     
-    return jsonify(trend_data)
+    try:
+        bbox = parse_bbox(request.args['bbox']) if 'bbox' in request.args else None
+        start, end = parse_date_range(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    infection = infection_source(start, end)
+    query = select(
+        infection.id,
+        infection.latitude,
+        infection.longitude,
+        infection.infection_level,
+        infection.date_recorded
+    ).where(
+        *bbox_conditions(infection, bbox), *date_conditions(infection, start, end)
+    ).order_by(infection.id)
+    
+    stream = STREAM_ENCODERS[export_format](iter_batches(query))
+    return Response(stream_with_context(stream), mimetype=EXPORT_FORMATS[export_format])
 
-@app.route('/api/predict', methods=['POST'])
+@bp.route('/api/infection_data/import', methods=['POST'])
+def import_infection_data():
+    """
+    API endpoint to bulk import infection observations
+    
+    Accepts a multipart upload in the 'file' field or the raw request body.
+    
+    Query parameters:
+        format: csv, ndjson or geojson (default: from the file name or Content-Type)
+    """
+    from ingest import IMPORT_FORMATS, detect_format, import_infections
+    
+    upload = request.files.get('file')
+    if upload is not None:
+        stream = upload.stream
+        import_format = request.args.get('format') or detect_format(upload.filename, upload.mimetype)
+    else:
+        stream = request.stream
+        import_format = request.args.get('format') or detect_format(mimetype=request.mimetype)
+    
+    if import_format not in IMPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(IMPORT_FORMATS)}"}), 400
+    
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    result = import_infections(text, import_format)
+    return jsonify(result), 400 if result['error'] and not result['rows'] else 200
+
+@bp.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def heatmap_tile(z, x, y):
+    """Infection heatmap tile in the web mercator z/x/y scheme"""
+    if not 0 <= z <= MAX_TILE_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        return jsonify({"error": "Tile out of range"}), 404
+    
+    # Cached tiles are revalidated on every use, since new infections replace them
+    tile = get_tile(z, x, y)
+    if isinstance(tile, str):
+        tile = os.path.abspath(tile)
+    return send_file(tile, mimetype='image/png', max_age=0)
+
+@bp.route('/api/trend_data')
+def get_trend_data():
+    """
+    API endpoint to get trend data for visualization
+    
+    Optional query parameters:
+        start, end: Inclusive date range as YYYY-MM-DD
+        granularity: day (default), week or month
+        image_id: Only include points detected in this image
+    """
+    try:
+        start, end = parse_date_range(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        return jsonify({"error": f"granularity must be one of {', '.join(GRANULARITIES)}"}), 400
+    
+    image_id = request.args.get('image_id', type=int)
+    
+    # Rollups change only with the infection data
+    state = get_dataset_state()
+    etag = f'trend_data-{state.version}'
+    cached = not_modified(etag, state.updated_date)
+    if cached is not None:
+        return cached
+    
+    return set_validators(jsonify(trend(start, end, granularity, image_id)), etag, state.updated_date)
+
+@bp.route('/api/predict', methods=['POST'])
 def predict():
     """API endpoint to get infection spread prediction using Cellular Automata"""
-    data = request.json
+    from cellular_automata import predict_spread
+    from ensemble import predict_ensemble
     
-    # Get current infection data from database
-    infections = InfectionData.query.all()
-    current_state = [{
-        'lat': infection.latitude,
-        'lng': infection.longitude,
-        'level': infection.infection_level
-    } for infection in infections]
+    data = request.json
     
     # Get prediction parameters from request
-    days = data.get('days', 30)
+    members = data.get('ensemble', 1)  # Monte-Carlo realizations; 1 runs a single prediction
+    response_format = data.get('format', 'full')  # 'delta' lists each point once (see predict_spread)
+    
+    max_members = current_app.config["ENSEMBLE_MAX_MEMBERS"]
+    if isinstance(members, bool) or not isinstance(members, int) or not 1 <= members <= max_members:
+        return jsonify({"error": f"ensemble must be an integer between 1 and {max_members}"}), 400
+    if response_format not in ('full', 'delta'):
+        return jsonify({"error": "format must be full or delta"}), 400
+    if response_format == 'delta' and members > 1:
+        return jsonify({"error": "The delta format is only available for single predictions"}), 400
+    try:
+        days, cell_size, seed = parse_prediction_params(data)
+        start, end = parse_date_range(data)  # Seed from the infections recorded in this range
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Results are cached per dataset version, so any infection write invalidates them
+    cache = get_prediction_cache()
+    params = {'days': days, 'cell_size': cell_size, 'seed': seed, 'ensemble': members, 'format': response_format,
+              'start': start and start.isoformat(), 'end': end and end.isoformat()}
+    version = get_dataset_version()
+    body = cache.get(version, params)
+    if body is not None:
+        return Response(body, mimetype='application/json', headers={'X-Cache': 'HIT'})
+    
+    # Get current infection data from database
+    current_state = load_current_state(start, end)
     
     # Generate prediction using cellular automata
-    prediction = predict_spread(current_state, days)
+    if members > 1:
+        prediction = predict_ensemble(current_state, days, members, cell_size=cell_size, seed=seed,
+                                      workers=current_app.config["ENSEMBLE_WORKERS"])
+    else:
+        prediction = predict_spread(current_state, days, cell_size=cell_size, seed=seed,
+                                    delta=response_format == 'delta')
+    body = current_app.json.dumps(prediction).encode()
+    
+    # Only cache if no write landed while the prediction was computed
+    if get_dataset_version() == version:
+        cache.put(version, params, body)
+    
+    return Response(body, mimetype='application/json', headers={'X-Cache': 'MISS'})
+
+@bp.route('/api/predict/stream', methods=['POST'])
+def predict_stream():
+    """
+    API endpoint streaming a prediction as newline-delimited JSON events
+    
+    Takes the parameters of /api/predict except ensemble and format. Every
+    timeframe is sent as soon as the simulation reaches its day (see
+    cellular_automata.stream_prediction); the start event carries the stream_id
+    accepted by /api/predict/stream/<stream_id>/cancel. Closing the connection
+    also stops the simulation.
+    """
+    from cellular_automata import stream_prediction
+    
+    data = request.json or {}
+    try:
+        days, cell_size, seed = parse_prediction_params(data)
+        start, end = parse_date_range(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    current_state = load_current_state(start, end)
+    
+    stream_id = uuid.uuid4().hex
+    cancelled = threading.Event()
+    with _prediction_streams_lock:
+        _prediction_streams[stream_id] = cancelled
+    
+    def generate():
+        try:
+            for event in stream_prediction(current_state, days, cell_size=cell_size, seed=seed, cancelled=cancelled):
+                if event['type'] == 'start':
+                    event['stream_id'] = stream_id
+                yield json.dumps(event, separators=(',', ':')) + '\n'
+        finally:
+            with _prediction_streams_lock:
+                _prediction_streams.pop(stream_id, None)
     
-    return jsonify(prediction)
+    # X-Accel-Buffering keeps nginx from holding frames back
+    return Response(generate(), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-@app.route('/api/model_info')
+@bp.route('/api/predict/stream/<stream_id>/cancel', methods=['POST'])
+def cancel_prediction_stream(stream_id):
+    """
+    API endpoint to stop a streamed prediction
+    
+    Streams are tracked per worker process, so with several workers the cancel
+    request may reach one that does not run the stream (404); clients should
+    also close the stream's connection.
+    """
+    with _prediction_streams_lock:
+        cancelled = _prediction_streams.get(stream_id)
+    if cancelled is None:
+        return jsonify({"error": "No running prediction stream with this id"}), 404
+    cancelled.set()
+    return jsonify({'stream_id': stream_id, 'cancelled': True}), 202
+
+@bp.route('/api/predict/cache')
+def prediction_cache_stats():
+    """API endpoint with hit/miss statistics of the prediction cache"""
+    return jsonify(get_prediction_cache().stats())
+
+@bp.route('/api/jobs/<int:job_id>')
+def job_status(job_id):
+    """API endpoint to get the status of an image processing job"""
+    from jobs import job_to_dict
+    
+    job = db.get_or_404(ProcessingJob, job_id)
+    data = job_to_dict(job)
+    
+    image = db.session.get(ImageData, job.image_id)
+    data['processed'] = image.processed
+    data['result_path'] = image.result_path
+    data['previews_url'] = url_for('.image_previews', image_id=image.id)
+    
+    return jsonify(data)
+
+@bp.route('/api/batches/<int:batch_id>')
+def batch_status(batch_id):
+    """API endpoint with the overall and per-file progress of an upload batch"""
+    from jobs import batch_to_dict
+    
+    batch = db.get_or_404(UploadBatch, batch_id)
+    return jsonify(batch_to_dict(batch))
+
+@bp.route('/api/jobs/<int:job_id>/progress')
+def job_progress(job_id):
+    """API endpoint to poll the progress of an image processing job"""
+    job = db.get_or_404(ProcessingJob, job_id)
+    return jsonify({'id': job.id, 'status': job.status, 'progress': job.progress})
+
+@bp.route('/api/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_processing_job(job_id):
+    """API endpoint to re-queue a failed image processing job"""
+    from jobs import retry_job
+    
+    job = db.get_or_404(ProcessingJob, job_id)
+    if not retry_job(job):
+        return jsonify({"error": f"Job is {job.status}, only failed or timed out jobs can be retried"}), 409
+    
+    return jsonify({'job_id': job.id, 'status_url': url_for('.job_status', job_id=job.id)}), 202
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Request, database and model timings in the Prometheus text format"""
+    if not metrics.enabled():
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/api/model_info')
 def model_info():
     """API endpoint to get information about the ML models"""
-    return jsonify(get_model_info())
+    from ml_models import get_model_info
+    
+    models = get_model_info()
+    
+    # Load statistics are per worker, so they are part of the tag as well
+    state = get_dataset_state(PREDICTION_MODELS)
+    loaded = sum(1 for model in models if model['loaded'])
+    etag = f'model_info-{state.version}-{loaded}'
+    cached = not_modified(etag, state.updated_date)
+    if cached is not None:
+        return cached
+    
+    return set_validators(jsonify(models), etag, state.updated_date)
 
 # Sample data route for development purposes
-@app.route('/api/sample_data', methods=['POST'])
+@bp.route('/api/sample_data', methods=['POST'])
 def add_sample_data():
     """Add sample infection data for development and testing"""
-    if not app.debug:
+    from ingest import insert_infections
+    
+    if not current_app.debug:
         return jsonify({"error": "This endpoint is only available in debug mode"}), 403
     
     # Add 20 sample infection points around a center point
     center_lat = request.json.get('lat', 0)
     center_lng = request.json.get('lng', 0)
     
-    for i in range(20):
-        # Create random points within ~5km of center
-        lat_offset = (np.random.random() - 0.5) * 0.1
-        lng_offset = (np.random.random() - 0.5) * 0.1
-        
-        new_infection = InfectionData(
-            latitude=center_lat + lat_offset,
-            longitude=center_lng + lng_offset,
-            infection_level=np.random.random(),
-            date_recorded=datetime.utcnow()
-        )
-        db.session.add(new_infection)
-    
+    # Create random points within ~5km of center
+    insert_infections(
+        center_lat + (np.random.random(20) - 0.5) * 0.1,
+        center_lng + (np.random.random(20) - 0.5) * 0.1,
+        np.random.random(20)
+    )
     db.session.commit()
     return jsonify({"status": "Sample data added"})
 
-@app.route('/uploads/<filename>')
+@bp.route('/uploads/<filename>')
 def uploaded_file(filename):
-    """Serve uploaded files"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """
+    Serve uploaded files
+    
+    Range requests are answered with 206 responses. Originals are stored under
+    their content hash and never change; derived files such as result masks are
+    revalidated with their ETag.
+    """
+    from uploads import is_content_addressed
+    
+    response = send_from_directory(os.path.abspath(current_app.config['UPLOAD_FOLDER']), filename, max_age=0)
+    if is_content_addressed(filename):
+        set_immutable(response)
+    return response
+
+@bp.route('/previews/<path:path>')
+def preview_file(path):
+    """Thumbnail or pyramid tile of an uploaded image (see previews.py)"""
+    if not path.endswith('.png') or not current_app.config['PREVIEW_FOLDER']:
+        return jsonify({"error": "Not found"}), 404
+    
+    # Every pyramid version has its own directory, so a URL's content never changes
+    return set_immutable(send_from_directory(os.path.abspath(current_app.config['PREVIEW_FOLDER']), path))
+
+@bp.route('/api/images/<int:image_id>/previews')
+def image_previews(image_id):
+    """
+    API endpoint with the preview URLs of an uploaded image
+    
+    Returns the URL of the original and, for the image and its result mask, the
+    thumbnail and a {z}/{x}/{y} tile URL template with the pyramid size, or null
+    if no pyramid was rendered (e.g. for PNG or JPEG uploads, which browsers show
+    directly).
+    """
+    from previews import PREVIEW_KINDS, get_manifest
+    
+    image = db.get_or_404(ImageData, image_id)
+    name = os.path.splitext(image.filename)[0]
+    folder = current_app.config['PREVIEW_FOLDER']
+    
+    data = {
+        'image_id': image.id,
+        'original': url_for('.uploaded_file', filename=image.filename)
+    }
+    for kind in PREVIEW_KINDS:
+        manifest = get_manifest(folder, name, kind) if folder else None
+        if manifest is None:
+            data[kind] = None
+            continue
+        base = url_for('.preview_file', path=f"{manifest['directory']}/thumbnail.png")[:-len('thumbnail.png')]
+        data[kind] = {
+            'width': manifest['width'],
+            'height': manifest['height'],
+            'tile_size': manifest['tile_size'],
+            'max_zoom': manifest['max_zoom'],
+            'thumbnail': base + 'thumbnail.png',
+            'tiles': base + '{z}/{x}/{y}.png'
+        }
+    
+    # Manifests change when an image is reprocessed
+    response = jsonify(data)
+    response.cache_control.no_cache = True
+    return response
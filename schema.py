@@ -0,0 +1,89 @@
+import logging
+
+from sqlalchemy import inspect, select, update, cast, func, Integer
+from sqlalchemy.schema import CreateColumn
+
+from app import db
+from models import InfectionData
+from rollups import ensure_rollups
+from clusters import ensure_clusters
+from model_registry import ensure_default_models
+from spatial import GRID_CELL_SIZE, GRID_COLS
+
+# db.create_all() only creates missing tables. This module brings tables created by
+# an older version of the app up to date: it adds new (nullable) columns and indexes
+# and fills in derived columns for existing rows.
+
+logger = logging.getLogger(__name__)
+
+
+def _add_missing_columns():
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                    connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {ddl}')
+                    logger.info(f"Added column {table.name}.{column.name}")
+
+
+def _create_missing_indexes():
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def _floor(expression):
+    """Portable SQL floor for the non-negative grid offsets used here"""
+    if db.engine.dialect.name == 'sqlite':
+        # CAST truncates toward zero, which equals floor for non-negative values
+        return cast(expression, Integer)
+    return cast(func.floor(expression), Integer)
+
+
+def backfill_grid_cells():
+    """Compute InfectionData.grid_cell for rows inserted before the column existed"""
+    # A bulk UPDATE bumps the dataset version even if it matches nothing, which
+    # would invalidate every cached result on each start
+    missing = db.session.execute(
+        select(InfectionData.id).where(InfectionData.grid_cell.is_(None)).limit(1)
+    ).first()
+    if missing is None:
+        return
+
+    row = _floor((InfectionData.latitude + 90) / GRID_CELL_SIZE)
+    col = _floor((InfectionData.longitude + 180) / GRID_CELL_SIZE)
+    result = db.session.execute(
+        update(InfectionData)
+        .where(InfectionData.grid_cell.is_(None))
+        .values(grid_cell=row * GRID_COLS + col)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    if result.rowcount:
+        logger.info(f"Backfilled grid cells for {result.rowcount} infection points")
+
+
+def init_database():
+    """Create missing tables and bring the schema up to date (see setup_db.py)"""
+    db.create_all()
+    upgrade_schema()
+
+
+def upgrade_schema():
+    """Bring the database schema and derived columns up to date"""
+    _add_missing_columns()
+    backfill_grid_cells()
+
+    # Indexes last, so backfilled values don't pay for index maintenance row by row
+    _create_missing_indexes()
+    ensure_rollups()
+    ensure_clusters()
+    ensure_default_models()
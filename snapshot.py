@@ -0,0 +1,202 @@
+import logging
+import threading
+from datetime import datetime, time, timedelta
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+
+from app import db
+from models import InfectionData
+from spatial import GRID_COLS, grid_cells
+from versioning import get_dataset_state
+from archive import infection_source
+
+# Per-worker columnar copy of the hot InfectionData table. Read endpoints filter
+# and aggregate NumPy arrays instead of building ORM rows or dictionaries for
+# every point on every request.
+#
+# A snapshot is immutable and tagged with the dataset version it was read at.
+# Each use compares that tag with the current version (see versioning.py): if
+# rows were only appended since, the rows with an id above the snapshot's last id
+# are read and appended into a new snapshot; if rows were updated or deleted, or
+# the database went back in time, the table is read again. Requests keep using
+# the snapshot they started with while a refresh replaces it, and workers never
+# hold stale data for longer than a version check, since every write bumps the
+# version in its own transaction.
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip while loading
+LOAD_BATCH_SIZE = 50000
+
+
+class InfectionSnapshot:
+    """InfectionData columns as parallel arrays, ordered by id"""
+
+    __slots__ = ('version', 'last_id', 'id', 'lat', 'lng', 'level', 'date', 'grid_cell')
+
+    def __init__(self, version, last_id, ids, lats, lngs, levels, dates):
+        self.version = version
+        self.last_id = last_id
+        self.id = ids
+        self.lat = lats
+        self.lng = lngs
+        self.level = levels
+        self.date = dates
+        self.grid_cell = grid_cells(lats, lngs)
+
+    def __len__(self):
+        return self.id.size
+
+    def select(self, bbox=None, start=None, end=None, after=None):
+        """
+        Indices of the rows matching the filters of the read endpoints
+
+        Args:
+            bbox: Tuple (west, south, east, north), or None
+            start, end: Inclusive dates, or None for an open end
+            after: Only rows with a larger id, or None
+
+        Returns:
+            Ascending index array (so the rows stay ordered by id)
+        """
+        mask = np.ones(self.id.size, dtype=bool)
+        if bbox is not None:
+            west, south, east, north = bbox
+            mask &= (self.lat >= south) & (self.lat <= north) & (self.lng >= west) & (self.lng <= east)
+        if start is not None:
+            mask &= self.date >= np.datetime64(datetime.combine(start, time.min))
+        if end is not None:
+            mask &= self.date < np.datetime64(datetime.combine(end + timedelta(days=1), time.min))
+        if after is not None:
+            mask &= self.id > after
+        return np.flatnonzero(mask)
+
+    def blocks(self, index, factor):
+        """Thinning block (see spatial.thinning_factor) of the given rows"""
+        cells = self.grid_cell[index]
+        return (cells // GRID_COLS // factor) * GRID_COLS + (cells % GRID_COLS) // factor
+
+    def merge_blocks(self, index, factor, blocks=None):
+        """
+        Merge rows falling in the same block of factor x factor grid cells
+
+        Args:
+            index: Rows to merge, ascending
+            factor: Thinning factor
+            blocks: Optional blocks to keep, e.g. those that gained rows
+
+        Returns:
+            Tuple of arrays (id, lat, lng, level, date, count), one entry per block
+            ordered by its smallest id. The smallest id identifies a block, the
+            coordinates are averaged and level and date are the maximum.
+        """
+        block = self.blocks(index, factor)
+        if blocks is not None:
+            keep = np.isin(block, blocks)
+            index, block = index[keep], block[keep]
+
+        unique, first, inverse = np.unique(block, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse, minlength=unique.size)
+        lats = np.bincount(inverse, weights=self.lat[index], minlength=unique.size) / np.maximum(counts, 1)
+        lngs = np.bincount(inverse, weights=self.lng[index], minlength=unique.size) / np.maximum(counts, 1)
+        levels = np.full(unique.size, -np.inf)
+        np.maximum.at(levels, inverse, self.level[index])
+        dates = np.full(unique.size, np.datetime64('NaT'), dtype=self.date.dtype)
+        np.maximum.at(dates.view(np.int64), inverse, self.date[index].view(np.int64))
+
+        # Rows are ordered by id, so a block's first row has its smallest id
+        order = np.argsort(first, kind='stable')
+        return (self.id[index][first][order], lats[order], lngs[order], levels[order],
+                dates[order], counts[order])
+
+
+def _read_rows(after_id):
+    """Arrays (id, lat, lng, level, date) of the rows with an id above after_id"""
+    result = db.session.connection().execute(
+        select(
+            InfectionData.id, InfectionData.latitude, InfectionData.longitude,
+            InfectionData.infection_level, InfectionData.date_recorded
+        ).where(InfectionData.id > after_id).order_by(InfectionData.id)
+        .execution_options(stream_results=True, yield_per=LOAD_BATCH_SIZE)
+    )
+    batches = []
+    for partition in result.partitions():
+        ids, lats, lngs, levels, dates = zip(*partition)
+        batches.append((
+            np.array(ids, dtype=np.int64),
+            np.array(lats, dtype=np.float64),
+            np.array(lngs, dtype=np.float64),
+            np.array(levels, dtype=np.float64),
+            np.array(dates, dtype='datetime64[us]')
+        ))
+    if not batches:
+        return (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), np.empty(0),
+                np.empty(0, dtype='datetime64[us]'))
+    return tuple(np.concatenate(column) for column in zip(*batches))
+
+
+class SnapshotHolder:
+    """The current snapshot of an application, refreshed on use"""
+
+    def __init__(self):
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def get(self, state=None):
+        """
+        Snapshot of the current dataset version
+
+        Args:
+            state: DatasetState just read by the caller, saves reading it again
+        """
+        state = state or get_dataset_state()
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version == state.version:
+            return snapshot
+
+        with self.lock:
+            # Another thread may have refreshed while this one waited
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.version == state.version:
+                return snapshot
+
+            if snapshot is None or state.rewritten_version > snapshot.version or state.version < snapshot.version:
+                columns = _read_rows(0)
+                logger.info(f"Loaded infection snapshot of {columns[0].size} rows at version {state.version}")
+            else:
+                added = _read_rows(snapshot.last_id)
+                columns = tuple(np.concatenate(pair) for pair in zip(
+                    (snapshot.id, snapshot.lat, snapshot.lng, snapshot.level, snapshot.date), added
+                ))
+
+            # Rows committed after the version was read may be included; the next
+            # check then appends only what follows them, or reloads after a rewrite
+            last_id = int(columns[0][-1]) if columns[0].size else 0
+            snapshot = InfectionSnapshot(state.version, last_id, *columns)
+            self.snapshot = snapshot
+            return snapshot
+
+
+def get_snapshot(state=None):
+    """Current InfectionSnapshot of this worker"""
+    holder = current_app.extensions.get('infection_snapshot')
+    if holder is None:
+        holder = current_app.extensions.setdefault('infection_snapshot', SnapshotHolder())
+    return holder.get(state)
+
+
+def snapshot_for(start=None, end=None, state=None):
+    """
+    Snapshot able to answer a query over a date range
+
+    Returns:
+        InfectionSnapshot, or None if snapshots are disabled or the range reaches
+        archived rows (see archive.infection_source)
+    """
+    if not current_app.config["INFECTION_SNAPSHOT"]:
+        return None
+    if infection_source(start, end) is not InfectionData:
+        return None
+    return get_snapshot(state)
@@ -0,0 +1,133 @@
+import math
+import numpy as np
+from sqlalchemy import or_
+
+# Infection points are bucketed into a fixed lat/lng grid so viewport queries can use
+# an integer index instead of scanning the whole table. Cell ids are row-major:
+# grid_cell = row * GRID_COLS + col, with rows counted from -90 and cols from -180.
+
+GRID_CELL_SIZE = 0.01  # Degrees (~1.1km at the equator)
+GRID_ROWS = int(round(180 / GRID_CELL_SIZE))
+GRID_COLS = int(round(360 / GRID_CELL_SIZE))
+
+# Above this many grid rows a bounding box is filtered on latitude/longitude only
+MAX_RANGE_ROWS = 64
+
+# Below this zoom level points are thinned to one per screen block
+DETAIL_ZOOM = 12
+
+# Approximate size of a thinned block on screen, in pixels
+THINNING_PIXELS = 16
+
+
+def _row_col(lat, lng):
+    """Grid row and column of a single coordinate"""
+    row = min(max(int(math.floor((lat + 90) / GRID_CELL_SIZE)), 0), GRID_ROWS - 1)
+    col = min(max(int(math.floor((lng + 180) / GRID_CELL_SIZE)), 0), GRID_COLS - 1)
+    return row, col
+
+
+def grid_cell(lat, lng):
+    """
+    Grid cell id of a coordinate
+
+    Args:
+        lat: Latitude in degrees
+        lng: Longitude in degrees
+
+    Returns:
+        Integer cell id
+    """
+    row, col = _row_col(lat, lng)
+    return row * GRID_COLS + col
+
+
+def grid_cells(lats, lngs):
+    """Vectorized grid_cell for arrays of coordinates"""
+    row = np.floor((np.asarray(lats, dtype=np.float64) + 90) / GRID_CELL_SIZE).astype(np.int64)
+    col = np.floor((np.asarray(lngs, dtype=np.float64) + 180) / GRID_CELL_SIZE).astype(np.int64)
+    np.clip(row, 0, GRID_ROWS - 1, out=row)
+    np.clip(col, 0, GRID_COLS - 1, out=col)
+    return row * GRID_COLS + col
+
+
+def parse_bbox(value):
+    """
+    Parse a "west,south,east,north" bounding box (Leaflet's toBBoxString format)
+
+    Returns:
+        Tuple (west, south, east, north)
+
+    Raises:
+        ValueError: If the value is not four finite numbers with west <= east and
+            south <= north
+    """
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError("bbox must have four comma-separated values")
+    if not all(math.isfinite(part) for part in parts):
+        raise ValueError("bbox values must be finite numbers")
+
+    west, south, east, north = parts
+    if west > east or south > north:
+        raise ValueError("bbox must be west,south,east,north")
+
+    return west, south, east, north
+
+
+def cell_ranges(west, south, east, north):
+    """
+    Contiguous grid cell id ranges covering a bounding box, one per grid row
+
+    Returns:
+        List of (first_cell, last_cell) tuples, or None if the box spans too many
+        rows for a range query to be worthwhile
+    """
+    row0, col0 = _row_col(south, west)
+    row1, col1 = _row_col(north, east)
+    if row1 - row0 + 1 > MAX_RANGE_ROWS:
+        return None
+
+    return [(row * GRID_COLS + col0, row * GRID_COLS + col1) for row in range(row0, row1 + 1)]
+
+
+def bbox_conditions(model, bbox):
+    """
+    SQL conditions selecting the rows of a model inside a bounding box
+
+    Args:
+        model: Mapped class with latitude, longitude and grid_cell columns
+        bbox: Tuple (west, south, east, north), or None for no filtering
+
+    Returns:
+        List of conditions for Select.where()
+    """
+    if bbox is None:
+        return []
+
+    west, south, east, north = bbox
+    conditions = [
+        model.latitude.between(south, north),
+        model.longitude.between(west, east)
+    ]
+    ranges = cell_ranges(west, south, east, north)
+    if ranges is not None:
+        conditions.append(or_(*[
+            model.grid_cell.between(first, last) for first, last in ranges
+        ]))
+    return conditions
+
+
+def thinning_factor(zoom):
+    """
+    Number of grid cells per side merged into one point at a given zoom level
+
+    Returns:
+        Factor >= 1, or None when points should not be thinned
+    """
+    if zoom is None or zoom >= DETAIL_ZOOM:
+        return None
+
+    # Degrees covered by one pixel of a 256px web mercator tile at the equator
+    degrees_per_pixel = 360 / (256 * 2 ** zoom)
+    return max(1, int(THINNING_PIXELS * degrees_per_pixel / GRID_CELL_SIZE))
@@ -40,6 +40,14 @@ function initPredictionControls() {
         });
     }
     
+    // Set up cancel button of streamed predictions
+    const cancelButton = document.getElementById('cancel-prediction');
+    if (cancelButton) {
+        cancelButton.addEventListener('click', function() {
+            cancelPredictionStream();
+        });
+    }
+    
     // Set up play button
     const playButton = document.getElementById('play-prediction');
     if (playButton) {
@@ -71,6 +79,147 @@ function initPredictionControls() {
     }
 }
 
+/**
+ * Decode a base64 column of the delta format into a typed array
+ * @param {string} encoded - Base64 of the little-endian values
+ * @param {Function} ArrayType - Typed array constructor (Float64Array, Float32Array)
+ * @returns {TypedArray}
+ */
+function decodeColumn(encoded, ArrayType) {
+    const bytes = Uint8Array.from(atob(encoded), char => char.charCodeAt(0));
+    return new ArrayType(bytes.buffer);
+}
+
+/**
+ * Define a property computed on first access
+ */
+function defineLazy(target, name, build) {
+    Object.defineProperty(target, name, {
+        configurable: true,
+        enumerable: true,
+        get() {
+            const value = build();
+            Object.defineProperty(target, name, { value: value, enumerable: true });
+            return value;
+        }
+    });
+    return target;
+}
+
+/**
+ * Create a delta-format prediction around its point table
+ *
+ * Every timeframe shows the first `count` points of the table, with levels
+ * derived from each point's log-odds offset; point lists are only built when
+ * something reads them.
+ * @param {number} growthRate - Growth rate of the prediction
+ * @param {Object} columns - Typed arrays lat, lng and offset
+ * @returns {Object} Prediction with empty timeframes, lat, lng and levelAt(index, day)
+ */
+function createDeltaPrediction(growthRate, columns) {
+    const prediction = {
+        format: 'delta',
+        growthRate: growthRate,
+        lat: columns.lat,
+        lng: columns.lng,
+        offset: columns.offset,
+        timeframes: []
+    };
+    prediction.levelAt = (index, day) => 1 / (1 + Math.exp(-(prediction.growthRate * day + prediction.offset[index])));
+    
+    prediction.framePoints = frame => {
+        const points = new Array(frame.count);
+        for (let i = 0; i < frame.count; i++) {
+            points[i] = { lat: prediction.lat[i], lng: prediction.lng[i], level: prediction.levelAt(i, frame.day) };
+        }
+        return points;
+    };
+    prediction.addTimeframe = frame => {
+        prediction.timeframes.push(
+            defineLazy({ day: frame.day, count: frame.count }, 'points', () => prediction.framePoints(frame))
+        );
+    };
+    return prediction;
+}
+
+/**
+ * Expand a delta-encoded prediction (format 'delta', see cellular_automata.py)
+ *
+ * The point table is decoded into typed arrays once. Full-format predictions
+ * are returned unchanged.
+ * @param {Object} data - Response of /api/predict
+ * @returns {Object} Prediction with timeframes, lat, lng and levelAt(index, day)
+ */
+function decodePrediction(data) {
+    if (data.format !== 'delta') {
+        return data;
+    }
+    
+    const prediction = createDeltaPrediction(data.growth_rate, {
+        lat: decodeColumn(data.columns.lat, Float64Array),
+        lng: decodeColumn(data.columns.lng, Float64Array),
+        offset: decodeColumn(data.columns.offset, Float32Array)
+    });
+    data.timeframes.forEach(prediction.addTimeframe);
+    defineLazy(prediction, 'initial_state', () => prediction.framePoints({ day: 0, count: data.observed }));
+    defineLazy(prediction, 'final_state', () => prediction.framePoints(data.final));
+    
+    return prediction;
+}
+
+/**
+ * Start a prediction from the start event of /api/predict/stream
+ * @param {Object} event - Start event with growth_rate and observed
+ * @returns {Object} Delta-format prediction without timeframes yet
+ */
+function startStreamedPrediction(event) {
+    const prediction = createDeltaPrediction(event.growth_rate, {
+        lat: new Float64Array(0),
+        lng: new Float64Array(0),
+        offset: new Float32Array(0)
+    });
+    prediction.streaming = true;
+    prediction.days = event.days;
+    defineLazy(prediction, 'initial_state', () => prediction.framePoints({ day: 0, count: event.observed }));
+    return prediction;
+}
+
+/**
+ * Append the points sent with a frame or end event to the point table
+ */
+function appendStreamedPoints(prediction, columns) {
+    const append = (current, encoded, ArrayType) => {
+        const added = decodeColumn(encoded, ArrayType);
+        if (added.length === 0) {
+            return current;
+        }
+        const merged = new ArrayType(current.length + added.length);
+        merged.set(current);
+        merged.set(added, current.length);
+        return merged;
+    };
+    prediction.lat = append(prediction.lat, columns.lat, Float64Array);
+    prediction.lng = append(prediction.lng, columns.lng, Float64Array);
+    prediction.offset = append(prediction.offset, columns.offset, Float32Array);
+}
+
+/**
+ * Add a streamed frame event to a prediction as its latest timeframe
+ */
+function addStreamedFrame(prediction, event) {
+    appendStreamedPoints(prediction, event.columns);
+    prediction.addTimeframe(event);
+}
+
+/**
+ * Complete a streamed prediction with its end event
+ */
+function finishStreamedPrediction(prediction, event) {
+    appendStreamedPoints(prediction, event.columns);
+    prediction.streaming = false;
+    defineLazy(prediction, 'final_state', () => prediction.framePoints(event.final));
+}
+
 /**
  * Update the prediction time slider based on available timeframes
  */
@@ -147,6 +296,18 @@ function updatePredictionSummary() {
     // Get final timeframe
     const finalTimeframe = app.data.predictions.timeframes[app.data.predictions.timeframes.length - 1];
     
+    // Ensemble predictions report the spread of infected cells across runs
+    let ensembleSummary = '';
+    if (app.data.predictions.ensemble && finalTimeframe.infected_cells) {
+        const band = finalTimeframe.infected_cells;
+        ensembleSummary = `
+            <div class="summary-item">
+                <span class="summary-label">Infected Cells (${app.data.predictions.ensemble.members} runs):</span>
+                <span class="summary-value">${Math.round(band.p50)} (90%: ${Math.round(band.p05)}-${Math.round(band.p95)})</span>
+            </div>
+        `;
+    }
+    
     // Update prediction summary HTML
     const predictionSummary = document.getElementById('prediction-summary');
     if (predictionSummary) {
@@ -172,6 +333,7 @@ function updatePredictionSummary() {
                 <span class="summary-label">Affected Area:</span>
                 <span class="summary-value">${areaKm.toFixed(2)} km²</span>
             </div>
+            ${ensembleSummary}
         `;
     }
 }
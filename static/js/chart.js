@@ -119,23 +119,26 @@ function initCharts() {
         type: 'scatter',
         data: {
             datasets: [{
-                label: 'Infection Distribution',
+                label: 'Hot and Cold Spots (Getis-Ord Gi*)',
                 data: [],
                 backgroundColor: function(context) {
-                    const value = context.raw ? context.raw.z : 0;
-                    if (value < 0.3) return 'rgba(39, 174, 96, 0.7)';
-                    if (value < 0.7) return 'rgba(243, 156, 18, 0.7)';
-                    return 'rgba(192, 57, 43, 0.7)';
+                    // Hot spots red to yellow, cold spots blue, by confidence
+                    const point = context.raw;
+                    if (!point) return 'rgba(255, 255, 255, 0.3)';
+                    if (point.type === 'cold') return 'rgba(41, 128, 185, 0.7)';
+                    if (point.confidence >= 99) return 'rgba(192, 57, 43, 0.7)';
+                    if (point.confidence >= 95) return 'rgba(243, 156, 18, 0.7)';
+                    return 'rgba(241, 196, 15, 0.7)';
                 },
                 borderColor: 'rgba(255, 255, 255, 0.3)',
                 borderWidth: 1,
                 pointRadius: function(context) {
-                    const value = context.raw ? context.raw.z : 0;
-                    return 5 + (value * 10); // 5-15px based on severity
+                    const z = context.raw ? Math.abs(context.raw.z) : 0;
+                    return 3 + Math.min(z, 6) * 2; // 3-15px based on the z-score
                 },
                 pointHoverRadius: function(context) {
-                    const value = context.raw ? context.raw.z : 0;
-                    return 7 + (value * 12); // 7-19px based on severity
+                    const z = context.raw ? Math.abs(context.raw.z) : 0;
+                    return 5 + Math.min(z, 6) * 2;
                 }
             }]
         },
@@ -173,7 +176,7 @@ function initCharts() {
             plugins: {
                 title: {
                     display: true,
-                    text: 'Spatial Distribution of G. boninense Infections',
+                    text: 'Infection Hot Spots of G. boninense',
                     color: 'rgba(255, 255, 255, 0.9)',
                     font: {
                         size: 16,
@@ -192,7 +195,9 @@ function initCharts() {
                             return [
                                 `Latitude: ${point.y.toFixed(4)}`,
                                 `Longitude: ${point.x.toFixed(4)}`,
-                                `Severity: ${(point.z * 100).toFixed(1)}%`
+                                `${point.type === 'hot' ? 'Hot' : 'Cold'} spot (${point.confidence}% confidence)`,
+                                `Gi* z-score: ${point.z.toFixed(2)}`,
+                                `Infections in cell: ${point.count}`
                             ];
                         }
                     }
@@ -228,18 +233,21 @@ function updateTrendChart() {
 }
 
 /**
- * Update the pattern chart with current data
+ * Update the pattern chart with the loaded pattern analysis
  */
 function updatePatternChart() {
-    if (!app.data.infections || !app.charts.pattern) {
+    if (!app.data.patterns || !app.charts.pattern) {
         return;
     }
     
     // Prepare data for scatter plot
-    const scatterData = app.data.infections.map(infection => ({
-        x: infection.lng,
-        y: infection.lat,
-        z: infection.level // Used for coloring and sizing
+    const scatterData = app.data.patterns.hotspots.map(hotspot => ({
+        x: hotspot.lng,
+        y: hotspot.lat,
+        z: hotspot.z, // Used for coloring and sizing
+        type: hotspot.type,
+        confidence: hotspot.confidence,
+        count: hotspot.count
     }));
     
     // Update chart data
@@ -303,88 +311,54 @@ function updateTrendSummary() {
 }
 
 /**
- * Update the pattern analysis with spatial statistics
+ * Update the pattern analysis with the spatial statistics from the server
  */
 function updatePatternAnalysis() {
-    if (!app.data.infections || app.data.infections.length === 0) {
+    const patternAnalysis = document.getElementById('pattern-analysis');
+    const patterns = app.data.patterns;
+    if (!patterns || patterns.count === 0) {
+        patternAnalysis.innerHTML = '<p>No infections to analyze in this area</p>';
         return;
     }
     
-    // Calculate spatial statistics
-    
-    // Calculate center of mass
-    let totalLat = 0;
-    let totalLng = 0;
-    let totalWeight = 0;
-    
-    app.data.infections.forEach(infection => {
-        const weight = infection.level;
-        totalLat += infection.lat * weight;
-        totalLng += infection.lng * weight;
-        totalWeight += weight;
-    });
-    
-    const centerLat = (totalWeight > 0) ? totalLat / totalWeight : 0;
-    const centerLng = (totalWeight > 0) ? totalLng / totalWeight : 0;
-    
-    // Calculate average distance from center (spread)
-    let totalDistance = 0;
-    
-    app.data.infections.forEach(infection => {
-        const dLat = infection.lat - centerLat;
-        const dLng = infection.lng - centerLng;
-        const distance = Math.sqrt(dLat * dLat + dLng * dLng);
-        totalDistance += distance;
-    });
-    
-    const avgDistance = app.data.infections.length > 0 ? 
-        totalDistance / app.data.infections.length : 0;
-    
-    // Calculate approximate area (convert to km²)
-    // 1 degree is approximately 111 km at the equator
-    const areaKm = Math.PI * Math.pow(avgDistance * 111, 2);
-    
-    // Calculate clustering index (ratio of points within close proximity)
-    const proximityThreshold = 0.05; // ~5.5 km
-    let closeProximityCount = 0;
-    
-    for (let i = 0; i < app.data.infections.length; i++) {
-        for (let j = i + 1; j < app.data.infections.length; j++) {
-            const dLat = app.data.infections[i].lat - app.data.infections[j].lat;
-            const dLng = app.data.infections[i].lng - app.data.infections[j].lng;
-            const distance = Math.sqrt(dLat * dLat + dLng * dLng);
-            
-            if (distance < proximityThreshold) {
-                closeProximityCount++;
-            }
-        }
-    }
-    
-    const maxPossiblePairs = (app.data.infections.length * (app.data.infections.length - 1)) / 2;
-    const clusteringIndex = maxPossiblePairs > 0 ? 
-        closeProximityCount / maxPossiblePairs : 0;
+    const nn = patterns.nearest_neighbour;
+    const spreadPattern = nn ? nn.pattern.charAt(0).toUpperCase() + nn.pattern.slice(1) : 'Single point';
+    const hot = patterns.hotspot_counts.hot;
+    const cold = patterns.hotspot_counts.cold;
+    const peak = patterns.density.peaks[0];
     
     // Update pattern analysis HTML
-    const patternAnalysis = document.getElementById('pattern-analysis');
     patternAnalysis.innerHTML = `
         <h3>Spatial Pattern Analysis</h3>
         <div class="summary-item">
             <span class="summary-label">Infection Center:</span>
-            <span class="summary-value">${centerLat.toFixed(4)}, ${centerLng.toFixed(4)}</span>
+            <span class="summary-value">${patterns.center.lat.toFixed(4)}, ${patterns.center.lng.toFixed(4)}</span>
         </div>
         <div class="summary-item">
-            <span class="summary-label">Affected Area:</span>
-            <span class="summary-value">${areaKm.toFixed(2)} km²</span>
+            <span class="summary-label">Analyzed Area:</span>
+            <span class="summary-value">${patterns.extent.area_km2.toFixed(2)} km² (${patterns.count} infections)</span>
+        </div>
+        <div class="summary-item">
+            <span class="summary-label">Peak Density:</span>
+            <span class="summary-value">
+                ${patterns.density.max.toFixed(1)} / km²${peak ? ` at ${peak.lat.toFixed(4)}, ${peak.lng.toFixed(4)}` : ''}
+            </span>
         </div>
         <div class="summary-item">
-            <span class="summary-label">Clustering Index:</span>
-            <span class="summary-value">${(clusteringIndex * 100).toFixed(1)}%</span>
+            <span class="summary-label">Hot Spot Cells (95%):</span>
+            <span class="summary-value text-danger">${hot[95]}</span>
+        </div>
+        <div class="summary-item">
+            <span class="summary-label">Cold Spot Cells (95%):</span>
+            <span class="summary-value text-success">${cold[95]}</span>
+        </div>
+        <div class="summary-item">
+            <span class="summary-label">Nearest Neighbour Ratio:</span>
+            <span class="summary-value">${nn ? `${nn.ratio.toFixed(2)} (z = ${nn.z.toFixed(1)})` : '-'}</span>
         </div>
         <div class="summary-item">
             <span class="summary-label">Spread Pattern:</span>
-            <span class="summary-value">
-                ${clusteringIndex > 0.5 ? 'Clustered' : clusteringIndex > 0.2 ? 'Mixed' : 'Dispersed'}
-            </span>
+            <span class="summary-value">${spreadPattern}</span>
         </div>
     `;
 }
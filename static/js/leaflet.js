@@ -39,12 +39,21 @@ function initMap() {
         "Satellite": satellite
     };
     
-    // Add the layer control to the map
-    L.control.layers(baseMaps).addTo(app.map);
+    // Create heatmap layer, rendered server-side from the infection data
+    app.layers.heatmap = L.tileLayer('/tiles/{z}/{x}/{y}.png', {
+        maxZoom: 18,
+        opacity: 0.8
+    }).addTo(app.map);
     
     // Create infection layer group
     app.layers.infections = L.layerGroup().addTo(app.map);
     
+    // Add the layer control to the map
+    L.control.layers(baseMaps, {
+        "Heatmap": app.layers.heatmap,
+        "Infection points": app.layers.infections
+    }).addTo(app.map);
+    
     // Create prediction layer group
     app.layers.predictions = L.layerGroup().addTo(app.map);
     
@@ -53,6 +62,15 @@ function initMap() {
     
     // Add map event listeners
     app.map.on('click', onMapClick);
+    app.map.on('moveend', onMapMoveEnd);
+}
+
+/**
+ * Reload infection points for the new viewport once the map stops moving
+ */
+function onMapMoveEnd() {
+    clearTimeout(app.viewportTimer);
+    app.viewportTimer = setTimeout(loadInfectionData, 250);
 }
 
 /**
@@ -74,6 +92,11 @@ function updateInfectionLayer() {
             markerClass += 'infection-marker-high';
         }
         
+        if (infection.cluster && infection.count > 1) {
+            app.layers.infections.addLayer(clusterMarker(infection, markerClass));
+            return;
+        }
+        
         // Calculate marker size based on infection level (10-30px)
         const size = 10 + (infection.level * 20);
         
@@ -91,6 +114,7 @@ function updateInfectionLayer() {
                     <h3>Infection Point</h3>
                     <p>Level: ${(infection.level * 100).toFixed(1)}%</p>
                     <p>Date: ${infection.date || 'Unknown'}</p>
+                    ${infection.count > 1 ? `<p>Points: ${infection.count}</p>` : ''}
                     <div class="infection-level">
                         <div class="infection-level-fill" style="width: ${infection.level * 100}%"></div>
                     </div>
@@ -100,23 +124,51 @@ function updateInfectionLayer() {
         app.layers.infections.addLayer(infectionMarker);
     });
     
-    // If there are infection points, fit the map to bounds
-    if (app.data.infections.length > 0) {
+    // On first load, fit the map to the infection points
+    if (!app.infectionBoundsFitted && app.data.infections.length > 0) {
+        app.infectionBoundsFitted = true;
         const markers = Object.values(app.layers.infections._layers);
         const group = L.featureGroup(markers);
         app.map.fitBounds(group.getBounds(), { padding: [50, 50] });
     }
 }
 
+/**
+ * Create the marker of an infection cluster; clicking it zooms into the cluster
+ * @param {Object} infection - Cluster loaded by loadInfectionClusters
+ * @param {string} markerClass - Marker class of the cluster's highest level
+ * @returns {L.Marker} The cluster marker
+ */
+function clusterMarker(infection, markerClass) {
+    // Marker size grows with the number of points (24-48px)
+    const size = Math.min(48, 24 + 6 * Math.log10(infection.count));
+    
+    const icon = L.divIcon({
+        className: `${markerClass} infection-cluster`,
+        html: `<span>${infection.count}</span>`,
+        iconSize: [size, size]
+    });
+    
+    const marker = L.marker([infection.lat, infection.lng], {
+        icon: icon,
+        title: `${infection.count} infection points, mean level ${(infection.meanLevel * 100).toFixed(1)}%`
+    });
+    
+    // Each cluster splits into four at the next zoom level
+    marker.on('click', () => {
+        app.map.setView([infection.lat, infection.lng], Math.min(infection.cluster.zoom + 2, app.clusterZoomLimit));
+    });
+    
+    return marker;
+}
+
 /**
  * Update the prediction layer with current prediction data
  */
 function updatePredictionLayer() {
-    // Clear existing predictions
-    app.layers.predictions.clearLayers();
-    
-    // If no prediction data or not in prediction view, do nothing
+    // If no prediction data or not in prediction view, clear the layer
     if (!app.data.predictions || app.currentView !== 'prediksi') {
+        clearPredictionLayer();
         return;
     }
     
@@ -126,45 +178,121 @@ function updatePredictionLayer() {
     // Update day display
     document.getElementById('prediction-day-display').textContent = `Day ${timeframe.day}`;
     
+    // Delta-encoded predictions only add the points that appeared since the last frame
+    if (app.data.predictions.format === 'delta') {
+        updateDeltaPredictionLayer(app.data.predictions, timeframe);
+        return;
+    }
+    
+    clearPredictionLayer();
+    
     // Add markers for each prediction point
     timeframe.points.forEach(point => {
-        // Determine marker class based on infection level
-        let markerClass = 'infection-marker prediction-overlay ';
-        if (point.level < 0.3) {
-            markerClass += 'infection-marker-low';
-        } else if (point.level < 0.7) {
-            markerClass += 'infection-marker-medium';
-        } else {
-            markerClass += 'infection-marker-high';
-        }
-        
-        // Calculate marker size based on infection level (8-25px)
-        const size = 8 + (point.level * 17);
-        
-        // Create custom marker
-        const marker = L.divIcon({
-            className: markerClass,
-            html: '',
-            iconSize: [size, size]
-        });
+        // Ensemble predictions fade markers by infection probability
+        const hasProbability = point.probability !== undefined;
+        const probabilityText = hasProbability
+            ? `<p>Probability: ${(point.probability * 100).toFixed(0)}% (95% CI ${(point.lower * 100).toFixed(0)}-${(point.upper * 100).toFixed(0)}%)</p>`
+            : '';
         
         // Create marker and add to layer
-        const predictionMarker = L.marker([point.lat, point.lng], { icon: marker })
-            .bindPopup(`
-                <div class="infection-popup">
-                    <h3>Predicted Infection</h3>
-                    <p>Level: ${(point.level * 100).toFixed(1)}%</p>
-                    <p>Day: ${timeframe.day}</p>
-                    <div class="infection-level">
-                        <div class="infection-level-fill" style="width: ${point.level * 100}%"></div>
-                    </div>
-                </div>
-            `);
+        const predictionMarker = L.marker([point.lat, point.lng], {
+            icon: predictionIcon(point.level),
+            opacity: hasProbability ? 0.2 + 0.8 * point.probability : 1
+        })
+            .bindPopup(predictionPopup(point.level, timeframe.day, probabilityText));
         
         app.layers.predictions.addLayer(predictionMarker);
     });
 }
 
+/**
+ * Remove every prediction marker
+ */
+function clearPredictionLayer() {
+    app.layers.predictions.clearLayers();
+    app.predictionMarkers = [];
+}
+
+/**
+ * Marker icon for a predicted infection level
+ * @param {number} level - Infection level (0-1)
+ * @returns {L.DivIcon} Icon sized and colored by level
+ */
+function predictionIcon(level) {
+    // Determine marker class based on infection level
+    let markerClass = 'infection-marker prediction-overlay ';
+    if (level < 0.3) {
+        markerClass += 'infection-marker-low';
+    } else if (level < 0.7) {
+        markerClass += 'infection-marker-medium';
+    } else {
+        markerClass += 'infection-marker-high';
+    }
+    
+    // Calculate marker size based on infection level (8-25px)
+    const size = 8 + (level * 17);
+    
+    return L.divIcon({
+        className: markerClass,
+        html: '',
+        iconSize: [size, size]
+    });
+}
+
+/**
+ * Popup content of a predicted infection
+ * @param {number} level - Infection level (0-1)
+ * @param {number} day - Prediction day
+ * @param {string} extra - Additional HTML shown below the level
+ * @returns {string} Popup HTML
+ */
+function predictionPopup(level, day, extra = '') {
+    return `
+        <div class="infection-popup">
+            <h3>Predicted Infection</h3>
+            <p>Level: ${(level * 100).toFixed(1)}%</p>
+            ${extra}
+            <p>Day: ${day}</p>
+            <div class="infection-level">
+                <div class="infection-level-fill" style="width: ${level * 100}%"></div>
+            </div>
+        </div>
+    `;
+}
+
+/**
+ * Show a timeframe of a delta-encoded prediction (see decodePrediction)
+ *
+ * Every frame shows a prefix of the prediction's point table, so markers are
+ * kept between frames: points that appear are added, points not yet visible
+ * (when stepping back) are removed and the rest only get their level updated.
+ * @param {Object} prediction - Decoded prediction
+ * @param {Object} timeframe - Timeframe with day and count
+ */
+function updateDeltaPredictionLayer(prediction, timeframe) {
+    const markers = app.predictionMarkers;
+    
+    while (markers.length > timeframe.count) {
+        app.layers.predictions.removeLayer(markers.pop());
+    }
+    
+    markers.forEach((marker, i) => {
+        marker.setIcon(predictionIcon(prediction.levelAt(i, timeframe.day)));
+    });
+    
+    for (let i = markers.length; i < timeframe.count; i++) {
+        // Popups are rendered when opened, for the frame shown at that time
+        const marker = L.marker([prediction.lat[i], prediction.lng[i]], {
+            icon: predictionIcon(prediction.levelAt(i, timeframe.day))
+        }).bindPopup(() => {
+            const day = prediction.timeframes[app.predictionTimeframe].day;
+            return predictionPopup(prediction.levelAt(i, day), day);
+        });
+        markers.push(marker);
+        app.layers.predictions.addLayer(marker);
+    }
+}
+
 /**
  * Handle map click events
  * @param {Event} e - The click event
@@ -201,6 +329,7 @@ function addSampleData(lat, lng) {
             
             // Reload infection data
             loadInfectionData();
+            app.layers.heatmap.redraw();
             
             // Hide loading indicator
             showLoader(false);
@@ -8,20 +8,33 @@ const app = {
     currentView: 'dashboard',
     map: null,
     layers: {
+        heatmap: null,
         infections: null,
         predictions: null
     },
     data: {
         infections: [],
         predictions: null,
-        trends: []
+        patterns: null,
+        trends: [],
+        trendsEtag: null
     },
     charts: {
         trend: null,
         pattern: null
     },
     predictionTimeframe: 0,
-    animationTimer: null
+    // Running streamed prediction: { id, controller }
+    predictionStream: null,
+    animationTimer: null,
+    infectionPointLimit: 5000,
+    predictionMarkers: [],
+    infectionBoundsFitted: false,
+    viewportTimer: null,
+    // Below this zoom the map shows server-side clusters (spatial.DETAIL_ZOOM)
+    clusterZoomLimit: 12,
+    // Sync cursor of the loaded infection data and the query it belongs to
+    infectionSync: { query: null, cursor: null }
 };
 
 // Initialize the application when the DOM is loaded
@@ -121,31 +134,170 @@ function changeView(view) {
 
 /**
  * Load infection data from the API
+ *
+ * When the viewport is unchanged since the last load only the points added
+ * since then are requested (see the since parameter of /api/infection_data)
+ * and merged into the loaded data by id.
  */
 function loadInfectionData() {
+    if (app.map.getZoom() < app.clusterZoomLimit) {
+        loadInfectionClusters();
+        return;
+    }
+    
     // Show loading indicator
     showLoader(true);
     
+    // Only request the points inside the current viewport
+    const params = new URLSearchParams({
+        bbox: app.map.getBounds().toBBoxString(),
+        zoom: app.map.getZoom(),
+        limit: app.infectionPointLimit
+    });
+    
+    const query = params.toString();
+    const sync = app.infectionSync;
+    if (sync.query === query && sync.cursor) {
+        params.set('since', sync.cursor);
+    }
+    
     // Fetch infection data from API
-    fetch('/api/infection_data')
+    fetch(`/api/infection_data?${params}`)
+        .then(response => response.json().then(data => ({ response, data })))
+        .then(({ response, data }) => {
+            const isDelta = params.has('since') && response.headers.get('X-Sync-Reset') !== 'true';
+            
+            // Store the data, replacing updated points and appending new ones
+            if (isDelta) {
+                if (data.length > 0) {
+                    const index = new Map(app.data.infections.map((point, i) => [point.id, i]));
+                    data.forEach(point => {
+                        if (index.has(point.id)) {
+                            app.data.infections[index.get(point.id)] = point;
+                        } else {
+                            app.data.infections.push(point);
+                        }
+                    });
+                }
+            } else {
+                app.data.infections = data;
+            }
+            app.infectionSync = { query: query, cursor: response.headers.get('X-Sync-Cursor') };
+            
+            // Update the map with infection data
+            if (!isDelta || data.length > 0) {
+                updateInfectionLayer();
+            }
+            
+            // Hide loading indicator
+            showLoader(false);
+        })
+        .catch(error => {
+            console.error('Error loading infection data:', error);
+            showFlashMessage('Error loading infection data', 'error');
+            showLoader(false);
+        });
+}
+
+/**
+ * Load the infection clusters of the current viewport from the API
+ *
+ * Clusters are stored as infection points carrying the highest level of their
+ * points, a count and the cluster cell (see /api/clusters).
+ */
+function loadInfectionClusters() {
+    // Show loading indicator
+    showLoader(true);
+    
+    const params = new URLSearchParams({
+        bbox: app.map.getBounds().toBBoxString(),
+        zoom: app.map.getZoom()
+    });
+    
+    // Fetch clusters from API; the browser revalidates its copy with the ETag
+    fetch(`/api/clusters?${params}`)
         .then(response => response.json())
         .then(data => {
-            // Store the data
-            app.data.infections = data;
+            app.data.infections = data.map(cluster => ({
+                lat: cluster.lat,
+                lng: cluster.lng,
+                level: cluster.max_level,
+                meanLevel: cluster.mean_level,
+                count: cluster.count,
+                cluster: { zoom: cluster.zoom, x: cluster.x, y: cluster.y }
+            }));
+            
+            // Points loaded later start from a full response
+            app.infectionSync = { query: null, cursor: null };
             
-            // Update the map with infection data
             updateInfectionLayer();
             
             // Hide loading indicator
             showLoader(false);
         })
         .catch(error => {
-            console.error('Error loading infection data:', error);
+            console.error('Error loading infection clusters:', error);
             showFlashMessage('Error loading infection data', 'error');
             showLoader(false);
         });
 }
 
+/**
+ * Fetch infection points in the columnar binary format (see export.py)
+ * @param {Object} params - Optional query parameters, e.g. { bbox: '...' }
+ * @returns {Promise<Object>} Typed arrays { id, lat, lng, level, date } where
+ *     date holds days since 1970-01-01 (-1 when unknown)
+ */
+function fetchInfectionColumns(params = {}) {
+    const query = new URLSearchParams({ ...params, format: 'columnar' });
+    
+    return fetch(`/api/infection_data/export?${query}`)
+        .then(response => response.arrayBuffer())
+        .then(buffer => {
+            const view = new DataView(buffer);
+            const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+            if (magic !== 'GNSD') {
+                throw new Error('Unexpected columnar export format');
+            }
+            
+            // First pass: count rows so each column is allocated once
+            const batches = [];
+            let offset = 8;
+            let total = 0;
+            for (;;) {
+                const count = view.getUint32(offset, true);
+                offset += 8;
+                if (count === 0) {
+                    break;
+                }
+                batches.push({ offset, count });
+                total += count;
+                offset += Math.ceil(28 * count / 8) * 8;
+            }
+            
+            const columns = {
+                id: new Int32Array(total),
+                lat: new Float64Array(total),
+                lng: new Float64Array(total),
+                level: new Float32Array(total),
+                date: new Int32Array(total)
+            };
+            
+            // Second pass: copy each batch into the columns
+            let row = 0;
+            batches.forEach(({ offset, count }) => {
+                columns.lat.set(new Float64Array(buffer, offset, count), row);
+                columns.lng.set(new Float64Array(buffer, offset + 8 * count, count), row);
+                columns.id.set(new Int32Array(buffer, offset + 16 * count, count), row);
+                columns.level.set(new Float32Array(buffer, offset + 20 * count, count), row);
+                columns.date.set(new Int32Array(buffer, offset + 24 * count, count), row);
+                row += count;
+            });
+            
+            return columns;
+        });
+}
+
 /**
  * Load trend data from the API
  */
@@ -153,15 +305,17 @@ function loadTrendData() {
     // Show loading indicator
     showLoader(true);
     
-    // Fetch trend data from API
+    // Fetch trend data from API; the browser revalidates its copy with the ETag
     fetch('/api/trend_data')
-        .then(response => response.json())
-        .then(data => {
-            // Store the data
-            app.data.trends = data;
-            
-            // Update trend chart
-            updateTrendChart();
+        .then(response => response.json().then(data => ({ response, data })))
+        .then(({ response, data }) => {
+            // Only redraw the chart when the data changed
+            const etag = response.headers.get('ETag');
+            if (!etag || etag !== app.data.trendsEtag) {
+                app.data.trends = data;
+                app.data.trendsEtag = etag;
+                updateTrendChart();
+            }
             
             // Hide loading indicator
             showLoader(false);
@@ -177,13 +331,31 @@ function loadTrendData() {
  * Load pattern data for analysis
  */
 function loadPatternData() {
-    // In a real implementation, this would fetch pattern data from the API
-    // For now, we'll use the infection data to show patterns
+    showLoader(true);
     
-    // Use infection data to show patterns
-    if (app.data.infections.length > 0) {
-        updatePatternChart();
+    // Analyze the area shown on the map
+    const params = new URLSearchParams();
+    if (app.map) {
+        params.set('bbox', app.map.getBounds().toBBoxString());
     }
+    
+    fetch(`/api/pattern_analysis?${params}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            app.data.patterns = data;
+            updatePatternChart();
+            showLoader(false);
+        })
+        .catch(error => {
+            console.error('Error loading pattern analysis:', error);
+            showFlashMessage('Error loading pattern analysis', 'error');
+            showLoader(false);
+        });
 }
 
 /**
@@ -196,23 +368,34 @@ function generatePrediction() {
     // Get prediction days from input
     const days = parseInt(document.getElementById('prediction-days').value) || 30;
     
+    // More than one run predicts infection probabilities from a Monte-Carlo ensemble
+    const ensemble = parseInt(document.getElementById('prediction-ensemble').value) || 1;
+    
+    // Single predictions are streamed and shown frame by frame
+    if (ensemble === 1) {
+        streamPrediction(days);
+        return;
+    }
+    
     // Request prediction from API
     fetch('/api/predict', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
-        body: JSON.stringify({ days: days })
+        // Single predictions are requested delta-encoded, each point is sent once
+        body: JSON.stringify({ days: days, ensemble: ensemble, format: ensemble > 1 ? 'full' : 'delta' })
     })
         .then(response => response.json())
         .then(data => {
             // Store the prediction data
-            app.data.predictions = data;
+            app.data.predictions = decodePrediction(data);
             
             // Reset timeframe
             app.predictionTimeframe = 0;
             
             // Update the prediction layer
+            clearPredictionLayer();
             updatePredictionLayer();
             
             // Hide loading indicator
@@ -225,6 +408,127 @@ function generatePrediction() {
         });
 }
 
+/**
+ * Stream a single prediction from /api/predict/stream
+ *
+ * The response is newline-delimited JSON; every timeframe is added to the
+ * slider and shown as soon as it arrives, so the map updates while the
+ * simulation is still running.
+ * @param {number} days - Number of days to predict
+ */
+function streamPrediction(days) {
+    cancelPredictionStream();
+    pausePredictionAnimation();
+    
+    const controller = new AbortController();
+    const stream = { id: null, controller: controller };
+    app.predictionStream = stream;
+    setPredictionCancelVisible(true);
+    
+    let prediction = null;
+    const handleEvent = event => {
+        if (event.type === 'start') {
+            stream.id = event.stream_id;
+            prediction = startStreamedPrediction(event);
+            app.data.predictions = prediction;
+            app.predictionTimeframe = 0;
+            clearPredictionLayer();
+        } else if (event.type === 'frame') {
+            addStreamedFrame(prediction, event);
+            
+            // Follow the newest frame unless the user moved the slider back
+            const following = app.predictionTimeframe >= prediction.timeframes.length - 2;
+            if (following) {
+                app.predictionTimeframe = prediction.timeframes.length - 1;
+            }
+            updatePredictionSlider();
+            if (following) {
+                updatePredictionLayer();
+            }
+            showLoader(false);
+        } else if (event.type === 'end') {
+            finishStreamedPrediction(prediction, event);
+            updatePredictionSummary();
+        } else if (event.type === 'cancelled') {
+            showFlashMessage(`Prediction cancelled on day ${event.day}`, 'warning');
+        }
+    };
+    
+    fetch('/api/predict/stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ days: days }),
+        signal: controller.signal
+    })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffered = '';
+            
+            // Events are separated by newlines and may span several chunks
+            const read = () => reader.read().then(({ done, value }) => {
+                buffered += decoder.decode(value || new Uint8Array(0), { stream: !done });
+                const lines = buffered.split('\n');
+                buffered = lines.pop();
+                lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+                if (!done) {
+                    return read();
+                }
+            });
+            return read();
+        })
+        .catch(error => {
+            if (error.name !== 'AbortError') {
+                console.error('Error streaming prediction:', error);
+                showFlashMessage('Error generating prediction', 'error');
+            }
+        })
+        .finally(() => {
+            if (app.predictionStream === stream) {
+                app.predictionStream = null;
+                setPredictionCancelVisible(false);
+            }
+            showLoader(false);
+        });
+}
+
+/**
+ * Stop the running streamed prediction, keeping the frames received so far
+ */
+function cancelPredictionStream() {
+    const stream = app.predictionStream;
+    if (!stream) {
+        return;
+    }
+    app.predictionStream = null;
+    setPredictionCancelVisible(false);
+    
+    // The server stops at its next simulated day; closing the connection stops
+    // it as well if the cancel request reaches another worker
+    if (stream.id) {
+        fetch(`/api/predict/stream/${stream.id}/cancel`, { method: 'POST' })
+            .catch(error => console.error('Error cancelling prediction:', error));
+    }
+    stream.controller.abort();
+}
+
+/**
+ * Show the cancel button while a prediction is streaming
+ * @param {boolean} visible - Whether the button is shown
+ */
+function setPredictionCancelVisible(visible) {
+    const cancelButton = document.getElementById('cancel-prediction');
+    if (cancelButton) {
+        cancelButton.style.display = visible ? '' : 'none';
+    }
+}
+
 /**
  * Show or hide the loading indicator
  * @param {boolean} show - Whether to show or hide the loader
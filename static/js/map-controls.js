@@ -114,6 +114,11 @@ function showModelInfoModal(models) {
                     <span class="detail-label">Last Updated:</span>
                     <span class="detail-value">${model.last_updated}</span>
                 </div>
+                ${model.loaded ? `
+                <div class="detail-item">
+                    <span class="detail-label">Load Time:</span>
+                    <span class="detail-value">${model.load_seconds.toFixed(2)}s (${(model.memory_bytes / 1048576).toFixed(1)} MB)</span>
+                </div>` : ''}
             </div>
         `;
         
@@ -254,36 +259,24 @@ function toggleBaseMap() {
 }
 
 /**
- * Export current map data as GeoJSON
+ * Export map data as GeoJSON
+ *
+ * Infection points are streamed by the server straight into the download, so
+ * exports of any size never have to be held in browser memory. Predicted points
+ * for the current timeframe are exported as a separate file.
  */
 function exportMapData() {
-    // Create GeoJSON structure
-    const geojson = {
-        type: 'FeatureCollection',
-        features: []
-    };
+    const date = new Date().toISOString().split('T')[0];
     
-    // Add infection data
-    app.data.infections.forEach(infection => {
-        geojson.features.push({
-            type: 'Feature',
-            geometry: {
-                type: 'Point',
-                coordinates: [infection.lng, infection.lat]
-            },
-            properties: {
-                level: infection.level,
-                date: infection.date
-            }
-        });
-    });
+    // Download all infection points from the streaming export endpoint
+    downloadUrl('/api/infection_data/export?format=geojson', `genosense_export_${date}.geojson`);
     
     // Add prediction data if available
     if (app.data.predictions && app.currentView === 'prediksi') {
         const currentTimeframe = app.data.predictions.timeframes[app.predictionTimeframe];
-        
-        currentTimeframe.points.forEach(point => {
-            geojson.features.push({
+        const geojson = {
+            type: 'FeatureCollection',
+            features: currentTimeframe.points.map(point => ({
                 type: 'Feature',
                 geometry: {
                     type: 'Point',
@@ -294,30 +287,32 @@ function exportMapData() {
                     predicted: true,
                     day: currentTimeframe.day
                 }
-            });
-        });
+            }))
+        };
+        
+        // Convert to JSON string
+        const dataStr = JSON.stringify(geojson, null, 2);
+        const dataUri = 'data:application/json;charset=utf-8,' + encodeURIComponent(dataStr);
+        downloadUrl(dataUri, `genosense_prediction_day${currentTimeframe.day}_${date}.geojson`);
     }
     
-    // Convert to JSON string
-    const dataStr = JSON.stringify(geojson, null, 2);
-    
-    // Create download link
-    const dataUri = 'data:application/json;charset=utf-8,' + encodeURIComponent(dataStr);
-    
-    // Create filename with date
-    const date = new Date().toISOString().split('T')[0];
-    const filename = `genosense_export_${date}.geojson`;
-    
+    // Show success message
+    showFlashMessage('Data exported successfully', 'success');
+}
+
+/**
+ * Trigger a browser download of a URL
+ * @param {string} url - URL to download
+ * @param {string} filename - Suggested file name
+ */
+function downloadUrl(url, filename) {
     // Create and trigger download link
     const linkElement = document.createElement('a');
-    linkElement.setAttribute('href', dataUri);
+    linkElement.setAttribute('href', url);
     linkElement.setAttribute('download', filename);
     linkElement.style.display = 'none';
     
     document.body.appendChild(linkElement);
     linkElement.click();
     document.body.removeChild(linkElement);
-    
-    // Show success message
-    showFlashMessage('Data exported successfully', 'success');
 }
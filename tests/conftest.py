@@ -0,0 +1,39 @@
+import pytest
+
+import tiles
+import result_cache
+from app import create_app, db
+from schema import init_database
+
+
+@pytest.fixture
+def app(tmp_path):
+    """Application on a fresh SQLite database, processing jobs and ensembles inline"""
+    app = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'genosense.db'}",
+        "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+        "TILE_CACHE_FOLDER": str(tmp_path / "tile_cache"),
+        "PREVIEW_FOLDER": str(tmp_path / "previews"),
+        "JOB_WORKERS": 0,
+        "BATCH_WORKERS": 0,
+        "ENSEMBLE_WORKERS": 0,
+        "RESUME_JOBS": False,
+        "METRICS_ENABLED": False,
+    })
+    # Process-wide caches are keyed on the dataset version, which restarts with
+    # every database
+    result_cache._prediction_cache = None
+    result_cache._analysis_cache = None
+    tiles._cache = None
+
+    with app.app_context():
+        init_database()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
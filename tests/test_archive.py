@@ -0,0 +1,73 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from app import db
+from archive import compact, infection_source, months_ago
+from clusters import get_clusters
+from ingest import insert_infections
+from models import InfectionArchive, InfectionData
+from rollups import trend
+from versioning import get_dataset_state
+
+DATES = [datetime(2023, 12, 30), datetime(2024, 1, 15), datetime(2024, 2, 10)]
+
+
+@pytest.fixture
+def history(app):
+    insert_infections([1.0, 2.0, 3.0], [101.0, 102.0, 103.0], [0.2, 0.4, 0.6], dates=DATES)
+    db.session.commit()
+
+
+def count(model):
+    return db.session.execute(select(func.count()).select_from(model)).scalar()
+
+
+def test_compact_moves_old_rows_with_their_ids(history):
+    ids = db.session.execute(select(InfectionData.id).order_by(InfectionData.id)).scalars().all()
+    before = get_dataset_state()
+
+    assert compact(date(2024, 2, 1)) == 2
+    assert compact(date(2024, 2, 1)) == 0
+
+    assert count(InfectionData) == 1 and count(InfectionArchive) == 2
+    assert db.session.execute(select(InfectionArchive.id).order_by(InfectionArchive.id)).scalars().all() == ids[:2]
+    # Delta cursors from before the move must reset
+    assert get_dataset_state().rewritten_version > before.rewritten_version
+
+
+def test_rollups_keep_and_clusters_drop_archived_rows(history):
+    compact(date(2024, 2, 1))
+
+    assert [day['date'] for day in trend()] == ['2023-12-30', '2024-01-15', '2024-02-10']
+    assert sum(cluster['count'] for cluster in get_clusters(None, 0)) == 1
+
+
+def test_only_ranges_reaching_the_archive_read_it(history):
+    compact(date(2024, 2, 1))
+
+    assert infection_source() is InfectionData
+    assert infection_source(date(2024, 2, 1), None) is InfectionData
+    assert infection_source(date(2024, 1, 1), None) is not InfectionData
+
+
+def test_api_includes_archived_rows_for_old_ranges(client, history):
+    compact(date(2024, 2, 1))
+
+    assert [point['level'] for point in client.get('/api/infection_data').json] == [0.6]
+    old = client.get('/api/infection_data?start=2024-01-01&end=2024-01-31').json
+    assert [point['level'] for point in old] == [0.4]
+    exported = client.get('/api/infection_data/export?start=2023-01-01').get_data(as_text=True)
+    assert len(exported.splitlines()) == 3
+
+
+@pytest.mark.parametrize('query', ['start=2024-13-01', 'end=yesterday', 'start=2024-02-02&end=2024-02-01'])
+def test_invalid_date_range_is_rejected(client, query):
+    assert client.get(f'/api/infection_data?{query}').status_code == 400
+
+
+@pytest.mark.parametrize('months, expected', [(0, date(2024, 3, 1)), (2, date(2024, 1, 1)), (3, date(2023, 12, 1)),
+                                              (15, date(2022, 12, 1))])
+def test_months_ago_counts_calendar_months(months, expected):
+    assert months_ago(months, today=date(2024, 3, 31)) == expected
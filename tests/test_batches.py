@@ -0,0 +1,111 @@
+import io
+import zipfile
+
+import numpy as np
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import jobs
+import uploads
+from app import db
+from models import ImageData, InfectionData, ProcessingJob, UploadBatch
+from raster import create_raster, MODEL_PIXEL_SCALE, MODEL_TIEPOINT, GEO_KEY_DIRECTORY
+from routes import allowed_file
+
+
+def geotiff(tmp_path, seed, size=128):
+    """Bytes of a small georeferenced 5-band orthomosaic with stressed patches"""
+    path = tmp_path / f'survey-{seed}.tif'
+    geo_tags = {
+        MODEL_PIXEL_SCALE: (0.00001, 0.00001, 0.0),
+        MODEL_TIEPOINT: (0, 0, 0, 101.69, 3.14, 0),
+        GEO_KEY_DIRECTORY: (1, 1, 0, 1, 1024, 0, 1, 2),
+    }
+    pixels = create_raster(str(path), size, size, 5, np.uint16, geo_tags)
+    rng = np.random.default_rng(seed)
+    pixels[..., :4] = rng.integers(1500, 3500, (size, size, 4), dtype=np.uint16)
+    pixels[..., 4] = rng.integers(20000, 32000, (size, size), dtype=np.uint16)
+    pixels[:64, :64, 4] = 6000
+    pixels.flush()
+    del pixels
+    return path.read_bytes()
+
+
+def files(*items):
+    return [FileStorage(stream=io.BytesIO(content), filename=name) for name, content in items]
+
+
+def zipped(*items):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, content in items:
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def test_batch_is_processed_in_one_run(app, tmp_path):
+    first, second = geotiff(tmp_path, 1), geotiff(tmp_path, 2)
+    with app.test_request_context():
+        batch, stored, skipped = uploads.register_batch(
+            files(('a.tif', first), ('flight.zip', zipped(('b.tif', second), ('notes.txt', b'x')))),
+            allowed_file
+        )
+
+    assert [entry['filename'] for entry in stored] == ['a.tif', 'b.tif']
+    assert skipped == [{'filename': 'notes.txt', 'reason': 'unsupported file type'}]
+
+    db.session.expire_all()
+    assert db.session.get(UploadBatch, batch.id).status == 'done'
+    assert {job.status for job in db.session.query(ProcessingJob)} == {'done'}
+    assert all(image.processed for image in db.session.query(ImageData))
+    sources = {row.source_image_id for row in db.session.query(InfectionData)}
+    assert sources == {entry['image_id'] for entry in stored}
+
+
+def test_failing_member_leaves_no_rows(app, tmp_path, monkeypatch):
+    store_stream = uploads.store_stream
+    calls = []
+
+    def failing(stream, filename):
+        calls.append(filename)
+        if len(calls) == 2:
+            raise OSError("No space left on device")
+        return store_stream(stream, filename)
+
+    monkeypatch.setattr(uploads, 'store_stream', failing)
+    with app.test_request_context(), pytest.raises(OSError):
+        uploads.register_batch(files(('a.tif', geotiff(tmp_path, 1)), ('b.tif', geotiff(tmp_path, 2))), allowed_file)
+
+    assert db.session.query(ImageData).count() == 0
+    assert db.session.query(UploadBatch).count() == 0
+
+
+def test_image_without_job_gets_one(app, tmp_path):
+    content = geotiff(tmp_path, 1)
+    with app.test_request_context():
+        filename, content_hash = uploads.store_stream(io.BytesIO(content), 'a.tif')
+    db.session.add(ImageData(filename=filename, content_hash=content_hash))
+    db.session.commit()
+
+    with app.test_request_context():
+        batch, stored, _ = uploads.register_batch(files(('again.tif', content)), allowed_file)
+
+    assert batch is not None
+    assert stored[0]['duplicate'] and 'job_id' in stored[0]
+    db.session.expire_all()
+    assert db.session.get(ProcessingJob, stored[0]['job_id']).status == 'done'
+
+
+def test_failed_detection_setup_fails_the_batch(app, tmp_path, monkeypatch):
+    def broken(paths, progress):
+        raise RuntimeError("Cannot start detection processes")
+
+    monkeypatch.setattr(jobs, '_detect_all', broken)
+    with app.test_request_context():
+        batch, stored, _ = uploads.register_batch(files(('a.tif', geotiff(tmp_path, 1))), allowed_file)
+
+    db.session.expire_all()
+    batch = db.session.get(UploadBatch, batch.id)
+    job = db.session.get(ProcessingJob, stored[0]['job_id'])
+    assert batch.status == 'failed' and job.status == 'failed'
+    assert job.error == "Cannot start detection processes"
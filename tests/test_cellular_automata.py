@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from cellular_automata import InfectionGrid, predict_spread, MAX_GRID_CELLS
+
+STATE = [
+    {'lat': 3.1400, 'lng': 101.6900, 'level': 0.6},
+    {'lat': 3.1410, 'lng': 101.6920, 'level': 0.3},
+    {'lat': 3.1385, 'lng': 101.6890, 'level': 0.9},
+]
+
+
+def test_predict_spread_is_reproducible_with_a_seed():
+    first = predict_spread(STATE, 20, seed=7)
+    second = predict_spread(STATE, 20, seed=7)
+    assert json.dumps(first, sort_keys=True) == json.dumps(second, sort_keys=True)
+
+
+def test_grid_rejects_padding_larger_than_the_cell_budget():
+    with pytest.raises(ValueError):
+        InfectionGrid([3.14], [101.69], [0.5], 1000, max_cells=MAX_GRID_CELLS)
+
+
+@pytest.mark.parametrize('cell_size', [0, -0.001, float('nan')])
+def test_grid_rejects_non_positive_cell_size(cell_size):
+    with pytest.raises(ValueError):
+        InfectionGrid([3.14], [101.69], [0.5], 10, cell_size=cell_size)
+
+
+@pytest.mark.parametrize('url', ['/api/predict', '/api/predict/stream'])
+@pytest.mark.parametrize('params', [
+    {'days': 1000},
+    {'days': -1},
+    {'days': '30'},
+    {'days': 2.5},
+    {'cell_size': 0},
+    {'cell_size': -1},
+    {'cell_size': 'fine'},
+    {'seed': 'abc'},
+    {'seed': 1.5},
+    {'seed': -1},
+    {'seed': True},
+])
+def test_predict_rejects_bad_parameters(client, url, params):
+    response = client.post(url, json=params)
+    assert response.status_code == 400
+    assert 'error' in response.json
+
+
+def test_predict_caches_by_parameters(client):
+    params = {'days': 5, 'seed': 1}
+    assert client.post('/api/predict', json=params).headers['X-Cache'] == 'MISS'
+    assert client.post('/api/predict', json=params).headers['X-Cache'] == 'HIT'
@@ -0,0 +1,77 @@
+from sqlalchemy import select, update, delete
+
+from app import db
+from models import InfectionData, InfectionCluster
+from clusters import MAX_CLUSTER_ZOOM, cluster_points, get_clusters, rebuild_clusters
+
+
+def index_rows():
+    return sorted(
+        (row.zoom, row.x, row.y, row.count, round(row.lat_sum, 9), round(row.lng_sum, 9),
+         round(row.level_sum, 9), row.level_max)
+        for row in db.session.execute(select(InfectionCluster)).scalars()
+    )
+
+
+def assert_matches_rebuild():
+    incremental = index_rows()
+    rebuild_clusters()
+    assert incremental == index_rows()
+
+
+def add(lat, lng, level):
+    point = InfectionData(latitude=lat, longitude=lng, infection_level=level)
+    db.session.add(point)
+    return point
+
+
+def test_index_agrees_with_clustering_on_the_fly(app):
+    points = [(3.1, 101.6, 0.2), (3.1001, 101.6001, 0.8), (-6.2, 106.8, 0.5)]
+    for point in points:
+        add(*point)
+    db.session.commit()
+
+    for zoom in (0, 5, MAX_CLUSTER_ZOOM):
+        expected = cluster_points(*zip(*points), zoom)
+        key = lambda cluster: (cluster['x'], cluster['y'])
+        assert sorted(get_clusters(None, zoom), key=key) == sorted(expected, key=key)
+    assert_matches_rebuild()
+
+
+def test_updates_and_deletes_rebuild_the_index(app):
+    moved = add(3.1, 101.6, 0.9)
+    removed = add(3.1, 101.6, 0.4)
+    add(-6.2, 106.8, 0.5)
+    db.session.commit()
+
+    moved.latitude, moved.longitude, moved.infection_level = -6.2, 106.8, 0.1
+    db.session.delete(removed)
+    db.session.commit()
+
+    (cluster,) = get_clusters(None, MAX_CLUSTER_ZOOM)
+    assert cluster['count'] == 2 and cluster['max_level'] == 0.5
+    assert 'cluster_rebuild' not in db.session.info
+    assert_matches_rebuild()
+
+
+def test_bulk_changes_rebuild_the_index(app):
+    add(3.1, 101.6, 0.9)
+    add(-6.2, 106.8, 0.5)
+    db.session.commit()
+
+    db.session.execute(update(InfectionData).where(InfectionData.infection_level > 0.8).values(infection_level=0.3))
+    db.session.commit()
+    assert max(cluster['max_level'] for cluster in get_clusters(None, 0)) == 0.5
+
+    db.session.execute(delete(InfectionData))
+    db.session.commit()
+    assert get_clusters(None, 0) == []
+
+
+def test_viewport_only_returns_its_cells(app):
+    add(3.1, 101.6, 0.2)
+    add(-6.2, 106.8, 0.5)
+    db.session.commit()
+
+    clusters = get_clusters((101.0, 3.0, 102.0, 4.0), MAX_CLUSTER_ZOOM)
+    assert [(cluster['count'], cluster['max_level']) for cluster in clusters] == [(1, 0.2)]
@@ -0,0 +1,80 @@
+import os
+import signal
+
+import pytest
+
+import ensemble
+import result_cache
+from app import db
+from ingest import insert_infections
+
+STATE = [
+    {'lat': 3.14, 'lng': 101.69, 'level': 0.6},
+    {'lat': 3.1405, 'lng': 101.6905, 'level': 0.3},
+    {'lat': 3.15, 'lng': 101.70, 'level': 0.8},
+]
+
+
+@pytest.fixture
+def pool():
+    yield 2
+    if ensemble._pool is not None:
+        ensemble._drop_pool(ensemble._pool)
+
+
+def test_same_seed_gives_the_same_ensemble():
+    first = ensemble.predict_ensemble(STATE, 20, 6, seed=11, workers=0)
+    assert ensemble.predict_ensemble(STATE, 20, 6, seed=11, workers=0) == first
+    assert ensemble.predict_ensemble(STATE, 20, 6, seed=12, workers=0) != first
+
+
+def test_result_does_not_depend_on_the_process_split(pool):
+    inline = ensemble.predict_ensemble(STATE, 20, 6, seed=11, workers=0)
+    assert ensemble.predict_ensemble(STATE, 20, 6, seed=11, workers=pool) == inline
+
+
+def test_broken_pool_is_replaced(pool):
+    expected = ensemble.predict_ensemble(STATE, 10, 4, seed=5, workers=0)
+    broken = ensemble._get_pool(pool)
+    ensemble.predict_ensemble(STATE, 10, 4, seed=5, workers=pool)
+    for pid in list(broken._processes):
+        os.kill(pid, signal.SIGKILL)
+
+    assert ensemble.predict_ensemble(STATE, 10, 4, seed=5, workers=pool) == expected
+    assert ensemble._get_pool(pool) is not broken
+
+
+def test_probabilities_and_bands_are_consistent():
+    result = ensemble.predict_ensemble(STATE, 30, 8, seed=3, workers=0)
+
+    assert result['ensemble']['members'] == 8
+    for frame in result['timeframes']:
+        band = frame['infected_cells']
+        assert band['p05'] <= band['p50'] <= band['p95']
+        for point in frame['points']:
+            assert 0 <= point['lower'] <= point['probability'] <= point['upper'] <= 1
+            assert point['probability'] >= ensemble.MIN_PROBABILITY
+
+
+def test_predict_endpoint_runs_reproducible_ensembles(client):
+    insert_infections([p['lat'] for p in STATE], [p['lng'] for p in STATE], [p['level'] for p in STATE])
+    db.session.commit()
+
+    request = {'days': 15, 'ensemble': 4, 'seed': 9}
+    first = client.post('/api/predict', json=request)
+    assert first.status_code == 200
+    assert first.json['ensemble']['members'] == 4
+
+    result_cache._prediction_cache = None
+    again = client.post('/api/predict', json=request)
+    assert again.headers['X-Cache'] == 'MISS'
+    assert again.json == first.json
+
+
+@pytest.mark.parametrize('members', [True, 0, 2.5, '4', 10 ** 6])
+def test_invalid_member_count_is_rejected(client, members):
+    assert client.post('/api/predict', json={'days': 5, 'ensemble': members}).status_code == 400
+
+
+def test_delta_format_needs_a_single_prediction(client):
+    assert client.post('/api/predict', json={'days': 5, 'ensemble': 2, 'format': 'delta'}).status_code == 400
@@ -0,0 +1,79 @@
+import json
+import struct
+from datetime import datetime
+
+import numpy as np
+
+from app import db
+from export import COLUMNAR_MAGIC, COLUMNAR_VERSION, columnar_stream, geojson_stream, ndjson_stream
+from ingest import insert_infections
+
+ROWS = [
+    (1, 3.1, 101.6, 0.25, datetime(2024, 3, 1, 9)),
+    (2, 3.2, 101.7, 0.5, None),
+    (3, -6.2, 106.8, 0.75, datetime(2024, 3, 2, 18)),
+]
+
+
+def decode_columnar(data):
+    """Rows of a columnar export as (id, lat, lng, level, days since 1970)"""
+    assert data[:4] == COLUMNAR_MAGIC
+    assert struct.unpack_from('<I', data, 4)[0] == COLUMNAR_VERSION
+    offset, rows = 8, []
+    while True:
+        count, _ = struct.unpack_from('<II', data, offset)
+        offset += 8
+        if count == 0:
+            assert offset == len(data)
+            return rows
+        columns = []
+        for dtype in ('<f8', '<f8', '<i4', '<f4', '<i4'):
+            columns.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+            offset += columns[-1].nbytes
+        offset += -offset % 8
+        lats, lngs, ids, levels, days = columns
+        rows.extend(zip(ids.tolist(), lats.tolist(), lngs.tolist(), levels.tolist(), days.tolist()))
+
+
+def test_ndjson_has_one_object_per_row():
+    lines = ''.join(ndjson_stream([ROWS[:2], ROWS[2:]])).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'id': 1, 'lat': 3.1, 'lng': 101.6, 'level': 0.25, 'date': '2024-03-01'},
+        {'id': 2, 'lat': 3.2, 'lng': 101.7, 'level': 0.5, 'date': None},
+        {'id': 3, 'lat': -6.2, 'lng': 106.8, 'level': 0.75, 'date': '2024-03-02'},
+    ]
+
+
+def test_geojson_is_one_feature_collection():
+    collection = json.loads(''.join(geojson_stream([ROWS[:1], ROWS[1:]])))
+    assert collection['type'] == 'FeatureCollection'
+    assert [feature['id'] for feature in collection['features']] == [1, 2, 3]
+    assert collection['features'][2]['geometry']['coordinates'] == [106.8, -6.2]
+    assert json.loads(''.join(geojson_stream([]))) == {'type': 'FeatureCollection', 'features': []}
+
+
+def test_columnar_batches_keep_float64_columns_aligned():
+    data = b''.join(columnar_stream([ROWS[:1], [], ROWS[1:]]))
+    assert decode_columnar(data) == [
+        (1, 3.1, 101.6, 0.25, 19783),
+        (2, 3.2, 101.7, 0.5, -1),
+        (3, -6.2, 106.8, 0.75, 19784),
+    ]
+
+
+def test_export_endpoint_filters_and_streams(client):
+    insert_infections([3.1, 3.2, -6.2], [101.6, 101.7, 106.8], [0.25, 0.5, 0.75],
+                      dates=[datetime(2024, 3, 1), datetime(2024, 3, 5), datetime(2024, 3, 1)])
+    db.session.commit()
+
+    response = client.get('/api/infection_data/export?bbox=101,3,102,4&end=2024-03-02')
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['lat'] for line in response.get_data(as_text=True).splitlines()] == [3.1]
+
+    response = client.get('/api/infection_data/export?format=columnar')
+    assert response.mimetype == 'application/octet-stream'
+    assert [row[3] for row in decode_columnar(response.data)] == [0.25, 0.5, 0.75]
+
+
+def test_unknown_format_is_rejected(client):
+    assert client.get('/api/infection_data/export?format=csv').status_code == 400
@@ -0,0 +1,51 @@
+from app import db
+from models import InfectionData
+from ingest import insert_infections
+
+
+def add_points(lats, lngs, levels):
+    insert_infections(lats, lngs, levels)
+    db.session.commit()
+
+
+def test_since_returns_only_points_added_after_the_cursor(client):
+    add_points([1.0, 1.1], [101.0, 101.1], [0.2, 0.4])
+    first = client.get('/api/infection_data')
+    assert first.status_code == 200
+    assert len(first.json) == 2
+    cursor = first.headers['X-Sync-Cursor']
+
+    add_points([1.2], [101.2], [0.6])
+    delta = client.get(f'/api/infection_data?since={cursor}')
+    assert delta.status_code == 200
+    assert 'X-Sync-Reset' not in delta.headers
+    assert [point['level'] for point in delta.json] == [0.6]
+
+    unchanged = client.get(f"/api/infection_data?since={delta.headers['X-Sync-Cursor']}")
+    assert unchanged.json == []
+
+
+def test_since_resets_after_rows_are_updated(client):
+    add_points([1.0], [101.0], [0.2])
+    cursor = client.get('/api/infection_data').headers['X-Sync-Cursor']
+
+    db.session.execute(db.select(InfectionData)).scalar_one().infection_level = 0.9
+    db.session.commit()
+
+    response = client.get(f'/api/infection_data?since={cursor}')
+    assert response.headers['X-Sync-Reset'] == 'true'
+    assert [point['level'] for point in response.json] == [0.9]
+
+
+def test_matching_etag_is_not_modified(client):
+    add_points([1.0], [101.0], [0.2])
+    etag = client.get('/api/infection_data').headers['ETag']
+
+    assert client.get('/api/infection_data', headers={'If-None-Match': etag}).status_code == 304
+
+    add_points([1.1], [101.1], [0.3])
+    assert client.get('/api/infection_data', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_malformed_cursor_is_rejected(client):
+    assert client.get('/api/infection_data?since=latest').status_code == 400
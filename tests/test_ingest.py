@@ -0,0 +1,38 @@
+import io
+
+from app import db
+from models import ImageData, InfectionData
+from ingest import import_infections
+
+
+def test_import_reports_row_errors_and_keeps_valid_rows(app):
+    db.session.add(ImageData(filename='survey.tif'))
+    db.session.commit()
+
+    text = io.StringIO(
+        "latitude,longitude,infection_level,date_recorded,source_image_id\n"
+        "1.0,101.0,0.5,2024-01-02,1\n"
+        "95.0,101.0,0.5,,\n"
+        "1.0,101.0,1.5,,\n"
+        "1.0,101.0,0.5,yesterday,\n"
+        "1.0,101.0,0.5,,2.5\n"
+        "1.0,101.0,0.5,,99\n"
+        "1.0,101.0,0.7,,\n"
+    )
+    result = import_infections(text, 'csv')
+
+    assert result['error'] is None
+    assert result['rows'] == 2
+    assert result['rejected'] == 5
+    assert [error['row'] for error in result['errors']] == [2, 3, 4, 5, 6]
+    assert 'source_image_id' in result['errors'][-1]['error']
+    assert db.session.query(InfectionData).count() == 2
+
+
+def test_import_rejects_unreadable_ndjson_lines(app):
+    text = io.StringIO('{"lat": 1.0, "lng": 101.0, "level": 0.5}\nnot json\n')
+    result = import_infections(text, 'ndjson')
+
+    assert result['rows'] == 1
+    assert result['rejected'] == 1
+    assert result['errors'][0]['row'] == 2
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import jobs
+from app import db
+from models import ImageData, ProcessingJob, UploadBatch
+
+
+@pytest.fixture
+def image(app):
+    image = ImageData(filename='survey.tif', original_filename='survey.tif')
+    db.session.add(image)
+    db.session.commit()
+    return image
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    """Images processed by a stand-in for the model; outcomes are popped per call"""
+    outcomes = []
+
+    def process_image(path, image_id, progress=None):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(jobs, 'process_image', process_image)
+    return outcomes
+
+
+def add_job(image, status, started_ago=None, batch=None):
+    job = ProcessingJob(image_id=image.id, status=status, batch_id=batch.id if batch else None,
+                        started_date=None if started_ago is None else datetime.utcnow() - started_ago)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def test_job_is_claimed_once(image):
+    job = add_job(image, 'queued')
+
+    assert jobs._claim(job.id)
+    assert not jobs._claim(job.id)
+    db.session.refresh(job)
+    assert job.status == 'running'
+    assert job.attempts == 1
+    assert job.started_date is not None
+
+
+def test_finished_job_marks_the_image_processed(image, processed):
+    processed.append('survey_result.tif')
+    job = jobs.enqueue_image(image)
+
+    # The job ran in its own app context and session
+    db.session.refresh(job)
+    db.session.refresh(image)
+    assert job.status == 'done' and job.progress == 1.0
+    assert image.processed and image.result_path == 'survey_result.tif'
+
+
+@pytest.mark.parametrize('outcome, error', [
+    (None, 'Image processing failed'),
+    (ValueError('unreadable raster'), 'unreadable raster'),
+])
+def test_failed_job_records_the_error(image, processed, outcome, error):
+    processed.append(outcome)
+    job = jobs.enqueue_image(image)
+
+    db.session.refresh(job)
+    db.session.refresh(image)
+    assert job.status == 'failed' and job.error == error
+    assert job.finished_date is not None
+    assert not image.processed
+
+
+def test_failed_job_can_be_retried(client, image, processed):
+    processed.extend([None, 'survey_result.tif'])
+    job = jobs.enqueue_image(image)
+
+    response = client.post(f'/api/jobs/{job.id}/retry')
+    assert response.status_code == 202
+    db.session.refresh(job)
+    assert job.status == 'done' and job.attempts == 2
+    assert job.error is None
+
+    assert client.post(f'/api/jobs/{job.id}/retry').status_code == 409
+
+
+def test_only_running_jobs_past_the_timeout_are_stale(app, image):
+    timeout = timedelta(seconds=app.config['JOB_TIMEOUT'])
+    batch = UploadBatch(status='running')
+    db.session.add(batch)
+    db.session.commit()
+    stale = add_job(image, 'running', started_ago=timeout + timedelta(minutes=1), batch=batch)
+    recent = add_job(image, 'running', started_ago=timeout - timedelta(minutes=1))
+    queued = add_job(image, 'queued')
+
+    assert not jobs.retry_job(recent)
+    assert jobs.fail_stale_jobs() == 1
+
+    for job in (stale, recent, queued, batch):
+        db.session.refresh(job)
+    assert stale.status == 'failed' and 'timed out' in stale.error
+    assert batch.status == 'failed'
+    assert recent.status == 'running'
+    assert queued.status == 'queued'
+
+
+def test_stale_running_job_can_be_retried(app, image, processed):
+    processed.append('survey_result.tif')
+    job = add_job(image, 'running', started_ago=timedelta(seconds=app.config['JOB_TIMEOUT'] + 60))
+
+    assert jobs.retry_job(job)
+    db.session.refresh(job)
+    assert job.status == 'done'
+
+
+def test_resume_fails_stale_jobs_and_submits_queued_ones(app, image, monkeypatch):
+    submitted = []
+
+    class Executor:
+        def submit(self, fn, *args):
+            submitted.append((fn, args[0]))
+
+    monkeypatch.setattr(jobs, '_executor', Executor())
+    batch = UploadBatch(status='queued')
+    db.session.add(batch)
+    db.session.commit()
+    single = add_job(image, 'queued')
+    add_job(image, 'queued', batch=batch)
+    add_job(image, 'queued', batch=batch)
+    stale = add_job(image, 'running', started_ago=timedelta(seconds=app.config['JOB_TIMEOUT'] + 60))
+
+    jobs._resume_pending_jobs()
+
+    assert submitted == [(jobs.run_job, single.id), (jobs.run_batch, batch.id)]
+    db.session.refresh(stale)
+    assert stale.status == 'failed'
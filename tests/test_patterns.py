@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from app import db
+from ingest import insert_infections
+from patterns import analyze_patterns, nearest_neighbour_distances
+
+
+def brute_force_nearest(x, y, sample):
+    distances = np.hypot(x[sample, None] - x[None, :], y[sample, None] - y[None, :])
+    distances[np.arange(sample.size), sample] = np.inf
+    return distances.min(axis=1)
+
+
+@pytest.mark.parametrize('cell', [0.05, 0.5, 5.0])
+def test_nearest_neighbours_match_brute_force(cell):
+    rng = np.random.default_rng(1)
+    # A dense cluster, a sparse background and a duplicated point
+    x = np.concatenate([rng.normal(2, 0.05, 300), rng.uniform(0, 20, 200), [7.0, 7.0]])
+    y = np.concatenate([rng.normal(3, 0.05, 300), rng.uniform(0, 20, 200), [9.0, 9.0]])
+    sample = rng.choice(x.size, 120, replace=False)
+    sample[-1] = x.size - 1
+
+    distances = nearest_neighbour_distances(x, y, sample, cell)
+    assert np.allclose(distances, brute_force_nearest(x, y, sample))
+    assert distances[-1] == 0
+
+
+def test_clustered_and_dispersed_patterns_are_told_apart():
+    rng = np.random.default_rng(2)
+    lats = 3.0 + rng.normal(0, 0.0005, 400)
+    lngs = 101.0 + rng.normal(0, 0.0005, 400)
+    bbox = (100.95, 2.95, 101.05, 3.05)
+    clustered = analyze_patterns(lats, lngs, np.full(400, 0.5), bbox=bbox)
+    assert clustered['nearest_neighbour']['pattern'] == 'clustered'
+
+    grid_lats, grid_lngs = np.meshgrid(np.linspace(2.95, 3.05, 20), np.linspace(100.95, 101.05, 20))
+    dispersed = analyze_patterns(grid_lats.ravel(), grid_lngs.ravel(), np.full(400, 0.5), bbox=bbox)
+    assert dispersed['nearest_neighbour']['pattern'] == 'dispersed'
+    assert dispersed['nearest_neighbour']['ratio'] > clustered['nearest_neighbour']['ratio']
+
+
+def test_severe_corner_is_a_hotspot():
+    rng = np.random.default_rng(3)
+    lats = rng.uniform(3.0, 3.1, 2000)
+    lngs = rng.uniform(101.0, 101.1, 2000)
+    levels = np.where((lats < 3.02) & (lngs < 101.02), 0.95, 0.05)
+
+    result = analyze_patterns(lats, lngs, levels, bbox=(101.0, 3.0, 101.1, 3.1), bandwidth_km=1.0)
+    top = result['hotspots'][0]
+    assert top['type'] == 'hot' and top['confidence'] == 99
+    assert top['lat'] < 3.03 and top['lng'] < 101.03
+    assert result['hotspot_counts']['hot'][99] > 0
+    assert result['density']['bandwidth_km'] == 1.0
+
+
+def test_results_are_repeatable_and_empty_input_is_handled():
+    rng = np.random.default_rng(4)
+    points = rng.uniform(3.0, 3.1, 3000), rng.uniform(101.0, 101.1, 3000), rng.uniform(0, 1, 3000)
+    assert analyze_patterns(*points) == analyze_patterns(*points)
+    assert analyze_patterns([], [], [])['count'] == 0
+
+
+def test_endpoint_caches_per_dataset_version(client):
+    insert_infections([3.0, 3.01, 3.02], [101.0, 101.01, 101.02], [0.2, 0.5, 0.8])
+    db.session.commit()
+
+    first = client.get('/api/pattern_analysis?bandwidth=0.5')
+    assert first.status_code == 200 and first.headers['X-Cache'] == 'MISS'
+    assert first.json['count'] == 3
+    assert client.get('/api/pattern_analysis?bandwidth=0.5').headers['X-Cache'] == 'HIT'
+
+    insert_infections([3.03], [101.03], [0.9])
+    db.session.commit()
+    again = client.get('/api/pattern_analysis?bandwidth=0.5')
+    assert again.headers['X-Cache'] == 'MISS' and again.json['count'] == 4
+
+
+@pytest.mark.parametrize('bandwidth', ['0', '-1', 'nan', 'inf', 'wide'])
+def test_invalid_bandwidth_is_rejected(client, bandwidth):
+    assert client.get(f'/api/pattern_analysis?bandwidth={bandwidth}').status_code == 400
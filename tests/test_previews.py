@@ -0,0 +1,111 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+from app import db
+from models import ImageData
+from previews import (
+    PREVIEW_TILE_SIZE, _downsample, build_previews, build_pyramid, get_manifest, pyramid_max_zoom
+)
+from raster import create_mask, create_raster
+
+
+def png_pixels(path):
+    """RGBA array of a PNG written by tiles.encode_png"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    width, height = struct.unpack_from('>II', data, 16)
+    (length,) = struct.unpack_from('>I', data, 33)
+    raw = np.frombuffer(zlib.decompress(data[41:41 + length]), dtype=np.uint8).reshape(height, -1)
+    return raw[:, 1:].reshape(height, width, 4)
+
+
+def survey(tmp_path, height=300, width=600):
+    """Uncompressed 5-band TIFF whose left half is empty (no data)"""
+    path = str(tmp_path / 'survey.tif')
+    pixels = create_raster(path, height, width, 5, np.uint16)
+    pixels[:, width // 2:] = np.random.default_rng(0).integers(1000, 4000, (height, width - width // 2, 5))
+    pixels.flush()
+    del pixels
+    return path
+
+
+@pytest.mark.parametrize('size, zoom', [((100, 100), 0), ((256, 256), 0), ((257, 10), 1), ((300, 600), 2),
+                                        ((5000, 3000), 5)])
+def test_max_zoom_shows_full_resolution(size, zoom):
+    assert pyramid_max_zoom(*size) == zoom
+
+
+def test_pyramid_covers_the_image(tmp_path):
+    folder = str(tmp_path / 'previews')
+    manifest = build_pyramid(survey(tmp_path), folder, 'survey', 'image')
+    target = os.path.join(folder, manifest['directory'])
+
+    assert (manifest['width'], manifest['height'], manifest['max_zoom']) == (600, 300, 2)
+    assert get_manifest(folder, 'survey', 'image') == manifest
+    for z, across, down in ((0, 1, 1), (1, 2, 1), (2, 3, 2)):
+        assert sorted(os.listdir(os.path.join(target, str(z)))) == [str(x) for x in range(across)]
+        assert sorted(os.listdir(os.path.join(target, str(z), '0'))) == [f'{y}.png' for y in range(down)]
+
+    thumbnail = png_pixels(os.path.join(target, 'thumbnail.png'))
+    assert thumbnail.shape == (75, 150, 4)
+    # No-data pixels are transparent
+    assert not thumbnail[:, :70, 3].any() and thumbnail[:, 80:, 3].all()
+
+
+def test_rebuild_moves_to_a_new_version(tmp_path):
+    folder = str(tmp_path / 'previews')
+    path = survey(tmp_path)
+    first = build_pyramid(path, folder, 'survey', 'image')
+    second = build_pyramid(path, folder, 'survey', 'image')
+
+    assert second['directory'] != first['directory']
+    assert not os.path.exists(os.path.join(folder, first['directory']))
+    assert os.path.exists(os.path.join(folder, second['directory'], 'thumbnail.png'))
+
+
+def test_mask_opacity_follows_probability(tmp_path):
+    path = str(tmp_path / 'survey_result.tif')
+    mask = create_mask(path, 256, 256)
+    mask[:, 128:] = 255
+    mask.flush()
+    del mask
+
+    manifest = build_pyramid(path, str(tmp_path), 'survey', 'result')
+    tile = png_pixels(os.path.join(str(tmp_path), manifest['directory'], '0', '0', '0.png'))
+    assert not tile[:, :128, 3].any()
+    assert (tile[:, 128:, 3] > 200).all()
+
+
+def test_downsampling_ignores_transparent_pixels():
+    rgba = np.zeros((2, 2, 4), dtype=np.uint8)
+    rgba[0, 0] = (200, 100, 50, 255)
+    assert _downsample(rgba).tolist() == [[[200, 100, 50, 64]]]
+
+
+def test_only_memory_mappable_rasters_get_previews(tmp_path):
+    image = tmp_path / 'photo.png'
+    image.write_bytes(b'\x89PNG\r\n\x1a\n' + b'\0' * 64)
+    assert build_previews(str(image), None, str(tmp_path / 'previews')) == {}
+
+
+def test_previews_are_listed_and_served_immutably(app, client, tmp_path):
+    folder = app.config['PREVIEW_FOLDER']
+    image = ImageData(filename='survey.tif')
+    db.session.add(image)
+    db.session.commit()
+    assert client.get(f'/api/images/{image.id}/previews').json['image'] is None
+
+    build_previews(survey(tmp_path), None, folder)
+    previews = client.get(f'/api/images/{image.id}/previews').json
+    assert previews['result'] is None
+    assert previews['image']['tile_size'] == PREVIEW_TILE_SIZE
+
+    tile = client.get(previews['image']['tiles'].format(z=2, x=2, y=1))
+    assert tile.status_code == 200 and tile.mimetype == 'image/png'
+    assert tile.cache_control.immutable and not tile.cache_control.no_cache
+    thumbnail = previews['image']['thumbnail']
+    assert client.get(thumbnail.replace('thumbnail.png', '../survey.json')).status_code == 404
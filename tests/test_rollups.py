@@ -0,0 +1,109 @@
+from datetime import datetime
+
+from sqlalchemy import select, update, delete
+
+from app import db
+from models import InfectionData, InfectionRollup
+from rollups import rebuild_rollups, trend
+
+
+def rollup_rows():
+    return sorted(
+        (str(row.day), row.image_id, row.count, round(row.level_sum, 9), row.level_max)
+        for row in db.session.execute(select(InfectionRollup)).scalars()
+    )
+
+
+def assert_matches_rebuild():
+    incremental = rollup_rows()
+    rebuild_rollups()
+    assert incremental == rollup_rows()
+
+
+def add(level, day, image_id=None):
+    point = InfectionData(latitude=1.0, longitude=101.0, infection_level=level,
+                          date_recorded=datetime(2024, 3, day, 12), source_image_id=image_id)
+    db.session.add(point)
+    return point
+
+
+def test_inserts_are_folded_in(app):
+    add(0.2, 1)
+    add(0.6, 1)
+    add(0.4, 2)
+    db.session.commit()
+
+    assert trend() == [
+        {'date': '2024-03-01', 'count': 2, 'avg_level': 0.4, 'max_level': 0.6},
+        {'date': '2024-03-02', 'count': 1, 'avg_level': 0.4, 'max_level': 0.4},
+    ]
+    assert_matches_rebuild()
+
+
+def test_updates_recompute_the_days_left_and_entered(app):
+    high = add(0.9, 1)
+    moved = add(0.3, 1)
+    add(0.5, 2)
+    db.session.commit()
+
+    high.infection_level = 0.1
+    moved.date_recorded = datetime(2024, 3, 2, 8)
+    db.session.commit()
+
+    assert [(day['date'], day['count'], day['max_level']) for day in trend()] == [
+        ('2024-03-01', 1, 0.1),
+        ('2024-03-02', 2, 0.5),
+    ]
+    assert_matches_rebuild()
+
+
+def test_row_moved_after_a_commit_leaves_its_day(app):
+    point = add(0.4, 1)
+    db.session.commit()
+
+    # The row is expired, so its old day has to be loaded before the change
+    point.date_recorded = datetime(2024, 3, 5, 12)
+    db.session.commit()
+
+    assert [(day['date'], day['count']) for day in trend()] == [('2024-03-05', 1)]
+    assert_matches_rebuild()
+
+
+def test_deletes_recompute_their_day(app):
+    points = [add(0.2, 1), add(0.8, 1)]
+    db.session.commit()
+
+    # Committing expired the rows, so the listener has to load them
+    db.session.delete(points[1])
+    db.session.commit()
+    assert [(day['count'], day['max_level']) for day in trend()] == [(1, 0.2)]
+
+    db.session.delete(points[0])
+    add(0.7, 1)
+    db.session.commit()
+    assert [(day['count'], day['max_level']) for day in trend()] == [(1, 0.7)]
+    assert_matches_rebuild()
+
+
+def test_bulk_updates_and_deletes_rebuild_the_rollups(app):
+    add(0.2, 1)
+    add(0.4, 2)
+    add(0.6, 3)
+    db.session.commit()
+
+    db.session.execute(update(InfectionData).where(InfectionData.infection_level < 0.3).values(infection_level=0.9))
+    db.session.execute(delete(InfectionData).where(InfectionData.infection_level == 0.6))
+    db.session.commit()
+
+    assert [(day['date'], day['max_level']) for day in trend()] == [('2024-03-01', 0.9), ('2024-03-02', 0.4)]
+    assert_matches_rebuild()
+
+
+def test_rolled_back_bulk_changes_do_not_rebuild(app):
+    add(0.2, 1)
+    db.session.commit()
+
+    db.session.execute(delete(InfectionData))
+    db.session.rollback()
+    assert 'rollup_rebuild' not in db.session.info
+    assert [day['count'] for day in trend()] == [1]
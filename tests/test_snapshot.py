@@ -0,0 +1,91 @@
+from datetime import date, datetime
+
+import numpy as np
+import pytest
+
+import snapshot
+from app import db
+from ingest import insert_infections
+from models import InfectionData
+from snapshot import get_snapshot, snapshot_for
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Ids after which the snapshot read rows"""
+    calls = []
+    read_rows = snapshot._read_rows
+
+    def spy(after_id):
+        calls.append(after_id)
+        return read_rows(after_id)
+
+    monkeypatch.setattr(snapshot, '_read_rows', spy)
+    return calls
+
+
+def add(lats, lngs, levels, dates=None):
+    insert_infections(lats, lngs, levels, dates=dates)
+    db.session.commit()
+
+
+def test_appends_are_read_incrementally(app, reads):
+    add([1.0, 1.1], [101.0, 101.1], [0.2, 0.4])
+    first = get_snapshot()
+    assert get_snapshot() is first
+
+    add([1.2], [101.2], [0.6])
+    second = get_snapshot()
+
+    assert reads == [0, first.last_id]
+    assert second.level.tolist() == [0.2, 0.4, 0.6]
+    assert second.last_id == second.id[-1]
+    assert first.level.tolist() == [0.2, 0.4]
+
+
+def test_updates_reload_the_table(app, reads):
+    add([1.0, 1.1], [101.0, 101.1], [0.2, 0.4])
+    get_snapshot()
+
+    db.session.execute(db.select(InfectionData).order_by(InfectionData.id)).scalars().first().infection_level = 0.9
+    db.session.commit()
+
+    assert get_snapshot().level.tolist() == [0.9, 0.4]
+    assert reads == [0, 0]
+
+
+def test_select_filters_by_bbox_date_and_id(app):
+    add([1.0, 1.5, 3.0], [101.0, 101.5, 103.0], [0.2, 0.4, 0.6],
+        dates=[datetime(2024, 3, 1), datetime(2024, 3, 2), datetime(2024, 3, 3)])
+    current = get_snapshot()
+
+    assert current.select((100.9, 0.9, 101.6, 1.6)).tolist() == [0, 1]
+    assert current.select(start=date(2024, 3, 2), end=date(2024, 3, 2)).tolist() == [1]
+    assert current.select(after=int(current.id[1])).tolist() == [2]
+
+
+def test_merged_blocks_keep_the_smallest_id_and_highest_level(app):
+    add([1.0001, 1.0002, 3.0], [101.0001, 101.0002, 103.0], [0.2, 0.7, 0.6])
+    current = get_snapshot()
+
+    ids, lats, lngs, levels, dates, counts = current.merge_blocks(current.select(), factor=4)
+    assert ids.tolist() == [current.id[0], current.id[2]]
+    assert counts.tolist() == [2, 1]
+    assert levels.tolist() == [0.7, 0.6]
+    assert np.isclose(lats[0], 1.00015)
+
+
+def test_snapshot_is_skipped_when_disabled(app):
+    assert snapshot_for() is not None
+    app.config['INFECTION_SNAPSHOT'] = False
+    assert snapshot_for() is None
+
+
+def test_endpoints_answer_the_same_without_snapshot(app, client):
+    add([1.0, 1.0001, 1.5, 3.0], [101.0, 101.0001, 101.5, 103.0], [0.2, 0.3, 0.4, 0.6])
+    queries = ['/api/infection_data', '/api/infection_data?bbox=100.9,0.9,101.6,1.6',
+               '/api/infection_data?zoom=8', '/api/clusters?zoom=3&start=2000-01-01']
+
+    with_snapshot = [client.get(query).json for query in queries]
+    app.config['INFECTION_SNAPSHOT'] = False
+    assert [client.get(query).json for query in queries] == with_snapshot
@@ -0,0 +1,41 @@
+import pytest
+
+from app import db
+from ingest import insert_infections
+from models import InfectionData
+from spatial import grid_cell, parse_bbox
+
+
+def test_bbox_returns_only_points_inside(client):
+    insert_infections([1.0, 1.5, 3.0], [101.0, 101.5, 103.0], [0.2, 0.4, 0.6])
+    db.session.commit()
+
+    response = client.get('/api/infection_data?bbox=100.9,0.9,101.6,1.6')
+    assert response.status_code == 200
+    assert sorted(point['level'] for point in response.json) == [0.2, 0.4]
+
+
+def test_moved_point_is_found_at_its_new_position(client):
+    insert_infections([1.0], [101.0], [0.2])
+    db.session.commit()
+
+    point = db.session.execute(db.select(InfectionData)).scalar_one()
+    point.latitude, point.longitude = 2.0, 102.0
+    db.session.commit()
+
+    assert point.grid_cell == grid_cell(2.0, 102.0)
+    assert len(client.get('/api/infection_data?bbox=101.9,1.9,102.1,2.1').json) == 1
+    assert client.get('/api/infection_data?bbox=100.9,0.9,101.1,1.1').json == []
+
+
+@pytest.mark.parametrize('value', ['1,2,3', '1,2,3,x', '3,0,1,1', '0,3,1,1', 'nan,0,1,1', '0,0,inf,1', '-inf,0,1,1'])
+def test_invalid_bbox_is_rejected(value):
+    with pytest.raises(ValueError):
+        parse_bbox(value)
+
+
+@pytest.mark.parametrize('path', ['/api/infection_data', '/api/clusters', '/api/pattern_analysis',
+                                  '/api/infection_data/export'])
+def test_non_finite_bbox_is_a_bad_request(client, path):
+    assert client.get(f'{path}?bbox=nan,0,1,1').status_code == 400
+    assert client.get(f'{path}?bbox=0,0,inf,1').status_code == 400
@@ -0,0 +1,116 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+import pytest
+from sqlalchemy import delete
+
+import tiles
+from app import db
+from models import InfectionData
+from tiles import TILE_SIZE, TileCache, encode_png, render_tile
+
+ZOOM = 10
+
+
+def decode_png(data):
+    """RGBA array of a PNG written by encode_png (one IDAT chunk, filter 0)"""
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack_from('>II', data, 16)
+    (length,) = struct.unpack_from('>I', data, 33)
+    assert data[37:41] == b'IDAT'
+    raw = np.frombuffer(zlib.decompress(data[41:41 + length]), dtype=np.uint8).reshape(height, -1)
+    assert not raw[:, 0].any()
+    return raw[:, 1:].reshape(height, width, 4)
+
+
+def tile_of(lat, lng, z=ZOOM):
+    px, py = tiles._world_pixels(np.array([lat]), np.array([lng]), z)
+    return int(px[0] // TILE_SIZE), int(py[0] // TILE_SIZE)
+
+
+def add(lat, lng, level=0.5):
+    point = InfectionData(latitude=lat, longitude=lng, infection_level=level)
+    db.session.add(point)
+    db.session.commit()
+    return point
+
+
+def test_png_round_trips():
+    rgba = np.random.default_rng(0).integers(0, 256, (5, 7, 4), dtype=np.uint8)
+    assert np.array_equal(decode_png(encode_png(rgba)), rgba)
+
+
+def test_tile_shows_heat_around_its_points_only():
+    x, y = tile_of(3.14, 101.69)
+    rgba = render_tile(np.array([3.14]), np.array([101.69]), np.array([1.0]), ZOOM, x, y)
+
+    assert rgba.shape == (TILE_SIZE, TILE_SIZE, 4)
+    hottest = np.unravel_index(np.argmax(rgba[..., 3]), rgba.shape[:2])
+    assert rgba[hottest][:3].tolist() == tiles.PALETTE_COLORS[-1].tolist()
+    assert (rgba[..., 3] > 0).sum() < (2 * tiles.BLUR_RADIUS + 1) ** 2
+    assert not render_tile(np.empty(0), np.empty(0), np.empty(0), ZOOM, x, y)[..., 3].any()
+
+
+def test_tiles_are_served_and_cached(app, client):
+    add(3.14, 101.69)
+    x, y = tile_of(3.14, 101.69)
+
+    response = client.get(f'/tiles/{ZOOM}/{x}/{y}.png')
+    assert response.status_code == 200 and response.mimetype == 'image/png'
+    assert decode_png(response.data)[..., 3].any()
+    assert os.path.exists(tiles.get_tile_cache().path(ZOOM, x, y))
+
+    assert client.get(f'/tiles/{ZOOM}/{2 ** ZOOM}/0.png').status_code == 404
+
+
+def test_committed_changes_invalidate_the_tiles_they_touch(app, client):
+    point = add(3.14, 101.69)
+    near = tile_of(3.14, 101.69)
+    far = tile_of(-6.2, 106.8)
+    cache = tiles.get_tile_cache()
+    for x, y in (near, far):
+        client.get(f'/tiles/{ZOOM}/{x}/{y}.png')
+
+    add(3.1401, 101.6901)
+    assert not os.path.exists(cache.path(ZOOM, *near))
+    assert os.path.exists(cache.path(ZOOM, *far))
+
+    client.get(f'/tiles/{ZOOM}/{near[0]}/{near[1]}.png')
+    point.latitude, point.longitude = -6.2, 106.8
+    db.session.commit()
+    # A moved point leaves one tile and enters another
+    assert not os.path.exists(cache.path(ZOOM, *near))
+    assert not os.path.exists(cache.path(ZOOM, *far))
+
+
+def test_bulk_deletes_clear_the_cache_after_commit(app, client):
+    add(3.14, 101.69)
+    x, y = tile_of(3.14, 101.69)
+    client.get(f'/tiles/{ZOOM}/{x}/{y}.png')
+    path = tiles.get_tile_cache().path(ZOOM, x, y)
+
+    db.session.execute(delete(InfectionData))
+    db.session.rollback()
+    assert os.path.exists(path)
+
+    db.session.execute(delete(InfectionData))
+    db.session.commit()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('count', [10])
+def test_cache_evicts_least_recently_used_tiles(tmp_path, count):
+    data = b'x' * 100
+    cache = TileCache(str(tmp_path), max_bytes=100 * count)
+    for y in range(count):
+        cache.put(0, 0, y, data)
+        os.utime(cache.path(0, 0, y), (y, y))
+    cache.get(0, 0, 0)
+
+    cache.put(0, 0, count, data)
+    kept = sorted(int(name.split('.')[0]) for name in os.listdir(tmp_path / '0' / '0'))
+    assert 0 in kept and count in kept
+    assert 1 not in kept
+    assert len(kept) * len(data) <= 0.9 * cache.max_bytes
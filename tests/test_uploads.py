@@ -0,0 +1,72 @@
+import io
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import uploads
+from app import db
+from models import ImageData, ProcessingJob
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    """Queue jobs without running the model"""
+    def enqueue_image(image):
+        job = ProcessingJob(image_id=image.id)
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    monkeypatch.setattr(uploads, 'enqueue_image', enqueue_image)
+
+
+def upload(name, content=b'palm survey'):
+    return FileStorage(stream=io.BytesIO(content), filename=name)
+
+
+def test_duplicate_upload_reuses_the_image(app, queued):
+    with app.test_request_context():
+        image, job, duplicate = uploads.register_upload(upload('flight.png'))
+        again, again_job, again_duplicate = uploads.register_upload(upload('copy.png'))
+
+    assert not duplicate
+    assert again_duplicate
+    assert again.id == image.id
+    assert again_job.id == job.id
+    assert db.session.query(ImageData).count() == 1
+    assert db.session.query(ProcessingJob).count() == 1
+
+
+def test_duplicate_of_processed_upload_needs_no_job(app, queued):
+    with app.test_request_context():
+        image, _, _ = uploads.register_upload(upload('flight.png'))
+        image.processed = True
+        db.session.commit()
+        again, job, duplicate = uploads.register_upload(upload('flight.png'))
+
+    assert duplicate and job is None
+    assert again.id == image.id
+
+
+def test_different_content_gets_its_own_image(app, queued):
+    with app.test_request_context():
+        first, _, _ = uploads.register_upload(upload('a.png', b'one'))
+        second, _, duplicate = uploads.register_upload(upload('a.png', b'two'))
+
+    assert not duplicate
+    assert first.id != second.id
+    assert first.filename != second.filename
+
+
+def test_duplicate_of_image_without_job_is_queued(app, queued):
+    with app.test_request_context():
+        image, job, _ = uploads.register_upload(upload('flight.png'))
+        # An image left behind without a job, e.g. by a crash before it was queued
+        db.session.delete(job)
+        db.session.commit()
+        again, again_job, duplicate = uploads.register_upload(upload('flight.png'))
+
+    assert duplicate
+    assert again.id == image.id
+    assert again_job is not None and again_job.image_id == image.id
+    assert db.session.query(ProcessingJob).count() == 1
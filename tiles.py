@@ -0,0 +1,390 @@
+import io
+import os
+import math
+import time
+import zlib
+import struct
+import logging
+import threading
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import event, select, inspect
+
+from app import db
+from models import InfectionData
+from spatial import bbox_conditions
+from versioning import get_dataset_version
+
+# Server-side heatmap tiles in the standard web mercator z/x/y scheme. Tiles are
+# rendered from InfectionData with NumPy binning and a separable blur, encoded as
+# RGBA PNG and kept in a size-bounded on-disk cache shared by all workers. Access
+# times drive LRU eviction. Committed inserts, updates and deletes delete the
+# tiles around the rows they touched; bulk updates or deletes, whose rows are not
+# known, empty the cache. A tile whose dataset version changed while it was
+# rendered is served once but not kept, since the commit that changed it may have
+# invalidated the region before the tile was stored.
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+MAX_TILE_ZOOM = 18
+
+# Heat spread around each point, in pixels
+BLUR_RADIUS = 8
+
+# Blurred point density at which a pixel reaches ~63% opacity
+DENSITY_SCALE = 0.05
+
+MAX_ALPHA = 220
+
+# Severity colour ramp, matching the map legend (low, medium, high)
+PALETTE_LEVELS = np.array([0.0, 0.5, 1.0])
+PALETTE_COLORS = np.array([
+    [39, 174, 96],
+    [243, 156, 18],
+    [192, 57, 43],
+], dtype=np.float64)
+
+
+def tile_bounds(z, x, y):
+    """
+    Geographic bounds of a tile
+
+    Returns:
+        Tuple (west, south, east, north) in degrees
+    """
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def _world_pixels(lats, lngs, z):
+    """Global web mercator pixel coordinates at zoom z"""
+    scale = TILE_SIZE * 2 ** z
+    lat = np.radians(np.clip(lats, -85.0511, 85.0511))
+    px = (np.asarray(lngs) + 180) / 360 * scale
+    py = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2 * scale
+    return px, py
+
+
+def _blur(grid):
+    """Separable Gaussian blur built from shifted slices"""
+    offsets = np.arange(-BLUR_RADIUS, BLUR_RADIUS + 1)
+    weights = np.exp(-0.5 * (offsets / (BLUR_RADIUS / 2)) ** 2)
+    weights /= weights.sum()
+
+    padded = np.pad(grid, BLUR_RADIUS)
+    height, width = grid.shape
+    rows = np.zeros((height, width + 2 * BLUR_RADIUS))
+    for i, weight in enumerate(weights):
+        rows += weight * padded[i:i + height, :]
+    result = np.zeros_like(grid)
+    for i, weight in enumerate(weights):
+        result += weight * rows[:, i:i + width]
+    return result
+
+
+def render_tile(lats, lngs, levels, z, x, y):
+    """
+    Render an RGBA heatmap tile
+
+    Args:
+        lats, lngs, levels: Arrays of infection points (points outside the tile
+            within BLUR_RADIUS pixels contribute to its edges)
+        z, x, y: Tile coordinates
+
+    Returns:
+        uint8 array of shape (TILE_SIZE, TILE_SIZE, 4)
+    """
+    size = TILE_SIZE + 2 * BLUR_RADIUS
+    density = np.zeros(size * size)
+    severity = np.zeros(size * size)
+
+    if len(lats):
+        px, py = _world_pixels(lats, lngs, z)
+        col = np.floor(px - x * TILE_SIZE + BLUR_RADIUS).astype(np.int64)
+        row = np.floor(py - y * TILE_SIZE + BLUR_RADIUS).astype(np.int64)
+        inside = (col >= 0) & (col < size) & (row >= 0) & (row < size)
+        index = row[inside] * size + col[inside]
+        density = np.bincount(index, minlength=size * size).astype(np.float64)
+        severity = np.bincount(index, weights=np.asarray(levels)[inside], minlength=size * size)
+
+    crop = slice(BLUR_RADIUS, BLUR_RADIUS + TILE_SIZE)
+    density = _blur(density.reshape(size, size))[crop, crop]
+    severity = _blur(severity.reshape(size, size))[crop, crop]
+
+    # Colour by mean severity, fade in with density
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_level = np.where(density > 0, severity / density, 0.0)
+    rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.interp(mean_level, PALETTE_LEVELS, PALETTE_COLORS[:, channel])
+    rgba[..., 3] = MAX_ALPHA * -np.expm1(-density / DENSITY_SCALE)
+    return rgba
+
+
+def encode_png(rgba):
+    """Encode an RGBA uint8 array as PNG"""
+    height, width, _ = rgba.shape
+    raw = np.zeros((height, 1 + width * 4), dtype=np.uint8)  # Filter byte 0 per row
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def _tile_points(z, x, y):
+    """Infection points that contribute to a tile, including its blur margin"""
+    west, south, east, north = tile_bounds(z, x, y)
+    margin_lng = (east - west) * BLUR_RADIUS / TILE_SIZE
+    margin_lat = (north - south) * BLUR_RADIUS / TILE_SIZE
+    bbox = (west - margin_lng, south - margin_lat, east + margin_lng, north + margin_lat)
+
+    rows = db.session.connection().execute(
+        select(InfectionData.latitude, InfectionData.longitude, InfectionData.infection_level)
+        .where(*bbox_conditions(InfectionData, bbox))
+    ).all()
+    if not rows:
+        return np.empty(0), np.empty(0), np.empty(0)
+
+    return tuple(np.array(column, dtype=np.float64) for column in zip(*rows))
+
+
+class TileCache:
+    """
+    Size-bounded on-disk tile cache with least-recently-used eviction
+
+    Tiles live at <folder>/<z>/<x>/<y>.png. A tile's access time records its last
+    use (set explicitly, so it works on noatime mounts) while the modification time
+    stays that of rendering, which keeps HTTP validators stable.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def path(self, z, x, y):
+        return os.path.join(self.folder, str(z), str(x), f'{y}.png')
+
+    def get(self, z, x, y):
+        """Path of a cached tile, or None if it is not cached"""
+        path = self.path(z, x, y)
+        try:
+            stat = os.stat(path)
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, z, x, y, data):
+        """Store a tile and evict old tiles if the cache grew too large"""
+        path = self.path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._scan())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+        return path
+
+    def _scan(self):
+        """Yield (path, atime, size) of every cached tile"""
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if not name.endswith('.png'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_atime, stat.st_size
+
+    def _evict(self):
+        """Delete least recently used tiles until the cache is at 90% of its limit"""
+        tiles = sorted(self._scan(), key=lambda tile: tile[1])
+        total = sum(size for _, _, size in tiles)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for path, _, size in tiles:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._size = total
+        logger.debug(f"Evicted {removed} heatmap tiles")
+
+    def invalidate(self, west, south, east, north):
+        """Delete every cached tile whose rendering is affected by the given region"""
+        removed = 0
+        for z in range(MAX_TILE_ZOOM + 1):
+            zoom_folder = os.path.join(self.folder, str(z))
+            if not os.path.isdir(zoom_folder):
+                continue
+
+            # Points reach BLUR_RADIUS pixels beyond their own tile
+            (x0, x1), (y1, y0) = _world_pixels(
+                np.array([south, north]), np.array([west, east]), z
+            )
+            max_index = 2 ** z - 1
+            x_min = max(int((x0 - BLUR_RADIUS) // TILE_SIZE), 0)
+            x_max = min(int((x1 + BLUR_RADIUS) // TILE_SIZE), max_index)
+            y_min = max(int((y0 - BLUR_RADIUS) // TILE_SIZE), 0)
+            y_max = min(int((y1 + BLUR_RADIUS) // TILE_SIZE), max_index)
+
+            for x_entry in os.scandir(zoom_folder):
+                if not x_entry.name.isdigit() or not x_min <= int(x_entry.name) <= x_max:
+                    continue
+                for y_entry in os.scandir(x_entry.path):
+                    y = y_entry.name.split('.')[0]
+                    if y.isdigit() and y_min <= int(y) <= y_max and y_entry.name.endswith('.png'):
+                        try:
+                            os.remove(y_entry.path)
+                            removed += 1
+                        except FileNotFoundError:
+                            pass
+
+        with self._lock:
+            self._size = None
+        if removed:
+            logger.debug(f"Invalidated {removed} heatmap tiles")
+
+    def discard(self, z, x, y):
+        """Delete a cached tile"""
+        try:
+            os.remove(self.path(z, x, y))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._size = None
+
+    def clear(self):
+        """Delete every cached tile"""
+        removed = 0
+        for path, _, _ in list(self._scan()):
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._size = None
+        logger.debug(f"Cleared {removed} heatmap tiles")
+
+
+_cache = None
+
+
+def get_tile_cache():
+    """The process-wide tile cache, configured from the app config"""
+    global _cache
+    if _cache is None:
+        _cache = TileCache(current_app.config["TILE_CACHE_FOLDER"], current_app.config["TILE_CACHE_MAX_BYTES"])
+    return _cache
+
+
+def get_tile(z, x, y):
+    """
+    Rendered PNG for a tile, rendering and caching it if needed
+
+    Returns:
+        Path of the cached PNG, or a BytesIO with the PNG if the data changed
+        while it was rendered
+    """
+    cache = get_tile_cache()
+    path = cache.get(z, x, y)
+    if path is not None:
+        return path
+
+    version = get_dataset_version()
+    lats, lngs, levels = _tile_points(z, x, y)
+    data = encode_png(render_tile(lats, lngs, levels, z, x, y))
+    path = cache.put(z, x, y, data)
+
+    # A commit after this check invalidates the stored tile itself; one before it
+    # may have invalidated the region before the tile was stored
+    if get_dataset_version() != version:
+        cache.discard(z, x, y)
+        return io.BytesIO(data)
+    return path
+
+
+def invalidate_tiles(lats, lngs):
+    """Invalidate cached tiles covering a set of new or changed infection points"""
+    if len(lats) == 0:
+        return
+    get_tile_cache().invalidate(float(np.min(lngs)), float(np.min(lats)),
+                                float(np.max(lngs)), float(np.max(lats)))
+
+
+def _previous_value(obj, name):
+    """Value of an attribute before the changes being flushed"""
+    history = inspect(obj).attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(obj, name)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changed_infections(session, flush_context):
+    """Remember where InfectionData rows were inserted, updated or deleted in this transaction"""
+    points = session.info.setdefault('tile_points', [])
+    points.extend(
+        (obj.latitude, obj.longitude)
+        for obj in session.new if isinstance(obj, InfectionData)
+    )
+    for obj in list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, InfectionData):
+            continue
+        # A moved point affects the tiles it left as well as those it entered
+        points.append((_previous_value(obj, 'latitude'), _previous_value(obj, 'longitude')))
+        if obj not in session.deleted:
+            points.append((obj.latitude, obj.longitude))
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _collect_bulk_changes(orm_execute_state):
+    """Bulk updates and deletes of InfectionData may touch any tile"""
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ is InfectionData:
+            orm_execute_state.session.info['tile_clear'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_committed_infections(session):
+    points = session.info.pop('tile_points', None)
+    if session.info.pop('tile_clear', False):
+        get_tile_cache().clear()
+    elif points:
+        lats, lngs = zip(*points)
+        invalidate_tiles(lats, lngs)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_rolled_back_infections(session):
+    session.info.pop('tile_points', None)
+    session.info.pop('tile_clear', None)
@@ -0,0 +1,293 @@
+import os
+import shutil
+import hashlib
+import logging
+import tarfile
+import zipfile
+import tempfile
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+
+from app import db
+from models import ImageData, ProcessingJob, UploadBatch
+from jobs import enqueue_image, enqueue_batch, retry_job
+
+# Content-addressed upload storage. Uploads are streamed to disk in chunks while
+# they are hashed and stored as <sha256>.<ext>, so uploads sharing a name no longer
+# overwrite each other and the same imagery is stored once. An ImageData row is
+# unique per hash: re-uploading a flight reuses the existing row, its result and
+# its infection points instead of running the model again.
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Archives whose images are unpacked by register_batch()
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+# Upper bound on the images of one batch upload
+MAX_BATCH_FILES = 1000
+
+# Registrations of a batch tried before giving up on concurrent uploads of the same images
+REGISTER_ATTEMPTS = 3
+
+
+def save_upload(file):
+    """
+    Stream an uploaded file into UPLOAD_FOLDER under its content hash
+
+    Args:
+        file: werkzeug FileStorage
+
+    Returns:
+        Tuple (stored file name, hex SHA-256 of the content)
+    """
+    return store_stream(file.stream, file.filename)
+
+
+def store_stream(stream, filename):
+    """
+    Stream a binary file object into UPLOAD_FOLDER under its content hash
+
+    Args:
+        stream: Readable binary file object, e.g. an archive member
+        filename: Original name, for the extension
+
+    Returns:
+        Tuple (stored file name, hex SHA-256 of the content)
+    """
+    folder = current_app.config["UPLOAD_FOLDER"]
+    os.makedirs(folder, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=folder, prefix='.upload-', delete=False) as temp:
+        try:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                temp.write(chunk)
+        except BaseException:
+            temp.close()
+            os.remove(temp.name)
+            raise
+
+    content_hash = digest.hexdigest()
+    extension = os.path.splitext(secure_filename(filename))[1].lower()
+    filename = f'{content_hash}{extension}'
+    path = os.path.join(folder, filename)
+    if os.path.exists(path):
+        os.remove(temp.name)
+    else:
+        os.replace(temp.name, path)
+    return filename, content_hash
+
+
+def is_content_addressed(filename):
+    """Whether a name in UPLOAD_FOLDER is an upload stored under its content hash"""
+    stem = os.path.splitext(filename)[0]
+    return len(stem) == 64 and all(c in '0123456789abcdef' for c in stem)
+
+
+def _latest_job(image):
+    return db.session.execute(
+        select(ProcessingJob)
+        .where(ProcessingJob.image_id == image.id)
+        .order_by(ProcessingJob.id.desc())
+        .limit(1)
+    ).scalar()
+
+
+def _find_by_hash(content_hash):
+    return db.session.execute(
+        select(ImageData).where(ImageData.content_hash == content_hash)
+    ).scalar()
+
+
+def register_upload(file):
+    """
+    Store an upload and queue it for processing unless the same content was seen before
+
+    Args:
+        file: werkzeug FileStorage
+
+    Returns:
+        Tuple (ImageData, ProcessingJob or None, duplicate flag). For a duplicate
+        the job is that of the original upload (retried if it failed, created if
+        it has none), or None if the original has already been processed.
+    """
+    filename, content_hash = save_upload(file)
+
+    image = _find_by_hash(content_hash)
+    if image is None:
+        image = ImageData(
+            filename=filename,
+            original_filename=secure_filename(file.filename),
+            content_hash=content_hash
+        )
+        db.session.add(image)
+        try:
+            db.session.flush()
+            # Commits the image together with its job
+            return image, enqueue_image(image), False
+        except IntegrityError:
+            # Another worker registered the same content first
+            db.session.rollback()
+            image = _find_by_hash(content_hash)
+
+    logger.info(f"Upload {file.filename} duplicates image {image.id}, reusing its results")
+    if image.processed:
+        return image, None, True
+
+    job = _latest_job(image)
+    if job is None:
+        job = enqueue_image(image)
+    elif job.status == 'failed':
+        retry_job(job)
+    return image, job, True
+
+
+def _archive_members(path, name):
+    """Yield (member name, binary stream) for every file in a zip or tar archive"""
+    if name.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as stream:
+                        yield info.filename, stream
+    else:
+        with tarfile.open(path, 'r:*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+
+
+def _iter_batch_files(files):
+    """Yield (file name, binary stream) for uploaded images and the members of uploaded archives"""
+    folder = current_app.config["UPLOAD_FOLDER"]
+    os.makedirs(folder, exist_ok=True)
+    for file in files:
+        if not file.filename.lower().endswith(ARCHIVE_EXTENSIONS):
+            yield file.filename, file.stream
+            continue
+
+        # Archives are read from disk, so they are never held in memory
+        with tempfile.NamedTemporaryFile(dir=folder, prefix='.archive-') as temp:
+            shutil.copyfileobj(file.stream, temp, UPLOAD_CHUNK_SIZE)
+            temp.flush()
+            try:
+                yield from _archive_members(temp.name, file.filename)
+            except (zipfile.BadZipFile, tarfile.TarError) as e:
+                logger.warning(f"Cannot read archive {file.filename}: {str(e)}")
+                yield file.filename, None
+
+
+def _store_batch_files(files, allowed):
+    """Store the images of a batch upload; returns (list of (name, stored name, hash), skipped)"""
+    stored, skipped = [], []
+    for name, stream in _iter_batch_files(files):
+        if stream is None:
+            skipped.append({'filename': name, 'reason': 'unreadable archive'})
+        elif not allowed(os.path.basename(name)):
+            skipped.append({'filename': name, 'reason': 'unsupported file type'})
+        elif len(stored) >= MAX_BATCH_FILES:
+            skipped.append({'filename': name, 'reason': f'more than {MAX_BATCH_FILES} images'})
+        else:
+            stored.append((name,) + store_stream(stream, name))
+    return stored, skipped
+
+
+def _register_batch_images(stored):
+    """
+    Add the ImageData rows of stored batch files and an UploadBatch with a job
+    for every image that needs processing, in one transaction
+
+    Returns:
+        Tuple (UploadBatch or None, entries describing each file, dictionary
+        mapping image ids to their job)
+
+    Raises:
+        IntegrityError: If another upload registered the same content concurrently
+    """
+    entries, images, pending, jobs = [], {}, [], {}
+    for name, filename, content_hash in stored:
+        image = images.get(content_hash) or _find_by_hash(content_hash)
+        duplicate = image is not None
+        if image is None:
+            image = ImageData(
+                filename=filename,
+                original_filename=secure_filename(os.path.basename(name)),
+                content_hash=content_hash
+            )
+            db.session.add(image)
+            db.session.flush()
+            pending.append(image)
+        elif content_hash not in images and not image.processed:
+            # Duplicates reuse the results (or the job) of the first upload
+            job = _latest_job(image)
+            if job is None:
+                pending.append(image)
+            else:
+                jobs[image.id] = job
+        images[content_hash] = image
+
+        entry = {'filename': name, 'image_id': image.id, 'duplicate': duplicate}
+        if duplicate:
+            entry['processed'] = image.processed
+        entries.append(entry)
+
+    batch = None
+    if pending:
+        batch = UploadBatch()
+        db.session.add(batch)
+        db.session.flush()
+        for image in pending:
+            jobs[image.id] = ProcessingJob(image_id=image.id, batch_id=batch.id)
+            db.session.add(jobs[image.id])
+    db.session.commit()
+    return batch, entries, jobs
+
+
+def register_batch(files, allowed):
+    """
+    Store the images of a batch upload and queue the new ones as one UploadBatch
+
+    Every file is stored before any row is written, and the images, the batch
+    and its jobs are committed together, so a failing member leaves no image
+    without a job.
+
+    Args:
+        files: werkzeug FileStorage list of images and zip or tar archives of images
+        allowed: Predicate telling whether a file name is a supported image
+
+    Returns:
+        Tuple (UploadBatch, or None if no image needs processing, list of
+        dictionaries describing each stored image, list of skipped files with
+        the reason)
+    """
+    stored, skipped = _store_batch_files(files, allowed)
+
+    for attempt in range(REGISTER_ATTEMPTS):
+        try:
+            batch, entries, jobs = _register_batch_images(stored)
+            break
+        except IntegrityError:
+            # Another worker registered some of the same content first; the next
+            # attempt finds its rows
+            db.session.rollback()
+            if attempt == REGISTER_ATTEMPTS - 1:
+                raise
+
+    for entry in entries:
+        if entry['image_id'] in jobs:
+            entry['job_id'] = jobs[entry['image_id']].id
+    for job in jobs.values():
+        if job.status == 'failed':
+            retry_job(job)
+
+    if batch is not None:
+        enqueue_batch(batch)
+    return batch, entries, skipped
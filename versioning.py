@@ -0,0 +1,122 @@
+import logging
+from datetime import datetime
+from collections import namedtuple
+
+from sqlalchemy import event, select, update, insert
+
+from app import db
+from models import DatasetVersion, InfectionData, PredictionModel
+
+# Every transaction that writes InfectionData bumps the 'infection_data' dataset
+# version in the same transaction. Caches key their entries on this version, so
+# a cached result can never outlive the data it was computed from, whichever
+# worker made the change. Loaders that bypass the ORM (Core statements on the
+# table) call mark_changed().
+# PredictionModel writes bump 'prediction_models' the same way, which tells every
+# worker's model registry to reload.
+#
+# The bump happens before the rows are written. Its row lock then serializes
+# writers, so new ids become visible in increasing order and "id > last seen id"
+# finds every row appended since a sync cursor (see routes.py). Updates and
+# deletes also record the version as rewritten_version: cursors older than that
+# cannot be served as a delta.
+
+logger = logging.getLogger(__name__)
+
+INFECTION_DATA = 'infection_data'
+PREDICTION_MODELS = 'prediction_models'
+
+# Mapped classes whose writes bump a dataset version
+TRACKED_MODELS = {
+    InfectionData: INFECTION_DATA,
+    PredictionModel: PREDICTION_MODELS,
+}
+
+
+DatasetState = namedtuple('DatasetState', 'version rewritten_version updated_date')
+
+
+def get_dataset_version(name=INFECTION_DATA):
+    """Current version of a dataset (0 if it was never written)"""
+    version = db.session.execute(
+        select(DatasetVersion.version).where(DatasetVersion.name == name)
+    ).scalar()
+    return version or 0
+
+
+def get_dataset_state(name=INFECTION_DATA):
+    """
+    Version of a dataset with the last version that updated or deleted rows and
+    the time of the last write
+    """
+    row = db.session.execute(
+        select(DatasetVersion.version, DatasetVersion.rewritten_version, DatasetVersion.updated_date)
+        .where(DatasetVersion.name == name)
+    ).first()
+    if row is None:
+        return DatasetState(0, 0, None)
+    return DatasetState(row.version, row.rewritten_version or 0, row.updated_date)
+
+
+def bump_dataset_version(connection, name=INFECTION_DATA, rewrite=False):
+    """
+    Increment a dataset version
+
+    Args:
+        connection: Connection (or Session) whose transaction the bump joins
+        name: Dataset name
+        rewrite: The write updates or deletes rows rather than only appending
+    """
+    table = DatasetVersion.__table__
+    values = {'version': table.c.version + 1, 'updated_date': datetime.utcnow()}
+    if rewrite:
+        values['rewritten_version'] = table.c.version + 1
+    result = connection.execute(update(table).where(table.c.name == name).values(**values))
+    if result.rowcount == 0:
+        connection.execute(insert(table).values(
+            name=name, version=1, rewritten_version=1 if rewrite else 0, updated_date=datetime.utcnow()
+        ))
+
+
+def mark_changed(session, name=INFECTION_DATA, rewrite=False):
+    """Bump a dataset version once per session transaction; call before writing"""
+    bumped = session.info.setdefault('bumped_versions', {})
+    if name not in bumped:
+        bump_dataset_version(session.connection(), name, rewrite)
+        bumped[name] = rewrite
+    elif rewrite and not bumped[name]:
+        table = DatasetVersion.__table__
+        session.connection().execute(
+            update(table).where(table.c.name == name).values(rewritten_version=table.c.version)
+        )
+        bumped[name] = True
+
+
+@event.listens_for(db.session, 'before_flush')
+def _bump_on_tracked_writes(session, flush_context, instances):
+    """Bump the dataset versions of tracked classes a flush is about to write"""
+    changed = {}
+    for obj in session.new:
+        if type(obj) in TRACKED_MODELS:
+            changed.setdefault(TRACKED_MODELS[type(obj)], False)
+    for obj in list(session.dirty) + list(session.deleted):
+        if type(obj) in TRACKED_MODELS and (obj in session.deleted or session.is_modified(obj)):
+            changed[TRACKED_MODELS[type(obj)]] = True
+    for name, rewrite in changed.items():
+        mark_changed(session, name, rewrite)
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _bump_on_bulk_writes(orm_execute_state):
+    """Bump the dataset version of a tracked class written by a bulk statement"""
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.class_ in TRACKED_MODELS:
+            mark_changed(orm_execute_state.session, TRACKED_MODELS[mapper.class_],
+                         rewrite=not orm_execute_state.is_insert)
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def _reset_bumped_versions(session):
+    session.info.pop('bumped_versions', None)